@@ -1,86 +1,53 @@
 # boot.py
 # This file is executed on every boot (including wake-from-sleep)
+# boot.py ต้องจบให้เร็วที่สุด: ไม่มีการหน่วงเวลา ไม่รอ Wi-Fi
+# main.py จะเริ่มอ่าน Modbus RTU ทันที ระหว่างที่ Wi-Fi กำลังเชื่อมต่ออยู่เบื้องหลัง
 import gc
 import machine
 import network
-import time
+from bridge_config import load_config
 
-# --- LED Configuration ---
-LED_PIN = 21 # GPIO Pin for the built-in LED (Commonly GPIO21 for ESP32-C3)
+# --- Configuration (แก้ไขชื่อ WiFi / รหัสผ่าน / ขา LED ได้ที่ config.json) ---
+_cfg = load_config()
+LED_PIN = _cfg["led_pin"] # GPIO Pin for the built-in LED (Commonly GPIO21 for ESP32-C3)
+WIFI_SSID = _cfg["wifi"]["ssid"]
+WIFI_PASSWORD = _cfg["wifi"]["password"]
 led = None
 
-# --- WiFi Configuration ---
-WIFI_SSID = "wifi-ice"      # <<<<< แก้ไขชื่อ WiFi ของคุณที่นี่
-WIFI_PASSWORD = ""          # <<<<< ยืนยันว่าไม่มีรหัสผ่านสำหรับ wifi-ice
-
-# --- Start of Debugging LED (Simple blink to confirm boot) ---
+# --- LED: ปิดไว้ก่อน main.py จะเปิดเมื่อได้ IP (ไม่มีการกระพริบ/หน่วงเวลาตอนบูต) ---
 try:
     led = machine.Pin(LED_PIN, machine.Pin.OUT)
-    # กระพริบ LED 3 ครั้ง เพื่อบ่งบอกว่า boot.py เริ่มทำงาน
-    for _ in range(3):
-        led.value(1) # เปิด LED
-        time.sleep_ms(100)
-        led.value(0) # ปิด LED
-        time.sleep_ms(100)
+    led.value(0)
 except Exception as e:
     print(f"boot.py: Failed to initialize LED on pin {LED_PIN}: {e}. LED debug disabled.")
     led = None # ตั้งค่า led เป็น None หากเกิดข้อผิดพลาด
-# --- End of Debugging LED ---
-
-print("boot.py: Starting Wi-Fi connection...")
 
-def connect_wifi():
+def start_wifi():
+    """เริ่มการเชื่อมต่อ Wi-Fi แบบไม่บล็อก (ไม่รอผล) และคืนค่า WLAN interface"""
     nic = network.WLAN(network.STA_IF)
-    
-    # ถ้ามีการเชื่อมต่ออยู่แล้ว ให้ยกเลิกก่อน (เพื่อความแน่ใจในสถานะเริ่มต้น)
-    if nic.isconnected():
-        nic.disconnect()
-        time.sleep_ms(100)
-        print("boot.py: Disconnecting existing WiFi connection.")
 
     if not nic.active():
         nic.active(True)
         print("boot.py: Wi-Fi STA interface activated.")
-        time.sleep_ms(100) # ให้เวลา interface เริ่มทำงาน
 
-    print(f"boot.py: Attempting to connect to SSID: '{WIFI_SSID}'", end="")
-    
+    # ถ้าเชื่อมต่ออยู่แล้ว (เช่น soft reboot) ให้ใช้การเชื่อมต่อเดิม ไม่ต้องตัดแล้วต่อใหม่
+    if nic.isconnected():
+        print(f"boot.py: Keeping existing WiFi connection, IP: {nic.ifconfig()[0]}")
+        return nic
+
+    # ถ้ากำลังเชื่อมต่ออยู่แล้วก็ไม่ต้องสั่งซ้ำ
+    if nic.status() == network.STAT_CONNECTING:
+        print("boot.py: WiFi association already in progress.")
+        return nic
+
+    print(f"boot.py: Connecting to SSID '{WIFI_SSID}' in background...")
     # ไม่มี nic.config(txpower=...) เพราะพบว่าไม่จำเป็นและอาจก่อให้เกิดปัญหา
     nic.connect(WIFI_SSID, WIFI_PASSWORD)
-    
-    max_wait = 30 # รอนานสุด 30 วินาทีสำหรับการเชื่อมต่อ
-    while max_wait > 0:
-        if nic.isconnected():
-            break
-        max_wait -= 1
-        print(".", end="")
-        time.sleep(1)
-    
-    if not nic.isconnected():
-        final_status = nic.status()
-        print(f"\nboot.py: WiFi connection failed! Final status: {final_status}")
-        # กระพริบ LED เร็วๆ เพื่อบ่งบอกว่า WiFi เชื่อมต่อไม่ได้
-        if led:
-            for _ in range(10):
-                led.value(1)
-                time.sleep_ms(50)
-                led.value(0)
-                time.sleep_ms(50)
-        return None 
-    
-    ip_info = nic.ifconfig()
-    print("\nboot.py: WiFi Connected!")
-    print(f"boot.py: IP Address: {ip_info[0]}")
-    print(f"boot.py: Subnet Mask: {ip_info[1]}")
-    print(f"boot.py: Gateway: {ip_info[2]}")
-    print(f"boot.py: DNS Server: {ip_info[3]}")
-    
-    # เปิด LED ค้างไว้ เพื่อบ่งบอกว่า WiFi เชื่อมต่อสำเร็จ
-    if led:
-        led.value(1) 
-    
-    return ip_info[0]
+    return nic
 
-# เรียกฟังก์ชันเชื่อมต่อ Wi-Fi ทันทีที่บูต
-connect_wifi()
-gc.collect() # ทำ Garbage collection เพื่อเคลียร์หน่วยความจำ
\ No newline at end of file
+# สั่งเชื่อมต่อ Wi-Fi ทันทีที่บูต แต่ไม่รอผล (main.py จะตรวจสถานะเอง)
+try:
+    start_wifi()
+except Exception as e:
+    print(f"boot.py: Failed to start Wi-Fi: {e}")
+gc.collect() # ทำ Garbage collection เพื่อเคลียร์หน่วยความจำ
@@ -0,0 +1,272 @@
+# bridge_config.py
+# โหลดการตั้งค่าของ gateway จาก config.json (แก้ไฟล์เดียว ไม่ต้องแก้โค้ดแล้ว flash ใหม่)
+# แล้ว compile ตอนบูตเป็นโครงสร้างที่ใช้งานได้ทันที: RegisterImage + ตาราง poll + RoutingTable
+# load_config() ใช้แค่ json (boot.py เรียกได้โดยไม่ต้องโหลดส่วนอื่น) ส่วน compiler import โมดูลที่ต้องใช้เมื่อถูกเรียก
+# main.py unload โมดูลนี้ทิ้งหลัง compile เสร็จ เพราะไม่ได้ใช้อีกจนกว่าจะรีบูต
+import json
+from array import array
+
+CONFIG_PATH = "config.json"
+
+# ค่าเริ่มต้น (เหมือนค่าที่เคย hard-code ไว้ใน main.py) ใช้เมื่อไม่มีไฟล์หรือไม่ได้ระบุบางส่วน
+DEFAULT_CONFIG = {
+    "wifi": {"ssid": "wifi-ice", "password": "", "static_ip": None},
+    "led_pin": 21,
+    "bus": {"uart_id": 1, "tx_pin": 5, "rx_pin": 4, "de_re_pin": 2, "baudrate": 9600},
+    "buses": None, # list ของ bus (แบบเดียวกับ "bus") สำหรับหลาย RS-485 bus, None = ใช้ "bus" เส้นเดียว
+    # coalesce = รวม Response ของแต่ละ client ในรอบเดียวกันเป็นการส่งครั้งเดียว (False = ส่งทีละ Response)
+    "tcp": {"port": 502, "rtu_over_tcp_port": None, "udp_port": None, "max_sessions": 4, "coalesce": True},
+    "snapshot": {"path": "registers.snap", "min_interval_ms": 600000},
+    # ส่งค่าที่เปลี่ยนออกไปเอง: mode None = ปิด, "udp" หรือ "mqtt"; format "binary" หรือ "json"
+    "publish": {"mode": None, "host": "", "port": 5020, "format": "binary", "topic": "modbus",
+                "min_interval_ms": 1000, "client_id": "modbus-bridge"},
+    # ประวัติย้อนหลังใน RAM (pages x page_size ไบต์, pages 0 = ปิด) + spill ลง flash ระหว่าง Wi-Fi หลุด
+    # ดึงย้อนหลังผ่าน TCP port (None = ไม่เปิด)
+    "history": {"pages": 8, "page_size": 1024, "interval_ms": 0, "spill_path": None, "spill_pages": 64,
+                "port": 5021},
+    # transparent proxy ของ ok/main.py: จำนวน client, ขนาด FIFO, request ค้างต่อ client, ปิด session ที่เงียบ
+    # client_timeout_ms = deadline ของ request, client_share/burst_ms = token bucket เวลา bus ต่อ IP
+    # prefetch = อ่านล่วงหน้าตามคาบที่เรียนจาก request ของ client แล้วตอบจาก cache (ดู modbus_proxy.py)
+    "proxy": {"max_sessions": 4, "max_queue": 16, "max_pending": 8, "idle_timeout_ms": 60000,
+              "client_timeout_ms": 2000, "client_share": 50, "burst_ms": 1000, "prefetch": False,
+              "prefetch_slots": 8, "prefetch_max_age_ms": 300, "prefetch_lead_ms": 50, "prefetch_min_score": 3},
+    # สแกนหา slave ตอนบูต (bus แรก): ผลถูกบันทึกกลับลงไฟล์นี้ ("result") และปิด "enabled" ให้เอง
+    "scan": {"enabled": False, "baudrates": [9600, 19200, 38400, 57600, 115200, 4800, 2400], "first": 1,
+             "last": 247, "turnaround_ms": 30, "all_baudrates": False, "result": None},
+    # หาช่วง register ที่อ่านได้ของแต่ละ slave ตอนบูต แล้วเขียน "blocks" ใหม่ลงไฟล์นี้ (slaves None = ผลสแกน
+    # หรือ slave ของ blocks เดิม) ดู register_prober.py
+    "probe": {"enabled": False, "slaves": None, "start": 0, "end": 1000, "interval_ms": 1000},
+    # RTU worker thread (_thread): poll ทุก bus ใน thread แยก เขียนลง back buffer ของ image แล้วสลับ reference
+    "rtu_thread": {"enabled": False, "stack_size": 8192},
+    # ตรวจ kernel viper/native เทียบกับต้นแบบ pure-Python ตอนบูต (ปกติปิด: รัน kernel_check.py ด้วย mpremote แทน)
+    "kernel_check": False,
+    "image_size": 100,
+    "blocks": [
+        {"slave": 1, "start": 0, "count": 100, "interval_ms": 1000},
+    ],
+    "tcp_map": [
+        {"address": 0, "block": 0},
+    ],
+}
+
+def load_config(source=CONFIG_PATH):
+    """โหลด config จากชื่อไฟล์ หรือจาก str/bytes ของ JSON โดยตรง แล้วเติมค่าเริ่มต้นที่ขาด คืนค่าเป็น dict"""
+    if isinstance(source, (bytes, bytearray)):
+        user = json.loads(source.decode())
+    elif source.lstrip().startswith("{"):
+        user = json.loads(source)
+    else:
+        try:
+            with open(source) as f:
+                user = json.load(f)
+        except OSError:
+            print(f"config: {source} not found, using defaults")
+            user = {}
+
+    cfg = {}
+    for key, default in DEFAULT_CONFIG.items():
+        value = user.get(key, default)
+        if isinstance(default, dict) and isinstance(value, dict):
+            merged = dict(default)
+            merged.update(value)
+            value = merged
+        cfg[key] = value
+    return cfg
+
+class BridgeConfig:
+    """config ที่ compile แล้ว: ค่าตั้งต่างๆ เป็น attribute, register image พร้อม block และ routing table"""
+    def __init__(self, cfg):
+        wifi = cfg["wifi"]
+        self.wifi_ssid = wifi["ssid"]
+        self.wifi_password = wifi["password"]
+        self.static_ip = tuple(wifi["static_ip"]) if wifi.get("static_ip") else None
+        self.led_pin = cfg["led_pin"]
+
+        # RS-485 buses: แต่ละเส้นมี UART, ขา DE/RE, baud rate และ turnaround ของตัวเอง
+        self.buses = []
+        for bus in cfg["buses"] or [cfg["bus"]]:
+            settings = dict(DEFAULT_CONFIG["bus"])
+            settings.update(bus)
+            settings.setdefault("turnaround_ms", 100)
+            settings.setdefault("max_utilisation", 80) # เพดาน bus utilisation (%) ก่อนเริ่มยืด interval
+            settings.setdefault("echo", False) # transceiver ได้ยินไบต์ที่ตัวเองส่ง: ตัด echo ทิ้ง
+            self.buses.append(settings)
+        bus = self.buses[0] # ค่าของ bus แรกยังเป็น attribute เดิม (uart_id, tx_pin, ...)
+        self.uart_id = bus["uart_id"]
+        self.tx_pin = bus["tx_pin"]
+        self.rx_pin = bus["rx_pin"]
+        self.de_re_pin = bus["de_re_pin"]
+        self.baudrate = bus["baudrate"]
+
+        self.tcp_port = cfg["tcp"]["port"]
+        self.rtu_over_tcp_port = cfg["tcp"]["rtu_over_tcp_port"] # None = ปิด
+        self.udp_port = cfg["tcp"]["udp_port"]                   # None = ปิด
+        self.tcp_max_sessions = cfg["tcp"]["max_sessions"]
+        self.tcp_coalesce = cfg["tcp"]["coalesce"]
+        self.snapshot_path = cfg["snapshot"]["path"]
+        self.snapshot_min_interval_ms = cfg["snapshot"]["min_interval_ms"]
+
+        publish = cfg["publish"]
+        if publish["mode"] not in (None, "udp", "mqtt"):
+            raise ValueError(f"unknown publish mode '{publish['mode']}'")
+        self.publish_format = None
+        if publish["mode"]:
+            from register_publisher import FORMAT_NAMES
+            if publish["format"] not in FORMAT_NAMES:
+                raise ValueError(f"unknown publish format '{publish['format']}'")
+            self.publish_format = FORMAT_NAMES[publish["format"]]
+        self.publish_mode = publish["mode"]
+        self.publish_host = publish["host"]
+        self.publish_port = publish["port"]
+        self.publish_topic = publish["topic"]
+        self.publish_min_interval_ms = publish["min_interval_ms"]
+        self.publish_client_id = publish["client_id"]
+
+        history = cfg["history"]
+        self.history_pages = history["pages"]
+        self.history_page_size = history["page_size"]
+        self.history_interval_ms = history["interval_ms"]
+        self.history_spill_path = history["spill_path"]
+        self.history_spill_pages = history["spill_pages"]
+        self.history_port = history["port"]
+
+        self.rtu_thread = cfg["rtu_thread"]["enabled"]
+        self.rtu_thread_stack_size = cfg["rtu_thread"]["stack_size"]
+        self.kernel_check = cfg["kernel_check"]
+
+        scan = cfg["scan"]
+        self.scan_enabled = scan["enabled"]
+        self.scan_baudrates = tuple(scan["baudrates"])
+        self.scan_first = scan["first"]
+        self.scan_last = scan["last"]
+        self.scan_turnaround_ms = scan["turnaround_ms"]
+        self.scan_all_baudrates = scan["all_baudrates"]
+
+        probe = cfg["probe"]
+        self.probe_enabled = probe["enabled"]
+        self.probe_slaves = (probe["slaves"] or (scan["result"] or {}).get("slaves")
+                             or sorted(set(blk["slave"] for blk in cfg["blocks"])))
+        self.probe_start = probe["start"]
+        self.probe_end = probe["end"]
+        self.probe_interval_ms = probe["interval_ms"]
+
+        # Poll blocks -> RegisterImage (ตำแหน่งใน image ต่อกันตามลำดับใน config ถ้าไม่ระบุ "offset")
+        from register_image import RegisterImage, POLICY_SERVE, POLICY_EXCEPTION
+        policies = {"serve": POLICY_SERVE, "exception": POLICY_EXCEPTION}
+        self.image = RegisterImage(cfg["image_size"])
+        self.poll_interval_ms = array('L')
+        self.block_bus = bytearray()  # index ของ bus ที่ block อยู่
+        self.block_priority = bytearray() # 0 = interval คงที่, > 0 = ยืดได้เมื่อ bus แน่น
+        self.block_unit = array('H')  # unit id ฝั่ง TCP ของ block (สำหรับ tcp_map "auto")
+        for blk in cfg["blocks"]:
+            if not (1 <= blk["count"] <= 125):
+                raise ValueError("block count must be 1-125")
+            index = self.image.add_block(blk["slave"], blk["start"], blk["count"], blk.get("offset"))
+            policy = blk.get("policy", "serve")
+            if policy not in policies:
+                raise ValueError(f"unknown stale policy '{policy}'")
+            self.image.set_policy(index, policies[policy], blk.get("max_age_ms", 0), blk.get("age_register", -1))
+            if blk.get("deadband"):
+                # ค่าเดียวทั้ง block หรือ list ต่อ register (สำหรับค่า analog ที่แกว่งเล็กน้อย)
+                self.image.set_deadband(index, blk["deadband"])
+            self.poll_interval_ms.append(blk.get("interval_ms", 1000))
+            bus_index = blk.get("bus", 0)
+            if not (0 <= bus_index < len(self.buses)):
+                raise ValueError(f"block refers to unknown bus {bus_index}")
+            self.block_bus.append(bus_index)
+            self.block_priority.append(blk.get("priority", 0))
+            self.block_unit.append(blk.get("unit", blk["slave"]))
+
+        # TCP mapping -> RoutingTable (ไม่ระบุ "unit" = ใช้ได้กับทุก unit id)
+        # {"auto": true} = map ทุก block เป็น unit ของ block ที่ address เดียวกับฝั่ง RTU (ครอบทุก bus)
+        from routing import RoutingTable
+        self.routing = RoutingTable()
+        for entry in cfg["tcp_map"]:
+            if entry.get("auto"):
+                for b in range(self.image.num_blocks()):
+                    self.routing.add(self.block_unit[b], self.image.block_start[b],
+                                     self.image.block_count[b], self.image.block_offset[b])
+                continue
+            self._add_window(entry)
+        self.routing.build()
+
+    def _add_window(self, entry):
+        """แปลง 1 รายการใน tcp_map เป็น window ใน RoutingTable
+        แหล่งข้อมูลระบุได้ 3 แบบ: "block" (+ "block_offset"), "slave" + "rtu_address" หรือ "slot" ตรงๆ
+        view: "direct" (ค่าเริ่มต้น), "scale", "swap", "byteswap", "const" (ใช้ "values"), "status" (ใช้ "block"),
+        "float" (float32 -> int32 ใช้ "mul", "div", "word_swap")"""
+        from routing import ANY_UNIT, VIEW_NAMES, VIEW_SCALE, VIEW_CONST, VIEW_STATUS, VIEW_FLOAT, STATUS_REGISTERS
+        image = self.image
+        unit = entry.get("unit", ANY_UNIT)
+        view = entry.get("view", "direct")
+        if view not in VIEW_NAMES:
+            raise ValueError(f"unknown tcp_map view '{view}'")
+        kind = VIEW_NAMES[view]
+        param = None
+        slot = 0
+
+        if kind == VIEW_CONST:
+            param = tuple(entry["values"])
+            count = len(param)
+            for value in param:
+                if type(value) is not int or not (-0x8000 <= value <= 0xFFFF):
+                    raise ValueError("const values must be 16-bit integers")
+        elif kind == VIEW_STATUS:
+            param = entry["block"]
+            if not (0 <= param < image.num_blocks()):
+                raise ValueError(f"tcp_map refers to unknown block {param}")
+            count = STATUS_REGISTERS
+        else:
+            if "block" in entry:
+                b = entry["block"]
+                if not (0 <= b < image.num_blocks()):
+                    raise ValueError(f"tcp_map refers to unknown block {b}")
+                first = entry.get("block_offset", 0)
+                slot = image.block_offset[b] + first
+                count = entry.get("count", image.block_count[b] - first)
+                if first + count > image.block_count[b]:
+                    raise ValueError(f"tcp_map window outside block {b}")
+            elif "rtu_address" in entry:
+                count = entry["count"]
+                slot = self._rtu_slot(entry["slave"], entry["rtu_address"], count, entry.get("bus"))
+            else:
+                slot = entry["slot"]
+                count = entry["count"]
+            if slot + count > image.size:
+                raise ValueError("tcp_map range outside register image")
+            if kind == VIEW_SCALE:
+                param = (entry.get("mul", 1), entry.get("div", 1), entry.get("add", 0), entry.get("signed", False))
+                for value in param[:3]:
+                    # คำนวณเป็นจำนวนเต็มเท่านั้น (เช่น x0.1 ใช้ "div": 10 แทน "mul": 0.1)
+                    if type(value) is not int:
+                        raise ValueError("scale mul/div/add must be integers")
+                if param[1] == 0:
+                    raise ValueError("scale div must not be 0")
+            elif kind == VIEW_FLOAT:
+                param = (entry.get("mul", 1), entry.get("div", 1), bool(entry.get("word_swap", False)))
+                if type(param[0]) is not int or type(param[1]) is not int:
+                    raise ValueError("float mul/div must be integers")
+                if param[1] == 0:
+                    raise ValueError("float div must not be 0")
+        self.routing.add(unit, entry["address"], count, slot, kind, param)
+
+    def _rtu_slot(self, slave, rtu_address, count, bus=None):
+        """หา slot ใน image ของ register ฝั่ง RTU (slave, rtu_address..+count) จาก poll block ที่ครอบคลุม
+        ระบุ bus ได้เมื่อ slave id เดียวกันมีอยู่บนหลาย bus"""
+        image = self.image
+        for b in range(image.num_blocks()):
+            if bus is not None and self.block_bus[b] != bus:
+                continue
+            start = image.block_start[b]
+            if (image.block_slave[b] == slave and start <= rtu_address and
+                    rtu_address + count <= start + image.block_count[b]):
+                return image.block_offset[b] + (rtu_address - start)
+        raise ValueError(f"no poll block covers slave {slave} registers {rtu_address}-{rtu_address + count - 1}")
+
+    @property
+    def registers(self):
+        return self.image.registers
+
+def compile_config(source=CONFIG_PATH):
+    """โหลดและ compile config ในขั้นตอนเดียว"""
+    return BridgeConfig(load_config(source))
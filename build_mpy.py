@@ -0,0 +1,75 @@
+# build_mpy.py
+# รันบน PC: cross-compile โมดูลของ gateway เป็น .mpy (bytecode สำเร็จรูป) ลงโฟลเดอร์ build/
+# บอร์ดจะไม่ต้อง compile source ทุกครั้งที่บูต และ bytecode ที่โหลดจาก .mpy ใช้ RAM น้อยกว่า
+# boot.py / main.py / config.json คัดลอกไปตามเดิม (MicroPython รัน boot.py และ main.py จาก source เท่านั้น)
+# ต้องมี mpy-cross ที่ตรงกับเวอร์ชัน firmware บนบอร์ด (pip install mpy-cross==<เวอร์ชันเดียวกัน>)
+#
+# ใช้งาน:
+#   python build_mpy.py                  -> build/*.mpy + build/manifest.py (สำหรับ freeze ลง firmware)
+#   python build_mpy.py --deploy         -> build แล้วลบ .py เดิมบนบอร์ดและคัดลอกไฟล์ใน build/ ด้วย mpremote
+#   python build_mpy.py --deploy --ok    -> แบบเดียวกันสำหรับ transparent proxy: ok/boot.py, ok/main.py,
+#                                           ok/config.json + เฉพาะโมดูลจากโฟลเดอร์หลักที่ ok/main.py ใช้
+# ok/main.py ใช้โมดูลจากโฟลเดอร์หลัก (OK_MODULES) คัดลอกแค่โฟลเดอร์ ok/ ลงบอร์ดอย่างเดียวจะ ImportError
+# หมายเหตุ: ถ้ามีทั้ง name.py และ name.mpy บนบอร์ด MicroPython จะโหลด .py ก่อน จึงต้องลบ .py ออก
+import os
+import shutil
+import subprocess
+import sys
+
+# โมดูลที่ compile เป็น .mpy (ทุกไฟล์ที่ main.py ใช้ ยกเว้น boot.py/main.py)
+# bus_simulator / local_broker เป็นตัวจำลองสำหรับทดสอบบน PC ไม่ deploy ลงบอร์ด
+MODULES = (
+    "modbus_kernels_viper", "modbus_kernels", "kernel_check", "modbus_codec", "modbus_transport",
+    "register_image", "routing", "modbus_dispatch", "modbus_diagnostics", "modbus_lib", "rtu_bus",
+    "wifi_supervisor", "register_snapshot", "register_publisher", "register_history", "bridge_config",
+    "modbus_proxy", "bus_scanner", "register_prober",
+)
+SOURCE_FILES = ("boot.py", "main.py", "config.json")
+# โมดูลที่ ok/main.py ต้องใช้ (รวมที่ import ต่อกันเป็นทอดๆ และที่ import ตอนใช้งานครั้งแรก)
+OK_MODULES = (
+    "modbus_kernels_viper", "modbus_kernels", "modbus_codec", "modbus_transport", "register_image", "routing",
+    "modbus_dispatch", "modbus_diagnostics", "modbus_lib", "rtu_bus", "wifi_supervisor", "register_publisher",
+    "bridge_config", "modbus_proxy",
+)
+OK_SOURCE_FILES = ("ok/boot.py", "ok/main.py", "ok/config.json")
+ARCH = "rv32imc" # ESP32-C3 (RISC-V) จำเป็นสำหรับโค้ด @micropython.viper/native ใน modbus_kernels_viper
+
+def build(out_dir="build", mpy_cross="mpy-cross"):
+    os.makedirs(out_dir, exist_ok=True)
+    total_src = total_mpy = 0
+    for name in MODULES:
+        src = name + ".py"
+        dst = os.path.join(out_dir, name + ".mpy")
+        subprocess.run([mpy_cross, "-march=" + ARCH, "-o", dst, src], check=True)
+        src_size = os.path.getsize(src)
+        mpy_size = os.path.getsize(dst)
+        total_src += src_size
+        total_mpy += mpy_size
+        print(f"{name:20s} {src_size:7d} -> {mpy_size:6d} bytes")
+    for name in SOURCE_FILES:
+        shutil.copy(name, os.path.join(out_dir, name))
+    os.makedirs(os.path.join(out_dir, "ok"), exist_ok=True)
+    for name in OK_SOURCE_FILES:
+        shutil.copy(name, os.path.join(out_dir, name))
+    # manifest สำหรับ freeze โมดูลลง firmware (bytecode อยู่ใน flash ไม่ต้องโหลดลง RAM เลย)
+    with open(os.path.join(out_dir, "manifest.py"), "w") as f:
+        f.write('include("$(PORT_DIR)/boards/manifest.py")\n')
+        for name in MODULES:
+            f.write(f'module("{name}.py", base_path="{os.path.abspath(".")}")\n')
+    print(f"total {total_src} bytes of source -> {total_mpy} bytes of .mpy in {out_dir}/")
+
+def deploy(out_dir="build", mpremote="mpremote", modules=MODULES, source_files=SOURCE_FILES):
+    for name in modules:
+        # ลบ source เดิมบนบอร์ด (ไม่มีอยู่แล้วก็ไม่เป็นไร)
+        subprocess.run([mpremote, "fs", "rm", ":" + name + ".py"], stderr=subprocess.DEVNULL)
+    files = [os.path.join(out_dir, name + ".mpy") for name in modules]
+    files += [os.path.join(out_dir, name) for name in source_files] # ok/*.py ไปอยู่ที่ root ของบอร์ด
+    subprocess.run([mpremote, "fs", "cp"] + files + [":"], check=True)
+
+if __name__ == "__main__":
+    build()
+    if "--deploy" in sys.argv:
+        if "--ok" in sys.argv:
+            deploy(modules=OK_MODULES, source_files=OK_SOURCE_FILES)
+        else:
+            deploy()
@@ -0,0 +1,116 @@
+# bus_scanner.py
+# โหมดค้นหา slave บน RS-485 (commissioning): ไล่ baud rate และ Slave ID 1-247 ด้วย probe ขนาดเล็กที่สุด
+# (FC03 อ่าน register 0 จำนวน 1 ค่า) แล้วบันทึกผลลง config.json ไม่ต้องเดา baud rate/Slave ID แล้ว flash ใหม่
+#   - timeout ของแต่ละ probe คำนวณจาก RTUTiming ของ baud rate นั้น (frame 8 + 7 ไบต์ + t3.5 + turnaround สั้นๆ)
+#     สแกนครบ 247 ID ที่ 9600 baud ใช้ราว 14 วินาที (turnaround 30 ms), ที่ 115200 baud ราว 8 วินาที
+#   - slave ที่ตอบ Exception (เช่นไม่มี register 0) ก็ถือว่าพบ เพราะตอบด้วย Slave ID และ CRC ที่ถูกต้อง
+#   - ขยะจากการรับผิด baud rate ไม่ผ่าน CRC จึงไม่ถูกนับ และถูกล้างออกจาก UART ก่อน probe ถัดไป
+#   - ค่าเริ่มต้นหยุดที่ baud rate แรกที่พบ slave (all_baudrates=True = สแกนทุก baud rate)
+# ทดสอบได้โดยไม่ต้องมี slave จริงด้วย bus_simulator.SimulatedBus
+import json
+import time
+from rtu_bus import RTUTiming
+
+PROBE_PDU = b'\x03\x00\x00\x00\x01'  # FC03: start 0, quantity 1
+PROBE_RESPONSE_LEN = 7               # Slave ID + FC + Byte Count + 2 + CRC
+DEFAULT_BAUDRATES = (9600, 19200, 38400, 57600, 115200, 4800, 2400)
+
+class BusScanner:
+    def __init__(self, master, baudrates=DEFAULT_BAUDRATES, first=1, last=247, turnaround_ms=30,
+                 all_baudrates=False):
+        self.master = master
+        self.baudrates = baudrates
+        self.first = first
+        self.last = last
+        self.turnaround_ms = turnaround_ms
+        self.all_baudrates = all_baudrates
+        self.found = []       # (baud rate, Slave ID, exception code หรือ 0 ถ้าตอบปกติ)
+        self.probes = 0
+        self.done = False
+        self._baud_index = -1
+        self._slave = last + 1 # เริ่มจาก baud rate แรกใน poll() ครั้งแรก
+        self._found_here = 0   # จำนวน slave ที่พบที่ baud rate ปัจจุบัน
+        self._timing = None
+        self._timeout_ms = 0
+        self._idle_since = time.ticks_us()
+        self._start = time.ticks_ms()
+
+    def poll(self):
+        """ทำ probe 1 ขั้น (ไม่บล็อก) คืนค่า True เมื่อสแกนครบแล้ว"""
+        if self.done:
+            return True
+        master = self.master
+        if master.busy:
+            result = master.poll_response()
+            if result is None:
+                return False
+            if result is not False:
+                code = result[1] if result[0] & 0x80 else 0
+                self.found.append((master.baudrate, self._slave, code))
+                self._found_here += 1
+                print(f"bus_scanner: slave {self._slave} at {master.baudrate} baud"
+                      + (f" (exception {code})" if code else ""))
+            self._idle_since = time.ticks_us()
+            self._slave += 1
+            return False
+
+        if self._slave > self.last:
+            if (self._found_here and not self.all_baudrates) or self._baud_index + 1 >= len(self.baudrates):
+                self.done = True
+                print(f"bus_scanner: {len(self.found)} slave(s) found with {self.probes} probes "
+                      f"in {time.ticks_diff(time.ticks_ms(), self._start)} ms")
+                return True
+            self._baud_index += 1
+            baudrate = self.baudrates[self._baud_index]
+            master.set_baudrate(baudrate)
+            self._timing = RTUTiming(baudrate, turnaround_ms=self.turnaround_ms)
+            self._timeout_ms = self._timing.response_timeout_ms(len(PROBE_PDU) + 3, PROBE_RESPONSE_LEN)
+            self._slave = self.first
+            self._found_here = 0
+            self._idle_since = time.ticks_us()
+
+        # เว้นช่วงเงียบ t3.5 แล้วล้างไบต์ค้าง (ขยะจาก slave ที่ใช้ baud rate อื่น) ก่อนส่ง probe
+        if time.ticks_diff(time.ticks_us(), self._idle_since) < self._timing.t35_us:
+            return False
+        while master.uart.any():
+            master.uart.read()
+        master.begin_request(self._slave, PROBE_PDU, self._timeout_ms)
+        self.probes += 1
+        return False
+
+    def run(self):
+        """สแกนจนครบ (บล็อก) คืนค่าเหมือน result()"""
+        while not self.poll():
+            pass
+        return self.result()
+
+    def result(self):
+        """{"baudrate": baud rate ที่พบ slave มากที่สุด, "slaves": [Slave ID ...]} หรือ None ถ้าไม่พบเลย"""
+        if not self.found:
+            return None
+        counts = {}
+        for baudrate, slave, code in self.found:
+            counts[baudrate] = counts.get(baudrate, 0) + 1
+        best = max(counts, key=lambda b: counts[b])
+        return {"baudrate": best, "slaves": [slave for baudrate, slave, code in self.found if baudrate == best]}
+
+def save_result(result, path="config.json"):
+    """บันทึกผลสแกนลง config: ปิดการสแกนตอนบูต, เก็บ "result" และตั้ง baud rate ของ bus แรกตามที่พบ"""
+    try:
+        with open(path) as f:
+            cfg = json.load(f)
+    except (OSError, ValueError):
+        cfg = {}
+    scan = cfg.get("scan") or {}
+    scan["enabled"] = False
+    scan["result"] = result
+    cfg["scan"] = scan
+    if result:
+        if cfg.get("buses"):
+            cfg["buses"][0]["baudrate"] = result["baudrate"]
+        else:
+            bus = cfg.get("bus") or {}
+            bus["baudrate"] = result["baudrate"]
+            cfg["bus"] = bus
+    with open(path, "w") as f:
+        json.dump(cfg, f)
@@ -0,0 +1,101 @@
+# bus_simulator.py
+# RS-485 bus จำลองที่มี slave หลายตัว (แต่ละตัวมี Slave ID และ baud rate ของตัวเอง) ใช้แทน UART จริง
+# ทดสอบ bus_scanner / ModbusRTUMaster ได้โดยไม่ต้องต่อ slave: SimulatedBus(...).attach(master)
+#   - slave ตอบเฉพาะเมื่อ baud rate ของ bus ตรงกับของตัวเอง (ตอบ FC03 และ FC06, Function Code อื่นตอบ Exception 01)
+#   - register ที่ไม่อยู่ใน map (set_map) ตอบ Exception 02 ถ้าช่วงที่อ่าน/เขียนมีรูแม้แต่ตัวเดียว เหมือนมิเตอร์จริง
+#   - ถ้า baud rate ไม่ตรง slave ได้ยินแต่ขยะ: ไม่ตอบ แต่บนสายจะมีไบต์ขยะ (noise=True) เหมือนของจริง
+from modbus_transport import RTU_FRAMER
+
+class SimulatedBus:
+    def __init__(self, slaves, baudrate=9600, size=16, noise=True):
+        self.slaves = dict(slaves) # Slave ID -> baud rate
+        self.baudrate = baudrate
+        self.registers = {slave: [0] * size for slave in self.slaves}
+        self.mapped = {slave: bytearray([1]) * size for slave in self.slaves} # 1 = register มีอยู่จริง
+        self.noise = noise
+        self.timeout = 100
+        self.timeout_char = 10
+        self.rx = bytearray()
+        self.requests = 0
+
+    def attach(self, master):
+        """ใช้ bus นี้แทน UART ของ master"""
+        master.uart = self
+        master.set_baudrate(self.baudrate)
+        return self
+
+    def set_map(self, slave, ranges):
+        """กำหนดให้ slave มีเฉพาะ register ในช่วง (start, count) ที่ระบุ นอกนั้นเป็นรู (ค่า register = address)"""
+        size = max(start + count for start, count in ranges)
+        self.registers[slave] = list(range(size))
+        mapped = self.mapped[slave] = bytearray(size)
+        for start, count in ranges:
+            mapped[start:start + count] = bytearray([1]) * count
+
+    # --- interface แบบ machine.UART ที่ ModbusRTUMaster ใช้ ---
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate:
+            self.baudrate = baudrate
+
+    def write(self, frame):
+        self.requests += 1
+        self.rx += self._respond(bytes(frame))
+        return len(frame)
+
+    def flush(self):
+        pass
+
+    def any(self):
+        return len(self.rx)
+
+    def read(self, n=None):
+        if not self.rx:
+            return None
+        n = len(self.rx) if n is None else min(n, len(self.rx))
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def readinto(self, buf, n=None):
+        if not self.rx:
+            return None
+        n = min(len(buf) if n is None else n, len(self.rx))
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    # --- slave ---
+
+    def _respond(self, frame):
+        unit = frame[0]
+        if unit not in self.slaves:
+            return b''
+        if self.slaves[unit] != self.baudrate:
+            return b'\xff\x00\xfe' if self.noise else b'' # framing error ที่ baud rate ผิด
+        decoded = RTU_FRAMER.decode(frame)
+        if decoded is None:
+            return b''
+        pdu = decoded[2]
+        regs = self.registers[unit]
+        mapped = self.mapped[unit]
+        fc = pdu[0]
+        if fc == 0x03 and len(pdu) == 5:
+            start = (pdu[1] << 8) | pdu[2]
+            quantity = (pdu[3] << 8) | pdu[4]
+            if start + quantity > len(regs) or b'\x00' in mapped[start:start + quantity]:
+                body = bytes([0x83, 0x02])
+            else:
+                body = bytearray([0x03, quantity * 2])
+                for v in regs[start:start + quantity]:
+                    body += bytes([v >> 8, v & 0xFF])
+        elif fc == 0x06 and len(pdu) == 5:
+            address = (pdu[1] << 8) | pdu[2]
+            if address >= len(regs) or not mapped[address]:
+                body = bytes([0x86, 0x02])
+            else:
+                regs[address] = (pdu[3] << 8) | pdu[4]
+                body = bytes(pdu)
+        else:
+            body = bytes([fc | 0x80, 0x01])
+        return bytes(RTU_FRAMER.encode(None, unit, body))
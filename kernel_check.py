@@ -0,0 +1,90 @@
+# kernel_check.py
+# ตรวจว่า kernel ใน modbus_kernels (viper/native บน MicroPython) ให้ผลตรงกับต้นแบบ pure-Python
+# และวัดเวลาต่อการเรียกของแต่ละ kernel บนข้อมูลขนาดเท่าของจริง
+# แยกจาก modbus_kernels เพื่อไม่ให้ bytecode ส่วนนี้อยู่ใน RAM: main.py import ตอนบูตเฉพาะเมื่อเปิด "kernel_check"
+# ใน config.json แล้ว unload ทิ้ง
+# ใช้บน PC: python kernel_check.py   บนบอร์ด: mpremote run kernel_check.py
+import time
+from array import array
+from modbus_kernels import (HAVE_NATIVE, crc16, mbap_header, store_be, load_be, pack_bits,
+                            crc16_py, mbap_header_py, store_be_py, load_be_py, pack_bits_py)
+
+if hasattr(time, "ticks_us"):
+    def _elapsed_us(start):
+        return time.ticks_diff(time.ticks_us(), start)
+    _now_us = time.ticks_us
+else: # CPython
+    def _now_us():
+        return int(time.perf_counter() * 1000000)
+    def _elapsed_us(start):
+        return _now_us() - start
+
+# kernel ที่ใช้จริง คู่กับต้นแบบ pure-Python (ใช้ใน self_check และ benchmark)
+KERNELS = (
+    ("crc16", crc16, crc16_py),
+    ("mbap_header", mbap_header, mbap_header_py),
+    ("store_be", store_be, store_be_py),
+    ("load_be", load_be, load_be_py),
+    ("pack_bits", pack_bits, pack_bits_py),
+)
+
+# --- Conformance check และ microbenchmark ---
+
+def _sample_inputs():
+    """ข้อมูลขนาดเท่าของจริงบนบอร์ด: FC03 Response 100 register (205 ไบต์), MBAP request, coils 2000 bit"""
+    regs = array('H', [(i * 2654435761) & 0xFFFF for i in range(125)])
+    payload = bytearray(250)
+    store_be_py(regs, 0, 125, payload, 0)
+    frame = bytearray([1, 3, 200]) + payload[:200]
+    adu = bytearray([0x12, 0x34, 0, 0, 0, 6, 1, 3, 0, 0, 0, 100])
+    bits = bytearray([(i * 7 >> 2) & 1 for i in range(2000)])
+    return regs, payload, frame, adu, bits
+
+def _calls(regs, payload, frame, adu, bits):
+    """{ชื่อ kernel: (args, ฟังก์ชันดึงผลลัพธ์มาเทียบ)} โดย buffer ขาออกสร้างใหม่ทุกครั้งที่เรียก"""
+    out = bytearray(256)
+    dest = array('H', [0] * 125)
+    return {
+        "crc16": ((frame,), lambda r: r),
+        "mbap_header": ((adu,), lambda r: r),
+        "store_be": ((regs, 25, 100, out, 2), lambda r: (r, bytes(out))),
+        "load_be": ((payload, 0, 125, dest, 0), lambda r: (r, list(dest))),
+        "pack_bits": ((bits, 0, 1968, out, 0), lambda r: (r, bytes(out))),
+    }
+
+def self_check():
+    """เทียบผลของ kernel ที่ใช้จริงกับต้นแบบ pure-Python คืนค่า list ของชื่อ kernel ที่ผลไม่ตรงกัน (ว่าง = ผ่าน)"""
+    inputs = _sample_inputs()
+    failed = []
+    for name, fast, ref in KERNELS:
+        args, result_of = _calls(*inputs)[name]
+        expected = result_of(ref(*args))
+        args, result_of = _calls(*inputs)[name]
+        if result_of(fast(*args)) != expected:
+            failed.append(name)
+    # ค่าอ้างอิงที่รู้ผลแน่นอน: CRC ของ request "01 03 00 00 00 0A" คือ 0xCDC5
+    if crc16(b'\x01\x03\x00\x00\x00\x0a') != 0xCDC5:
+        failed.append("crc16 reference")
+    return failed
+
+def benchmark(iterations=200):
+    """วัดเวลาเฉลี่ย (us) ต่อการเรียกของแต่ละ kernel เทียบกับ pure-Python พิมพ์ผลและคืนค่า {ชื่อ: (native us, python us)}"""
+    inputs = _sample_inputs()
+    results = {}
+    for name, fast, ref in KERNELS:
+        args, _ = _calls(*inputs)[name]
+        times = []
+        for fn in (fast, ref):
+            start = _now_us()
+            for _ in range(iterations):
+                fn(*args)
+            times.append(_elapsed_us(start) / iterations)
+        results[name] = (times[0], times[1])
+        speedup = times[1] / times[0] if times[0] else 0
+        print(f"kernel_check: {name:12s} {times[0]:9.1f} us  (python {times[1]:9.1f} us, x{speedup:.1f})")
+    return results
+
+if __name__ == "__main__":
+    print("native kernels:", HAVE_NATIVE)
+    print("self_check:", self_check() or "ok")
+    benchmark()
@@ -0,0 +1,94 @@
+# local_broker.py
+# ตัวรับข้อความแทน broker/collector จริง สำหรับทดสอบ register_publisher บน PC (CPython)
+# รับได้ทั้ง UDP datagram และ MQTT 3.1.1 แบบพื้นฐาน (CONNECT, PUBLISH QoS 0, PINGREQ, DISCONNECT)
+# แล้วพิมพ์ค่าที่ถอดรหัสได้ออกทางหน้าจอ
+#
+# ใช้งาน: python local_broker.py [udp_port] [mqtt_port]   (ค่าเริ่มต้น 5020 และ 1883)
+# แล้วตั้ง "publish" ใน config.json ของบอร์ดให้ชี้มาที่ IP ของเครื่องนี้
+import json
+import select
+import socket
+import sys
+from register_publisher import decode_binary
+
+def show(topic, payload):
+    try:
+        if payload[:1] == b'{':
+            msg = json.loads(payload)
+            block, seq, values = msg["block"], msg["seq"], msg["values"]
+        else:
+            block, seq, values = decode_binary(payload)
+        print(f"{topic}: block {block} seq {seq} {len(values)} value(s) {values}")
+    except (ValueError, KeyError) as e:
+        print(f"{topic}: undecodable payload {payload.hex()} ({e})")
+
+def read_packet(conn):
+    """อ่าน MQTT control packet 1 ชุด คืนค่า (packet type, body) หรือ None ถ้าปิดการเชื่อมต่อ"""
+    header = conn.recv(1)
+    if not header:
+        return None
+    length = 0
+    shift = 0
+    while True:
+        b = conn.recv(1)
+        if not b:
+            return None
+        length |= (b[0] & 0x7F) << shift
+        shift += 7
+        if not b[0] & 0x80:
+            break
+    body = b''
+    while len(body) < length:
+        chunk = conn.recv(length - len(body))
+        if not chunk:
+            return None
+        body += chunk
+    return header[0], body
+
+def handle_mqtt(conn):
+    packet = read_packet(conn)
+    if packet is None:
+        return False
+    kind, body = packet
+    ptype = kind >> 4
+    if ptype == 1:   # CONNECT -> CONNACK (accepted)
+        conn.sendall(b'\x20\x02\x00\x00')
+    elif ptype == 3: # PUBLISH (QoS 0 ไม่มี packet id)
+        n = (body[0] << 8) | body[1]
+        show(body[2:2 + n].decode(), body[2 + n:])
+    elif ptype == 12: # PINGREQ -> PINGRESP
+        conn.sendall(b'\xd0\x00')
+    elif ptype == 14: # DISCONNECT
+        return False
+    return True
+
+def main():
+    udp_port = int(sys.argv[1]) if len(sys.argv) > 1 else 5020
+    mqtt_port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(("0.0.0.0", udp_port))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("0.0.0.0", mqtt_port))
+    listener.listen(4)
+    print(f"local_broker: UDP on {udp_port}, MQTT on {mqtt_port}")
+
+    clients = []
+    while True:
+        ready, _, _ = select.select([udp, listener] + clients, [], [])
+        for s in ready:
+            if s is udp:
+                data, addr = udp.recvfrom(2048)
+                n = data[0]
+                show(data[1:1 + n].decode(), data[1 + n:])
+            elif s is listener:
+                conn, addr = listener.accept()
+                print(f"local_broker: MQTT client {addr}")
+                clients.append(conn)
+            elif not handle_mqtt(s):
+                clients.remove(s)
+                s.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,260 @@
 # main.py
 import machine
+import sys
 import time
-import network
 import gc
 # นำเข้าคลาส Modbus ที่เราสร้างไว้ในไฟล์ modbus_lib.py
-from modbus_lib import ModbusRTUMaster, ModbusTCPServer 
+from modbus_lib import ModbusRTUMaster, ModbusRequestHandler, ModbusTCPServer, ModbusUDPServer
+from modbus_transport import RTU_FRAMER
+from rtu_bus import RTUBus, RTUTiming
+from wifi_supervisor import WiFiSupervisor
+from register_snapshot import RegisterSnapshot
+from register_image import QUALITY_GOOD
+# ส่วนที่ใช้ไม่บ่อย (config compiler, kernel self-check, publisher, history, FC diagnostics)
+# import เมื่อต้องใช้เท่านั้น เพื่อลดเวลาบูตและ RAM ที่ bytecode ใช้
 
-# --- WiFi Configuration (จำเป็นต้องมีใน main.py ด้วย เผื่อกรณี main.py รันเดี่ยวๆ หรือรีเซ็ต) ---
-WIFI_SSID = "wifi-ice"
-WIFI_PASSWORD = "" # <<<<< ยืนยันว่าไม่มีรหัสผ่านสำหรับ wifi-ice
+def unload(name):
+    """เอาโมดูลที่ใช้เสร็จแล้วออกจาก sys.modules เพื่อให้ gc คืน RAM ของ bytecode"""
+    sys.modules.pop(name, None)
+    gc.collect()
 
-# --- Modbus RTU Configuration ---
-UART_ID = 1          # ใช้ UART 1 สำหรับ Modbus RTU (GPIO4/5)
-UART_TX_PIN = 5      # GPIO5 สำหรับ UART1 TX
-UART_RX_PIN = 4      # GPIO4 สำหรับ UART1 RX
-MAX485_DE_RE_PIN = 2 # GPIO2 สำหรับขา DE/RE ของ MAX485
-MODBUS_RTU_BAUDRATE = 9600 # <<<<< แก้ไขตาม Baud rate ของอุปกรณ์ Modbus RTU ของคุณ
-MODBUS_SLAVE_ID = 1      # <<<<< แก้ไขตาม Slave ID ของอุปกรณ์ Modbus RTU ของคุณ
+# --- Configuration ---
+# ค่าตั้งทั้งหมด (Wi-Fi, ขา UART, Baud rate, Slave ID, poll blocks, TCP mapping) อยู่ใน config.json
+# ดูค่าเริ่มต้นได้ใน bridge_config.DEFAULT_CONFIG
+from bridge_config import compile_config
+config = compile_config()
+del compile_config
+unload("bridge_config")
 
 # พื้นที่เก็บข้อมูลส่วนกลางสำหรับ Holding Registers (เพื่อเชื่อมข้อมูลจาก RTU ไป TCP)
-holding_registers = [0] * 100 
-
-def connect_wifi_for_main():
-    """เชื่อมต่อ Wi-Fi หรือยืนยันสถานะการเชื่อมต่อ และคืนค่า IP Address"""
-    nic = network.WLAN(network.STA_IF)
-    if not nic.isconnected(): # หาก Wi-Fi ไม่ได้เชื่อมต่อ (เช่น หลังจาก Soft Reboot)
-        print("main.py: WiFi was not connected, attempting to reconnect...")
-        nic.active(True)
-        # ไม่มี nic.config(txpower=...) ที่นี่เช่นกัน
-        nic.connect(WIFI_SSID, WIFI_PASSWORD)
-        max_wait = 20
-        while max_wait > 0:
-            if nic.isconnected():
-                break
-            max_wait -= 1
-            print(".", end="")
-            time.sleep(1)
-        if not nic.isconnected():
-            status = nic.status()
-            raise RuntimeError(f"main.py: WiFi connection failed: Status {status}")
-    
-    ip_info = nic.ifconfig()
-    print("main.py: WiFi IP:", ip_info[0])
-    return ip_info[0]
+register_image = config.image
+holding_registers = register_image.registers
+
+def ms_since_reset():
+    """เวลาตั้งแต่รีเซ็ต (ms) - ticks_ms บน ESP32 เริ่มนับจาก 0 ตอนบูต"""
+    return time.ticks_diff(time.ticks_ms(), 0)
 
 def main():
     global holding_registers
 
-    # 1. เชื่อมต่อ Wi-Fi (หรือยืนยันการเชื่อมต่อจาก boot.py)
+    # ตรวจว่า kernel แบบ viper/native ให้ผลตรงกับต้นแบบ pure-Python เฉพาะเมื่อเปิด "kernel_check" ใน config
+    # (ไม่อยู่ในเส้นทางบูตปกติ: ตรวจ/วัดความเร็วด้วย mpremote run kernel_check.py)
+    if config.kernel_check:
+        import kernel_check
+        failed = kernel_check.self_check()
+        if failed:
+            print(f"main.py: WARNING: native kernels do not match the Python reference: {failed}")
+        else:
+            print(f"main.py: Kernels ok ({'native' if kernel_check.HAVE_NATIVE else 'pure Python'}).")
+        del kernel_check
+        unload("kernel_check")
+
+    # 0. โหลด snapshot จาก flash ก่อน เพื่อให้ TCP มีค่าเดิมให้บริการทันที (ถือว่า stale จนกว่าจะ poll สำเร็จ)
+    snapshot = RegisterSnapshot(config.snapshot_path, config.snapshot_min_interval_ms)
     try:
-        esp_ip = connect_wifi_for_main()
-        if esp_ip is None:
-            print("main.py: Failed to get IP, exiting main loop.")
-            return
+        restored = snapshot.load(register_image)
+        print(f"main.py: Restored {restored} register block(s) from snapshot (stale until first live poll).")
     except Exception as e:
-        print(f"main.py: Failed to connect to WiFi in main: {e}")
-        return
+        print(f"main.py: Failed to load register snapshot: {e}")
 
-    # 2. เริ่มต้น Modbus RTU Master
+    # Threaded mode: RTU worker เขียนลง back buffer แล้วสลับ reference ฝั่ง TCP อ่านค่าที่ publish แล้วเสมอ
+    if config.rtu_thread:
+        import _thread
+        register_image.enable_double_buffer(_thread.allocate_lock())
+
+    # ประวัติย้อนหลัง: เก็บทุก sample ที่ poll ได้ เพื่อให้ client ดึงช่วงที่ Wi-Fi หลุดกลับไปได้
+    history = None
+    if config.history_pages:
+        from register_history import RegisterHistory
+        history = RegisterHistory(register_image, config.history_pages, config.history_page_size,
+                                  config.history_interval_ms, config.history_spill_path, config.history_spill_pages)
+        history.offline = True # ยังไม่ได้ต่อ Wi-Fi
+
+    led = None
     try:
-        rtu_master = ModbusRTUMaster(UART_ID, UART_TX_PIN, UART_RX_PIN, MAX485_DE_RE_PIN, MODBUS_RTU_BAUDRATE, MODBUS_SLAVE_ID)
-        print("main.py: Modbus RTU Master initialized.")
+        led = machine.Pin(config.led_pin, machine.Pin.OUT)
+    except Exception:
+        led = None
+
+    # Modbus TCP Server จะถูกสร้าง/ย้ายไป IP ใหม่ ผ่าน callback ของ WiFiSupervisor
+    # ทุก transport (MBAP/TCP, RTU-over-TCP, MBAP/UDP) ใช้ handler เดียวกัน = register image เดียวกัน
+    handler = ModbusRequestHandler(holding_registers, register_image, config.routing)
+    tcp_server = None
+    servers = []
+    publisher = None
+
+    def on_ip_change(ip):
+        nonlocal tcp_server, publisher
+        print(f"main.py: WiFi IP: {ip} after {ms_since_reset()} ms")
+        if led:
+            led.value(1) # เปิด LED ค้างไว้ เพื่อบ่งบอกว่า WiFi เชื่อมต่อสำเร็จ
+        if history:
+            history.offline = False
+        if tcp_server is None:
+            tcp_server = ModbusTCPServer(ip, config.tcp_port, holding_registers, handler=handler,
+                                         max_sessions=config.tcp_max_sessions, coalesce=config.tcp_coalesce)
+            servers.append(tcp_server)
+            if config.rtu_over_tcp_port:
+                servers.append(ModbusTCPServer(ip, config.rtu_over_tcp_port, holding_registers,
+                                               framer=RTU_FRAMER, handler=handler,
+                                               max_sessions=config.tcp_max_sessions, coalesce=config.tcp_coalesce))
+            if config.udp_port:
+                servers.append(ModbusUDPServer(ip, config.udp_port, handler))
+            if history and config.history_port:
+                from register_history import HistoryServer
+                servers.append(HistoryServer(ip, config.history_port, history))
+            print(f"main.py: {len(servers)} Modbus server(s) initialized.")
+            # Push publisher ทำงานคู่กับ Modbus TCP server (ไม่ได้แทนที่)
+            if config.publish_mode:
+                try:
+                    from register_publisher import RegisterPublisher, UDPTransport, MQTTTransport
+                    if config.publish_mode == "mqtt":
+                        transport = MQTTTransport(config.publish_host, config.publish_port, config.publish_client_id)
+                    else:
+                        transport = UDPTransport(config.publish_host, config.publish_port)
+                    publisher = RegisterPublisher(register_image, transport, config.publish_format,
+                                                  config.publish_topic, config.publish_min_interval_ms)
+                    print(f"main.py: Publishing changes via {config.publish_mode} to {config.publish_host}:{config.publish_port}")
+                except OSError as e:
+                    print(f"main.py: Failed to start publisher: {e}")
+        else:
+            for server in servers:
+                server.rebind(ip) # สร้าง listening socket ใหม่บน IP ใหม่
+
+    def on_disconnect():
+        if led:
+            led.value(0)
+        if history:
+            history.offline = True # page ที่เต็มระหว่างนี้จะถูกเขียนลง flash ด้วย (ถ้าตั้ง spill_path)
+        print(f"main.py: WiFi lost, RTU polling continues. Stats: {wifi.stats()}")
+
+    # 1. เริ่ม Wi-Fi เบื้องหลัง (ไม่รอ) - ระหว่างนี้ฝั่ง RTU ทำงานไปก่อนได้เลย
+    try:
+        wifi = WiFiSupervisor(config.wifi_ssid, config.wifi_password, on_ip_change=on_ip_change, on_disconnect=on_disconnect)
     except Exception as e:
-        print(f"main.py: Failed to initialize Modbus RTU Master: {e}")
+        print(f"main.py: Failed to start WiFi: {e}")
         return
 
-    # 3. เริ่มต้น Modbus TCP Server
+    # 2. เริ่มต้น Modbus RTU Master 1 ตัวต่อ RS-485 bus (UART, ขา DE/RE และ baud rate ของแต่ละ bus)
+    buses = []
     try:
-        tcp_server = ModbusTCPServer(esp_ip, 502, holding_registers) 
-        print("main.py: Modbus TCP Server initialized.")
+        for index, bus in enumerate(config.buses):
+            rtu_master = ModbusRTUMaster(bus["uart_id"], bus["tx_pin"], bus["rx_pin"], bus["de_re_pin"],
+                                         bus["baudrate"], 1, echo=bus["echo"])
+            timing = RTUTiming(bus["baudrate"], turnaround_ms=bus["turnaround_ms"])
+            buses.append(RTUBus(index, rtu_master, register_image, timing, bus["max_utilisation"], history))
+        print(f"main.py: {len(buses)} Modbus RTU Master(s) initialized.")
     except Exception as e:
-        print(f"main.py: Failed to initialize Modbus TCP Server: {e}")
+        print(f"main.py: Failed to initialize Modbus RTU Master: {e}")
         return
 
-    last_rtu_read_time = time.ticks_ms()
-    rtu_read_interval = 1000 # อ่าน Modbus RTU ทุก 1 วินาที (สามารถปรับได้)
+    # โหมด commissioning: สแกนหา baud rate/Slave ID บน bus แรก บันทึกลง config.json แล้วรีบูตด้วยค่าใหม่
+    if config.scan_enabled:
+        from bus_scanner import BusScanner, save_result
+        scanner = BusScanner(buses[0].master, config.scan_baudrates, config.scan_first, config.scan_last,
+                             config.scan_turnaround_ms, config.scan_all_baudrates)
+        result = scanner.run()
+        save_result(result)
+        print(f"main.py: Bus scan result {result} saved to config.json.")
+        if result:
+            machine.reset()
+        buses[0].master.set_baudrate(config.buses[0]["baudrate"])
+        del scanner
+        unload("bus_scanner")
+
+    # หาช่วง register ที่อ่านได้ของแต่ละ slave แล้วเขียนตาราง poll ใหม่ (ไม่ข้ามรู) ลง config.json แล้วรีบูต
+    if config.probe_enabled:
+        from register_prober import RegisterProber, poll_table, save_poll_table
+        prober = RegisterProber(buses[0].master, buses[0].timing)
+        blocks = []
+        for slave in config.probe_slaves:
+            ranges = prober.readable_ranges(slave, config.probe_start, config.probe_end)
+            print(f"main.py: slave {slave} readable ranges {ranges}")
+            blocks += poll_table(slave, ranges, config.probe_interval_ms)
+        print(f"main.py: {len(blocks)} poll block(s) from {prober.probes} probes.")
+        if blocks:
+            save_poll_table(blocks)
+            machine.reset()
+        del prober
+        unload("register_prober")
+
+    num_blocks = register_image.num_blocks()
+    for block in range(num_blocks):
+        buses[config.block_bus[block]].add_block(block, config.poll_interval_ms[block], config.block_priority[block])
+    for bus in buses:
+        planned = bus.planned_utilisation()
+        if planned > bus.max_utilisation:
+            print(f"main.py: bus {bus.name} is planned at {planned}% utilisation "
+                  f"(ceiling {bus.max_utilisation}%), low-priority blocks will be slowed down.")
+
+    # 3. อ่าน RTU รอบแรกทุก block ทันที (ทุก bus ไปพร้อมกัน) เพื่อเติมข้อมูลใน register image ก่อน Wi-Fi จะพร้อม
+    while not all(bus.first_round_done for bus in buses):
+        for bus in buses:
+            bus.poll()
+    first_poll_ok = sum(1 for block in range(num_blocks) if register_image.quality[block] == QUALITY_GOOD)
+    print(f"main.py: Time to first RTU poll: {ms_since_reset()} ms ({first_poll_ok}/{num_blocks} blocks ok)")
+
+    first_response_logged = False
+    last_age_update = time.ticks_ms()
+    last_bus_report = last_age_update
+
+    def rtu_worker():
+        """poll ทุก bus + อายุข้อมูล + snapshot ใน thread ของตัวเอง (thread เดียวที่เขียน register image)"""
+        last_update = time.ticks_ms()
+        while True:
+            for bus in buses:
+                bus.poll()
+            now = time.ticks_ms()
+            if time.ticks_diff(now, last_update) >= 1000:
+                last_update = now
+                register_image.update_age_registers()
+                snapshot.maybe_save(register_image)
+            time.sleep_ms(1)
+
+    if config.rtu_thread:
+        _thread.stack_size(config.rtu_thread_stack_size)
+        _thread.start_new_thread(rtu_worker, ())
+        print("main.py: RTU worker thread started (double-buffered register image).")
 
     print("main.py: Starting main loop...")
     while True:
         gc.collect()
-        
-        tcp_server.poll_for_clients()
+
+        wifi.poll() # ไม่บล็อก: reconnect แบบ exponential back-off อยู่ในนี้
+
+        if tcp_server and wifi.isconnected():
+            for server in servers:
+                server.poll_for_clients()
+            if not first_response_logged and tcp_server.first_response_ticks is not None:
+                first_response_logged = True
+                print(f"main.py: Time to first TCP response: {time.ticks_diff(tcp_server.first_response_ticks, 0)} ms")
+            if publisher:
+                publisher.poll()
+
+        # แต่ละ bus มีตาราง poll ของตัวเอง และทำ transaction ได้ครั้งละ 1 รายการ (ไม่บล็อก)
+        # threaded mode: rtu_worker ทำส่วนนี้แทน
+        if not config.rtu_thread:
+            for bus in buses:
+                bus.poll()
 
         current_time = time.ticks_ms()
-        if time.ticks_diff(current_time, last_rtu_read_time) >= rtu_read_interval:
-            last_rtu_read_time = current_time
-
-            try:
-                rtu_data = rtu_master.read_holding_registers(0, 100)
-                
-                if rtu_data:
-                    for i in range(len(rtu_data)):
-                        if i < len(holding_registers):
-                            holding_registers[i] = rtu_data[i]
-                else:
-                    print("main.py: Modbus RTU read returned no data or failed.")
-            except Exception as e:
-                print(f"main.py: Error reading Modbus RTU: {e}")
+        if not config.rtu_thread and time.ticks_diff(current_time, last_age_update) >= 1000:
+            last_age_update = current_time
+            register_image.update_age_registers()
+            snapshot.maybe_save(register_image)
+
+        # รายงานอัตรา poll ที่ทำได้จริงเทียบกับที่ตั้งไว้ ทุก 60 วินาที
+        if time.ticks_diff(current_time, last_bus_report) >= 60000:
+            last_bus_report = current_time
+            if tcp_server:
+                print(f"main.py: tcp {tcp_server.stats()}")
+            for bus in buses:
+                print(f"main.py: bus {bus.stats()}")
+                for block, interval, effective, achieved, cost in bus.block_report():
+                    print(f"main.py:   block {block}: configured {interval} ms, effective {effective} ms, "
+                          f"achieved {achieved} ms, wire time {cost // 1000} ms")
 
         time.sleep_ms(10)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
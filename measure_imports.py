@@ -0,0 +1,71 @@
+# measure_imports.py
+# วัดเวลา import และ RAM (gc.mem_free() ที่ลดลง) ของแต่ละโมดูล
+# รันบนบอร์ดจาก PC: mpremote run measure_imports.py
+# เทียบก่อน/หลัง: รันครั้งแรกตอนบนบอร์ดเป็น .py แล้วรันอีกครั้งหลัง python build_mpy.py --deploy
+# (คอลัมน์ "from" บอกว่าโหลดจาก .py, .mpy หรือ frozen)
+# บน CPython ใช้ได้เช่นกัน (ใช้ tracemalloc แทน gc.mem_free) แต่ตัวเลขเทียบกับบอร์ดไม่ได้
+import gc
+import sys
+import time
+
+# เรียงจากโมดูลที่ไม่พึ่งโมดูลอื่นก่อน เพื่อให้ตัวเลขของแต่ละแถวเป็นของโมดูลนั้นเอง
+MODULES = (
+    "modbus_kernels_viper", "modbus_kernels", "modbus_codec", "modbus_transport", "register_image", "routing",
+    "modbus_dispatch", "modbus_lib", "rtu_bus", "wifi_supervisor", "register_snapshot",
+    "bridge_config", "modbus_diagnostics", "kernel_check", "register_publisher", "register_history",
+    "modbus_proxy", "bus_scanner", "register_prober",
+)
+
+if hasattr(gc, "mem_free"):
+    def mem_used():
+        return -gc.mem_free()
+    def now_us():
+        return time.ticks_us()
+    def elapsed_us(start):
+        return time.ticks_diff(time.ticks_us(), start)
+else: # CPython
+    import tracemalloc
+    tracemalloc.start()
+    def mem_used():
+        return tracemalloc.get_traced_memory()[0]
+    def now_us():
+        return int(time.perf_counter() * 1000000)
+    def elapsed_us(start):
+        return now_us() - start
+
+def origin(module):
+    path = getattr(module, "__file__", None)
+    if not path:
+        return "frozen"
+    return ".mpy" if path.endswith(".mpy") else ".py"
+
+def measure(modules=MODULES):
+    """import ทีละโมดูล คืนค่า list ของ (ชื่อ, ที่มา, เวลา us, RAM ไบต์)"""
+    results = []
+    for name in modules:
+        if name in sys.modules:
+            continue # ถูก import ไปแล้วโดยโมดูลก่อนหน้า
+        gc.collect()
+        before = mem_used()
+        start = now_us()
+        try:
+            module = __import__(name)
+        except ImportError as e:
+            print(f"{name}: import failed: {e}")
+            continue
+        took = elapsed_us(start)
+        gc.collect()
+        results.append((name, origin(module), took, mem_used() - before))
+    return results
+
+def report(results):
+    print(f"{'module':20s} {'from':6s} {'import us':>10s} {'RAM bytes':>10s}")
+    total_us = total_ram = 0
+    for name, source, took, ram in results:
+        total_us += took
+        total_ram += ram
+        print(f"{name:20s} {source:6s} {took:10d} {ram:10d}")
+    print(f"{'total':27s} {total_us:10d} {total_ram:10d}")
+
+if __name__ == "__main__":
+    report(measure())
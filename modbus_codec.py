@@ -0,0 +1,96 @@
+# modbus_codec.py
+# แปลงค่า register แบบทั้งก้อน (bulk) ระหว่าง payload big-endian ของ Modbus กับค่าใน register image
+# ใช้ struct.unpack_from/pack_into ครั้งเดียวต่อก้อน ด้วย format string ที่ cache ไว้ต่อจำนวน register
+# แทนการ slice + unpack ทีละ register (ซึ่งสร้าง object ใหม่ทุกตัว)
+# decode_into ใช้กับ Response ของ RTU: decode payload ลง register image ตรงตำแหน่งของ block (rtu_bus)
+#
+# Typed view: แปลงทั้ง block เป็น int32 / float32 (เลือก word order ได้) หรือ fixed-point ที่ scale แล้ว
+#   word_swap=False : register แรกเป็น word สูง (ABCD, ค่ามาตรฐานของ Modbus)
+#   word_swap=True  : register แรกเป็น word ต่ำ (CDAB, พบบ่อยในมิเตอร์ไฟฟ้า)
+# routing ใช้ to_float32/from_int32 กับ view "float" (float32 จาก RTU -> int32 ที่ scale แล้วฝั่ง TCP)
+import struct
+import sys
+from array import array
+from modbus_kernels import HAVE_NATIVE, store_be, load_be
+
+_formats = {}
+
+def register_format(quantity, code='H', order='>'):
+    """format string ของ quantity ค่า เช่น '>10H' (cache ไว้ ไม่สร้าง string ใหม่ทุกครั้ง)"""
+    key = (quantity, code, order)
+    fmt = _formats.get(key)
+    if fmt is None:
+        fmt = _formats[key] = '%s%d%s' % (order, quantity, code)
+    return fmt
+
+# CPython (ใช้ทดสอบบน PC) มี array.byteswap() แปลง big-endian ทั้งก้อนได้เร็วกว่า unpack
+# MicroPython ใช้ kernel viper ใน modbus_kernels (หรือ unpack_from แล้ว slice assign ถ้าไม่มี viper)
+_HOST_BYTESWAP = hasattr(array('H'), 'byteswap')
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def decode_registers(buf, offset, quantity):
+    """แปลง payload big-endian (2 ไบต์ต่อ register) เป็น tuple ของค่า 16-bit ในการเรียกครั้งเดียว"""
+    return struct.unpack_from(register_format(quantity), buf, offset)
+
+def decode_into(buf, offset, quantity, dest, dest_offset=0):
+    """แปลง payload big-endian แล้วคัดลอกลง array('H') dest (เช่น register image) ตรงตำแหน่ง dest_offset"""
+    if HAVE_NATIVE:
+        return load_be(buf, offset, quantity, dest, dest_offset) # viper: คัดลอกตรงไม่สร้าง object กลาง
+    if _HOST_BYTESWAP:
+        values = array('H', bytes(memoryview(buf)[offset:offset + quantity * 2]))
+        if _LITTLE_ENDIAN:
+            values.byteswap()
+    else:
+        values = array('H', struct.unpack_from(register_format(quantity), buf, offset))
+    dest[dest_offset:dest_offset + quantity] = values
+    return quantity
+
+def encode_registers(values, start, quantity, buf, offset):
+    """เขียนค่า values[start:start + quantity] ลง buf เป็น big-endian ในการเรียกครั้งเดียว คืนค่าจำนวนไบต์"""
+    if HAVE_NATIVE and isinstance(values, array):
+        return store_be(values, start, quantity, buf, offset)
+    if start or quantity != len(values):
+        values = values[start:start + quantity]
+    struct.pack_into(register_format(quantity), buf, offset, *values)
+    return quantity * 2
+
+def to_bytes(values, start, quantity, order='>'):
+    """ค่า register เป็น bytes (ใช้ต่อกับ typed view)"""
+    buf = bytearray(quantity * 2)
+    struct.pack_into(register_format(quantity, 'H', order), buf, 0, *values[start:start + quantity])
+    return buf
+
+# --- Typed views (ทั้ง block ในการเรียกครั้งเดียว) ---
+
+def to_int32(registers, start, count, word_swap=False, signed=True):
+    """อ่าน count ค่า 32-bit จาก register คู่ที่ start คืนค่าเป็น tuple"""
+    order = '<' if word_swap else '>'
+    buf = to_bytes(registers, start, count * 2, order)
+    return struct.unpack_from(register_format(count, 'i' if signed else 'I', order), buf, 0)
+
+def to_float32(registers, start, count, word_swap=False):
+    """อ่าน count ค่า float32 (IEEE 754) จาก register คู่ที่ start คืนค่าเป็น tuple"""
+    order = '<' if word_swap else '>'
+    buf = to_bytes(registers, start, count * 2, order)
+    return struct.unpack_from(register_format(count, 'f', order), buf, 0)
+
+def to_scaled(registers, start, count, scale, signed=False):
+    """อ่าน count ค่า fixed-point 16-bit แล้วคูณ scale (เช่น 0.1 สำหรับค่าที่เก็บเป็น x10) คืนค่าเป็น list"""
+    values = registers[start:start + count]
+    if signed:
+        values = struct.unpack_from(register_format(count, 'h'), to_bytes(values, 0, count), 0)
+    return [v * scale for v in values]
+
+def from_int32(values, word_swap=False, signed=True):
+    """แปลงค่า 32-bit เป็น tuple ของ register (2 ค่าต่อ 1 ค่า)"""
+    order = '<' if word_swap else '>'
+    buf = bytearray(len(values) * 4)
+    struct.pack_into(register_format(len(values), 'i' if signed else 'I', order), buf, 0, *values)
+    return struct.unpack_from(register_format(len(values) * 2, 'H', order), buf, 0)
+
+def from_float32(values, word_swap=False):
+    """แปลงค่า float32 เป็น tuple ของ register (2 ค่าต่อ 1 ค่า)"""
+    order = '<' if word_swap else '>'
+    buf = bytearray(len(values) * 4)
+    struct.pack_into(register_format(len(values), 'f', order), buf, 0, *values)
+    return struct.unpack_from(register_format(len(values) * 2, 'H', order), buf, 0)
@@ -0,0 +1,57 @@
+# modbus_diagnostics.py
+# Function Code ที่ใช้ไม่บ่อย (diagnostics / report-by-exception) แยกจาก modbus_dispatch
+# ModbusRequestHandler import โมดูลนี้เมื่อมี request แรกเท่านั้น (register_lazy) จึงไม่กิน RAM ตอนบูต
+# handler ทุกตัวรับ (request_handler, unit_id, pdu, out) และคืนค่าความยาว Response PDU
+import struct
+from modbus_dispatch import ModbusError, ILLEGAL_DATA_VALUE, FC_READ_CHANGES
+from modbus_kernels import pack_bits
+from routing import VIEW_FLOAT
+
+MAX_CHANGE_BITS = 1968 # bitmap สูงสุด 246 ไบต์ ให้ Response ไม่เกิน MAX_PDU_SIZE
+_bits = bytearray(MAX_CHANGE_BITS)    # 1 ไบต์ต่อ register (0/1) ก่อนรวมเป็น bitmap
+_NO_CHANGES = bytes(MAX_CHANGE_BITS)
+
+def read_changes(handler, unit_id, pdu, out):
+    """FC 0x41 Read Changes (report-by-exception)
+    Request: since (4 ไบต์) + start address (2) + quantity (2)
+    Response: change seq ปัจจุบัน (4) + byte count (1) + bitmap (bit 0 ของไบต์แรก = start address)
+    bit = 1 คือ register เปลี่ยนหลัง seq since (since = 0 คือทั้งหมด) ให้ client อ่านเฉพาะช่วงนั้นด้วย FC03
+    address ที่ไม่มี mapping หรือเป็น virtual register จะเป็น 0 เสมอ"""
+    since, start_reg, num_regs = struct.unpack_from('>LHH', pdu, 1)
+    if not (1 <= num_regs <= MAX_CHANGE_BITS):
+        raise ModbusError(ILLEGAL_DATA_VALUE)
+    image = handler.image
+    with image.lock: # threaded mode: change_seq กับ reg_seq ชุดเดียวกัน
+        return _change_bitmap(image, handler.routing, unit_id, since, start_reg, num_regs, out)
+
+def _change_bitmap(image, routing, unit_id, since, start_reg, num_regs, out):
+    # เก็บผลต่อ register เป็น 0/1 ลง buffer ที่จองไว้ แล้วรวมเป็น bitmap ด้วย kernel pack_bits ครั้งเดียว
+    bits = _bits
+    memoryview(bits)[:num_regs] = memoryview(_NO_CHANGES)[:num_regs]
+    address = start_reg
+    end = start_reg + num_regs
+    while address < end:
+        if routing:
+            w = routing.find(unit_id, address)
+            if w < 0:
+                address += 1
+                continue
+            stop = min(end, routing.window_end(w))
+            pair = routing.kinds[w] == VIEW_FLOAT # ค่า int32 ขึ้นกับ register ทั้งคู่
+            for a in range(address, stop):
+                slot = routing.slot_of(w, a)
+                if slot < 0:
+                    continue
+                if image.changed_since(slot, since) or (pair and image.changed_since(slot + 1, since)):
+                    bits[a - start_reg] = 1
+            address = stop
+        else:
+            for a in range(address, min(end, image.size)):
+                if image.changed_since(a, since):
+                    bits[a - start_reg] = 1
+            break
+    out[0] = FC_READ_CHANGES
+    struct.pack_into('>L', out, 1, image.change_seq)
+    nbytes = pack_bits(bits, 0, num_regs, out, 6)
+    out[5] = nbytes
+    return 6 + nbytes
@@ -0,0 +1,142 @@
+# modbus_dispatch.py
+# ประมวลผล Modbus PDU ด้วยตาราง handler 256 ช่อง (index = Function Code) แทน if/else ต่อ Function Code
+# handler ได้รับ memoryview ของ PDU และ buffer ขาออกที่จองไว้แล้ว เขียน Response ลง buffer โดยตรง
+# ข้อผิดพลาดทุกชนิดแปลงเป็น Exception Code ที่เดียวใน process_pdu()
+import struct
+import time
+from array import array
+from modbus_codec import encode_registers
+from register_image import NO_LOCK
+
+# Modbus Exception Codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_FAILURE = 0x04
+SLAVE_DEVICE_BUSY = 0x06
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_FAILED = 0x0B
+
+MAX_PDU_SIZE = 253
+
+# Function Code เฉพาะของ gateway (อยู่ในช่วง user-defined 65-72 ของมาตรฐาน)
+FC_READ_CHANGES = 0x41 # อ่าน bitmap ของ register ที่เปลี่ยนตั้งแต่ change seq N (modbus_diagnostics)
+
+# ข้อผิดพลาดจากการ unpack PDU ที่สั้น/ผิดรูปแบบ (MicroPython ยก ValueError, CPython ยก struct.error)
+_DECODE_ERRORS = (ValueError, IndexError, getattr(struct, 'error', ValueError))
+
+class ModbusError(Exception):
+    """ยกขึ้นจาก handler เพื่อให้ตอบเป็น Exception Response ด้วย code ที่กำหนด"""
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+class ModbusRequestHandler:
+    def __init__(self, registers_data, image=None, routing=None, stats=True):
+        self.registers = registers_data # อ้างอิงถึงลิสต์ holding_registers ส่วนกลาง
+        self.image = image # RegisterImage (ถ้ามี) ใช้ตรวจความสดของข้อมูลก่อนตอบ
+        self.routing = routing # RoutingTable (ถ้ามี) แปลง (unit, address) เป็นตำแหน่งใน registers
+        self.out = bytearray(MAX_PDU_SIZE) # buffer ของ Response PDU ใช้ซ้ำทุก request
+        self._out_mv = memoryview(self.out)
+        self.view_buf = array('H', bytes(250)) # ค่าของ routing view ที่ไม่ใช่ direct (สูงสุด 125 register)
+        self.handlers = [None] * 256
+        # สถิติต่อ Function Code: [จำนวนครั้ง, เวลารวม (us), เวลาสูงสุด (us)] ของการ decode + dispatch
+        self.stats_enabled = stats
+        self.fc_stats = {}
+        self.register(0x03, self._read_holding_registers)
+        if image is not None:
+            # ใช้ไม่บ่อย: import modbus_diagnostics เมื่อมี request แรกเท่านั้น (ประหยัด RAM ตอนบูต)
+            self.register_lazy(FC_READ_CHANGES, "modbus_diagnostics", "read_changes")
+
+    def register(self, function_code, handler):
+        """ลงทะเบียน handler(unit_id, pdu, out) -> ความยาว Response PDU ที่เขียนลง out"""
+        self.handlers[function_code] = handler
+        self.fc_stats[function_code] = array('L', [0, 0, 0])
+
+    def register_lazy(self, function_code, module, name):
+        """ลงทะเบียน handler ที่อยู่ในโมดูลอื่น module.name(request_handler, unit_id, pdu, out)
+        โมดูลจะถูก import เมื่อมี request ของ Function Code นี้ครั้งแรก แล้วแทนที่ตัวเองในตาราง"""
+        def load(unit_id, pdu, out):
+            func = getattr(__import__(module), name)
+            def handler(unit_id, pdu, out):
+                return func(self, unit_id, pdu, out)
+            self.handlers[function_code] = handler
+            return handler(unit_id, pdu, out)
+        self.register(function_code, load)
+
+    def process_pdu(self, unit_id, pdu):
+        """ประมวลผล Modbus PDU (Function Code + Data) คืนค่า Response PDU (ปกติ หรือ Exception)
+        ค่าที่คืนเป็น memoryview ของ buffer ภายใน: ต้องส่ง/คัดลอกออกไปก่อนเรียก process_pdu ครั้งถัดไป"""
+        start = time.ticks_us()
+        pdu = memoryview(pdu)
+        function_code = pdu[0]
+        handler = self.handlers[function_code]
+        out = self.out
+        try:
+            if handler is None:
+                raise ModbusError(ILLEGAL_FUNCTION) # ฟังก์ชันโค้ดไม่รองรับ
+            n = handler(unit_id, pdu, out)
+        except ModbusError as e:
+            n = self._exception(function_code, e.code)
+        except _DECODE_ERRORS:
+            n = self._exception(function_code, ILLEGAL_DATA_VALUE) # PDU สั้นหรือรูปแบบผิด
+        if self.stats_enabled and handler is not None:
+            elapsed = time.ticks_diff(time.ticks_us(), start)
+            st = self.fc_stats[function_code]
+            st[0] += 1
+            st[1] += elapsed
+            if elapsed > st[2]:
+                st[2] = elapsed
+        return self._out_mv[:n]
+
+    def _exception(self, function_code, code):
+        # สร้าง Exception Response PDU: ตั้งค่า MSB ของ Function Code เพื่อระบุว่าเป็น Exception
+        self.out[0] = function_code | 0x80
+        self.out[1] = code
+        return 2
+
+    def stats(self):
+        """คืนค่าสถิติต่อ Function Code: {fc: (จำนวนครั้ง, เวลาเฉลี่ย us, เวลาสูงสุด us)}"""
+        result = {}
+        for fc, st in self.fc_stats.items():
+            result[fc] = (st[0], st[1] // st[0] if st[0] else 0, st[2])
+        return result
+
+    # --- Function Code handlers ---
+
+    def _read_holding_registers(self, unit_id, pdu, out):
+        """FC03 Read Holding Registers"""
+        start_reg, num_regs = struct.unpack_from('>HH', pdu, 1)
+        if not (1 <= num_regs <= 125):
+            raise ModbusError(ILLEGAL_DATA_VALUE)
+
+        # แปลง TCP address เป็นตำแหน่งใน registers (ไม่มี routing = address ตรงกับ index)
+        window = -1
+        slot = start_reg
+        check_start, check_count = start_reg, num_regs
+        if self.routing:
+            window = self.routing.find(unit_id, start_reg, num_regs)
+            if window < 0:
+                raise ModbusError(ILLEGAL_DATA_ADDRESS)
+            source = self.routing.source_range(window, start_reg, num_regs)
+            check_start, check_count = source if source else (0, 0)
+        elif slot + num_regs > len(self.registers):
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+
+        # ตรวจความสดของข้อมูล (ข้อมูลเก่าเกินกำหนด = Gateway Target Device Failed to Respond)
+        if self.image and check_count and self.image.check_range(check_start, check_count):
+            raise ModbusError(GATEWAY_TARGET_FAILED)
+
+        out[0] = 0x03
+        out[1] = num_regs * 2 # Byte Count
+        image = self.image
+        # threaded mode: อ่านจาก buffer ที่ publish แล้วภายใต้ lock (ถือไว้แค่ตอนคัดลอก) ได้ค่าชุดเดียวกันทั้งช่วง
+        with image.lock if image else NO_LOCK:
+            registers = image.registers if image else self.registers
+            if window >= 0:
+                values, base = self.routing.read(window, start_reg, num_regs, registers, image, self.view_buf)
+            else:
+                values = registers
+                base = slot
+            # Pack ค่า Register ทั้งหมดเป็น 16-bit unsigned short (H) แบบ Big-endian (>) ในครั้งเดียว
+            return 2 + encode_registers(values, base, num_regs, out, 2)
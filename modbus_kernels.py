@@ -0,0 +1,94 @@
+# modbus_kernels.py
+# ลูปที่ทำงานบ่อยที่สุดของ gateway (kernel) แยกไว้ที่เดียว:
+#   crc16        : CRC-16/Modbus ของ RTU frame และไฟล์ snapshot
+#   mbap_header  : แยก MBAP header (transaction id, protocol id, length, unit id)
+#   store_be     : คัดลอก array('H') ลง buffer เป็น big-endian (payload ของ FC03 Response)
+#   load_be      : คัดลอก payload big-endian ลง array('H') (Response ของ RTU -> register image)
+#   pack_bits    : รวมค่า 0/1 เป็น bitmap (LSB ก่อน แบบ coils/discrete inputs)
+# บน MicroPython ใช้ kernel แบบ viper/native จาก modbus_kernels_viper (compile เป็น machine code)
+# บน CPython (ทดสอบบน PC) หรือ firmware ที่ไม่มี native emitter ใช้โค้ด Python ธรรมดาที่ให้ผลเหมือนกันทุกไบต์
+# ตรวจความถูกต้องและวัดความเร็วได้ด้วย kernel_check.self_check() / kernel_check.benchmark()
+from array import array
+
+# ตรวจจากการ import ได้จริง: hasattr(micropython, "viper") เป็น False เสมอ (decorator มีแค่ใน compiler)
+# ImportError = ไม่มีโมดูล micropython (CPython), SyntaxError = firmware ไม่มี native emitter,
+# ValueError = .mpy ที่ compile ไว้คนละ architecture กับบอร์ด
+try:
+    import modbus_kernels_viper as _viper
+    HAVE_NATIVE = True
+except (ImportError, SyntaxError, ValueError):
+    HAVE_NATIVE = False
+
+def _make_crc_table():
+    table = array('H', [0] * 256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table[i] = crc
+    return table
+
+CRC_TABLE = _make_crc_table() # ตาราง 256 ค่า (512 ไบต์) แทนการวน 8 bit ต่อไบต์
+
+# --- Pure-Python (ใช้บน CPython และเป็นต้นแบบสำหรับตรวจ kernel แบบ native) ---
+
+def crc16_py(data, crc=0xFFFF):
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def mbap_header_py(adu):
+    return (adu[0] << 8) | adu[1], (adu[2] << 8) | adu[3], (adu[4] << 8) | adu[5], adu[6]
+
+def store_be_py(values, start, count, buf, offset):
+    for i in range(count):
+        v = values[start + i]
+        buf[offset] = v >> 8
+        buf[offset + 1] = v & 0xFF
+        offset += 2
+    return count * 2
+
+def load_be_py(buf, offset, count, dest, dest_offset):
+    for i in range(count):
+        dest[dest_offset + i] = (buf[offset] << 8) | buf[offset + 1]
+        offset += 2
+    return count
+
+def pack_bits_py(bits, start, count, buf, offset):
+    nbytes = (count + 7) >> 3
+    for i in range(nbytes):
+        buf[offset + i] = 0
+    for i in range(count):
+        if bits[start + i]:
+            buf[offset + (i >> 3)] |= 1 << (i & 7)
+    return nbytes
+
+# --- Native kernels (MicroPython ที่มี native emitter เท่านั้น ดู modbus_kernels_viper) ---
+
+if HAVE_NATIVE:
+    def crc16(data, crc=0xFFFF):
+        return _viper.crc16(data, len(data), crc, CRC_TABLE)
+
+    mbap_header = _viper.mbap_header
+
+    def store_be(values, start, count, buf, offset):
+        _viper.store_be(memoryview(values)[start:], count, memoryview(buf)[offset:])
+        return count * 2
+
+    def load_be(buf, offset, count, dest, dest_offset):
+        _viper.load_be(memoryview(buf)[offset:], count, memoryview(dest)[dest_offset:])
+        return count
+
+    def pack_bits(bits, start, count, buf, offset):
+        _viper.pack_bits(memoryview(bits)[start:], count, memoryview(buf)[offset:])
+        return (count + 7) >> 3
+else:
+    crc16 = crc16_py
+    mbap_header = mbap_header_py
+    store_be = store_be_py
+    load_be = load_be_py
+    pack_bits = pack_bits_py
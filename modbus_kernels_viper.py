@@ -0,0 +1,50 @@
+# modbus_kernels_viper.py
+# ส่วน native ของ modbus_kernels: @micropython.viper / @micropython.native (compile เป็น machine code)
+# แยกไฟล์เพราะ decorator พวกนี้ compiler เท่านั้นที่รู้จัก (โมดูล micropython ไม่มี attribute viper/native ตอนรัน)
+# และ port ที่ไม่มี native emitter จะ compile ไฟล์นี้ไม่ผ่าน (SyntaxError) modbus_kernels จึง import
+# ใน try/except แล้วใช้ต้นแบบ pure-Python แทนเมื่อ import ไม่ได้ (รวมถึงบน CPython ที่ไม่มีโมดูล micropython)
+# viper รับอาร์กิวเมนต์ได้ไม่เกิน 4 ตัว: ผู้เรียกส่ง offset เป็น memoryview ที่ slice แล้วแทน
+import micropython
+
+@micropython.viper
+def crc16(data, n: int, crc: int, table) -> int:
+    p = ptr8(data)
+    t = ptr16(table)
+    for i in range(n):
+        crc = (crc >> 8) ^ t[(crc ^ p[i]) & 0xFF]
+    return crc
+
+@micropython.native
+def mbap_header(adu):
+    return (adu[0] << 8) | adu[1], (adu[2] << 8) | adu[3], (adu[4] << 8) | adu[5], adu[6]
+
+@micropython.viper
+def store_be(values, count: int, buf):
+    src = ptr16(values)
+    dst = ptr8(buf)
+    j = 0
+    for i in range(count):
+        v = src[i]
+        dst[j] = v >> 8
+        dst[j + 1] = v & 0xFF
+        j += 2
+
+@micropython.viper
+def load_be(buf, count: int, dest):
+    src = ptr8(buf)
+    dst = ptr16(dest)
+    j = 0
+    for i in range(count):
+        dst[i] = (src[j] << 8) | src[j + 1]
+        j += 2
+
+@micropython.viper
+def pack_bits(bits, count: int, buf):
+    src = ptr8(bits)
+    dst = ptr8(buf)
+    nbytes = (count + 7) >> 3
+    for i in range(nbytes):
+        dst[i] = 0
+    for i in range(count):
+        if src[i]:
+            dst[i >> 3] |= 1 << (i & 7)
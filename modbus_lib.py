@@ -1,52 +1,104 @@
 # modbus_lib.py
 import machine
 import time
-import struct
 import socket
-import sys
+from modbus_transport import MBAP_FRAMER, RTU_FRAMER, TCPSession, TX_BUFFER_SIZE, crc16, t35_us
+from modbus_dispatch import ModbusRequestHandler
+from modbus_codec import decode_registers
+
+# ความยาว Response ของ Function Code ที่รู้ได้จากไบต์แรกๆ (ใช้กับ request แบบ transparent)
+_COUNTED_RESPONSE = (0x01, 0x02, 0x03, 0x04, 0x17)       # Slave ID + FC + Byte Count + Data + CRC
+_FIXED_RESPONSE = {0x05: 8, 0x06: 8, 0x0F: 8, 0x10: 8, 0x16: 10}
+
+def rtu_response_length(frame, n):
+    """ความยาวทั้งหมดของ RTU Response จาก n ไบต์แรกที่รับได้ คืนค่า 0 ถ้ายังบอกไม่ได้
+    (ยังรับไม่พอ หรือ Function Code ที่ความยาวไม่แน่นอน ซึ่งต้องรอช่วงเงียบ t3.5 แทน)"""
+    if n < 2:
+        return 0
+    fc = frame[1]
+    if fc & 0x80:
+        return 5 # Exception Response
+    if fc in _COUNTED_RESPONSE:
+        return 5 + frame[2] if n >= 3 else 0
+    return _FIXED_RESPONSE.get(fc, 0)
 
 # --- Modbus RTU Master Implementation ---
 class ModbusRTUMaster:
-    def __init__(self, uart_id, tx_pin, rx_pin, de_re_pin, baudrate, slave_id):
+    # ก่อนทุก transaction: ล้างไบต์ค้างใน RX (Response ที่มาช้าของ transaction ก่อนที่ timeout ไปแล้ว หรือ noise)
+    # ระหว่างรับ: ตัดไบต์หน้า frame จนกว่าจะขึ้นต้นด้วย Slave ID + Function Code ที่ถาม (และ Byte Count ที่คาดไว้)
+    # และถ้า frame ครบแต่ CRC ผิด ให้ลองหาจุดเริ่ม frame ถัดไปใน buffer ก่อนถือว่าล้มเหลว
+    # ไบต์ที่รับไว้แล้วเงียบไปนานเกิน t3.5 (เห็นเองว่า UART ว่าง) ถือเป็น frame อื่น: ทิ้งเมื่อไบต์ถัดไปมาถึง
+    # ทำให้ bus กลับมาปกติภายใน transaction เดียวหลัง timeout แทนที่จะล้มต่อกันหลายครั้ง
+    # echo=True สำหรับ transceiver ที่ได้ยินไบต์ที่ตัวเองส่ง (RE ต่อค้าง enable): ตัด echo ของ request ทิ้ง
+    def __init__(self, uart_id, tx_pin, rx_pin, de_re_pin, baudrate, slave_id, echo=False):
         self.de_re_pin = machine.Pin(de_re_pin, machine.Pin.OUT)
         self.de_re_pin.value(0) # ตั้งค่าขา DE/RE เป็น LOW เพื่อเข้าสู่โหมดรับ (Receive Mode)
         
         # กำหนด UART ด้วยขา TX/RX ที่ถูกต้อง และตั้งค่า timeout สำหรับการรับส่งข้อมูล
         self.uart = machine.UART(uart_id, baudrate=baudrate, tx=tx_pin, rx=rx_pin, timeout=100, timeout_char=10)
+        self.uart_id = uart_id
+        self.baudrate = baudrate
         self.slave_id = slave_id
 
+        # สถานะของ transaction ที่กำลังรอ Response (ใช้กับ begin_/poll_transaction แบบไม่บล็อก)
+        self.busy = False
+        self.done_us = 0 # ticks_us ที่ transaction ล่าสุดจบบนสาย (ไบต์สุดท้ายที่รับ หรือเวลาที่ timeout)
+        self.last_exception = 0 # Exception Code ล่าสุดที่ slave ตอบกลับมา (0 = ไม่มี)
+        self._rx = bytearray(256) # buffer รับ Response ขนาดสูงสุดของ RTU ADU (FC03 ใช้ 5 + 125 * 2)
+        self._rx_mv = memoryview(self._rx)
+        self._rx_len = 0
+        self._expected_len = 0
+        self._quantity = 0
+        self._tx_slave = 0
+        self._start_time = 0
+        self._timeout_ms = 0
+        self._last_rx_us = 0
+        self._gap = False # เห็นช่วงเงียบ >= t3.5 หลังไบต์ใน buffer แล้ว (ไบต์ถัดไปคือ frame ใหม่)
+        self._tx_fc = 0
+        self._tx_count = 0 # Byte Count ที่คาดใน Response (0 = ไม่ตรวจ)
+        self.echo = echo
+        self._echo = None  # request ที่เพิ่งส่ง (ใช้เทียบ echo)
+        self._echo_left = 0
+        # สถิติการ resync: จำนวนครั้ง, ไบต์ค้างที่ล้างก่อนส่ง, ไบต์ขยะที่ตัดหน้า frame, ไบต์ echo ที่ตัดทิ้ง
+        self.resyncs = 0
+        self.flushed_bytes = 0
+        self.skipped_bytes = 0
+        self.echo_bytes = 0
+        # ช่วงเงียบ t3.5: จบ Response ที่ไม่รู้ความยาว และแยกไบต์ขยะก่อนช่วงเงียบออกจาก frame ที่ตามมา
+        self._t35_us = t35_us(baudrate)
+        # Request frame ที่ compile แล้ว (รวม CRC): request ของการ poll ซ้ำๆ ไม่เปลี่ยน
+        # จึงไม่ต้องสร้าง PDU/คำนวณ CRC ใหม่ทุกรอบ
+        self._frames = {}
+
+    def set_baudrate(self, baudrate):
+        """เปลี่ยน baud rate ของ UART ขณะทำงาน (ใช้ตอนสแกนหา slave) ต้องไม่มี transaction ค้างอยู่"""
+        self.uart.init(baudrate=baudrate)
+        self.baudrate = baudrate
+        self._t35_us = t35_us(baudrate)
+
     def _calculate_crc(self, data):
         """คำนวณ Modbus RTU CRC (Cyclic Redundancy Check)"""
-        crc = 0xFFFF
-        for byte in data:
-            crc ^= byte
-            for _ in range(8):
-                if (crc & 0x0001):
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return crc.to_bytes(2, 'little') # คืนค่า CRC แบบ Little-endian
-
-    def read_holding_registers(self, start_address, quantity):
-        if not (1 <= quantity <= 125): # ตรวจสอบจำนวน Register ที่สามารถอ่านได้ (FC03 สูงสุด 125)
-            print("Error: Quantity must be between 1 and 125.")
-            return None
+        return crc16(data).to_bytes(2, 'little') # คืนค่า CRC แบบ Little-endian
 
-        # สร้าง ADU (Application Data Unit) สำหรับ Modbus RTU Request
-        # ประกอบด้วย: Slave ID (1 byte) + Function Code (1 byte) + Start Address (2 bytes) + Quantity (2 bytes)
-        pdu = bytearray([
-            self.slave_id,
-            0x03, # Function Code: Read Holding Registers (0x03)
-            (start_address >> 8) & 0xFF, # Start Address High Byte
-            start_address & 0xFF,       # Start Address Low Byte
-            (quantity >> 8) & 0xFF,      # Quantity High Byte
-            quantity & 0xFF            # Quantity Low Byte
-        ])
-        
-        crc = self._calculate_crc(pdu) # คำนวณ CRC
-        adu = pdu + crc # รวม PDU กับ CRC เพื่อสร้าง ADU
+    def _flush_rx(self):
+        """ล้างไบต์ที่ค้างใน RX ก่อนส่ง request (ทุกอย่างก่อน request นี้เป็นของ frame ก่อนหน้า)"""
+        uart = self.uart
+        n = uart.any()
+        if not n:
+            return
+        while n:
+            got = uart.readinto(self._rx_mv[:min(n, len(self._rx))])
+            if not got:
+                break
+            self.flushed_bytes += got
+            n = uart.any()
+        self.resyncs += 1
 
+    def _send(self, adu):
+        self._flush_rx()
+        if self.echo:
+            self._echo = adu
+            self._echo_left = len(adu)
         self.de_re_pin.value(1) # ตั้งค่าขา DE/RE เป็น HIGH เพื่อเปิดใช้งานการส่ง (Transmit Mode)
         time.sleep_us(100) # หน่วงเวลาเล็กน้อยเพื่อให้ MAX485 สลับโหมด
 
@@ -58,177 +110,507 @@ class ModbusRTUMaster:
         time.sleep_us(100) # หน่วงเวลาเล็กน้อยก่อนสลับไปโหมดรับ
         self.de_re_pin.value(0) # ตั้งค่าขา DE/RE เป็น LOW เพื่อเปิดใช้งานการรับ (Receive Mode)
 
-        # อ่าน Response จาก Modbus RTU Slave
+    def request_frame(self, start_address, quantity, slave_id=None):
+        """คืนค่า request frame ของ FC03 (bytes รวม CRC, แก้ไขไม่ได้) จาก cache หรือ compile ครั้งแรก"""
+        if slave_id is None:
+            slave_id = self.slave_id # ใช้ Slave ID ที่กำหนดตอนสร้าง ถ้าไม่ได้ระบุ
+        key = (slave_id << 32) | (start_address << 16) | quantity
+        frame = self._frames.get(key)
+        if frame is None:
+            # สร้าง ADU (Application Data Unit) สำหรับ Modbus RTU Request
+            # ประกอบด้วย: Slave ID (1 byte) + Function Code (1 byte) + Start Address (2 bytes) + Quantity (2 bytes)
+            pdu = bytearray([
+                slave_id,
+                0x03, # Function Code: Read Holding Registers (0x03)
+                (start_address >> 8) & 0xFF, # Start Address High Byte
+                start_address & 0xFF,       # Start Address Low Byte
+                (quantity >> 8) & 0xFF,      # Quantity High Byte
+                quantity & 0xFF            # Quantity Low Byte
+            ])
+            frame = bytes(pdu + self._calculate_crc(pdu)) # รวม PDU กับ CRC เพื่อสร้าง ADU
+            if len(self._frames) >= 64:
+                self._frames.clear() # จำกัดขนาด cache (กรณีเรียกด้วย address ที่ไม่ซ้ำกัน เช่นตอนสแกน)
+            self._frames[key] = frame
+        return frame
+
+    def begin_read_holding_registers(self, start_address, quantity, slave_id=None, timeout_ms=None):
+        """ส่งคำขอ FC03 แล้วคืนทันที (ไม่รอ Response) จากนั้นเรียก poll_transaction() จนกว่าจะเสร็จ
+        คืนค่า False ถ้าพารามิเตอร์ไม่ถูกต้อง"""
+        if not (1 <= quantity <= 125): # ตรวจสอบจำนวน Register ที่สามารถอ่านได้ (FC03 สูงสุด 125)
+            print("Error: Quantity must be between 1 and 125.")
+            return False
+        frame = self.request_frame(start_address, quantity, slave_id)
         # Response ที่คาดหวัง: Slave ID (1) + FC (1) + Byte Count (1) + Data (2*quantity) + CRC (2)
-        # ความยาวขั้นต่ำของ Response คือ 5 ไบต์ (ถ้ามีแค่ 1 Register + CRC)
-        expected_len = 1 + 1 + 1 + (quantity * 2) + 2 
+        return self.begin_transaction(frame, 1 + 1 + 1 + (quantity * 2) + 2, timeout_ms)
 
-        response_buffer = bytearray(expected_len)
-        bytes_read = 0
-        
-        # คำนวณ timeout based on UART settings (timeout และ timeout_char)
-        # นี่คือการประมาณเวลาสูงสุดที่ควรรอรับข้อมูล
-        timeout_ms = self.uart.timeout + self.uart.timeout_char * expected_len 
-        start_time = time.ticks_ms()
-
-        # วนลูปอ่านไบต์จนกว่าจะครบตามที่คาดหวัง หรือหมดเวลา
-        while bytes_read < expected_len and time.ticks_diff(time.ticks_ms(), start_time) < timeout_ms:
-            if self.uart.any(): # ตรวจสอบว่ามีข้อมูลในบัฟเฟอร์ UART หรือไม่
-                byte = self.uart.read(1) # อ่านทีละ 1 ไบต์
-                if byte:
-                    response_buffer[bytes_read] = byte[0]
-                    bytes_read += 1
-            else:
-                time.sleep_us(100) # หน่วงเวลาเล็กน้อยเพื่อไม่ให้ CPU ทำงานหนักเกินไป
+    def begin_transaction(self, frame, expected_len, timeout_ms=None):
+        """ส่ง request frame ที่ compile ไว้แล้ว (จาก request_frame) และเตรียมรับ Response ยาว expected_len ไบต์"""
+        self._send(frame)
+
+        quantity = (expected_len - 5) >> 1
+        self._expected_len = expected_len
+        self._rx_len = 0
+        self._gap = False
+        self._quantity = quantity
+        self._tx_slave = frame[0]
+        self._tx_fc = frame[1]
+        self._tx_count = expected_len - 5
+        # ถ้าไม่ได้กำหนด timeout มา ใช้ค่าจาก UART settings (timeout และ timeout_char) เหมือนเดิม
+        if timeout_ms is None:
+            timeout_ms = self.uart.timeout + self.uart.timeout_char * expected_len
+        self._timeout_ms = timeout_ms
+        self._start_time = time.ticks_ms()
+        self.busy = True
+        return True
+
+    def poll_transaction(self, decode=True):
+        """อ่านไบต์ที่มีอยู่ใน UART โดยไม่รอ คืนค่า None = ยังรอ Response อยู่,
+        tuple ของค่า register = สำเร็จ, False = ล้มเหลว (timeout, exception, CRC ผิด ฯลฯ)
+        decode=False คืน memoryview ของ payload big-endian ใน RX buffer แทน tuple (ไม่สร้าง object ต่อ register
+        ใช้ได้จนกว่าจะเริ่ม transaction ถัดไป) สำหรับ decode ลง register image โดยตรง"""
+        if not self.busy:
+            return False
+        rx_len = self._receive()
+        expected = self._expected_len
+        # Exception Response ยาว 5 ไบต์เสมอ ไม่ต้องรอจนครบความยาวของ Response ปกติ
+        if rx_len >= 5 and (self._rx[1] & 0x80):
+            expected = 5
+        done = rx_len >= expected
+        if done and not self._crc_ok(expected):
+            done = False
+            self._resync()
+        in_time = time.ticks_diff(time.ticks_ms(), self._start_time) < self._timeout_ms
+        if not done and in_time:
+            return None
+        self._complete()
+        if done:
+            self._rx_len = expected # ไบต์เกินท้าย frame ไม่ใช่ของ Response นี้
+        if not self._check_read_response():
+            return False
+        if not decode:
+            return self._rx_mv[3:3 + self._quantity * 2]
+        # ดึงข้อมูล Register ออกมาในครั้งเดียว (16-bit Big-endian ต่อ Register)
+        return decode_registers(self._rx, 3, self._quantity)
+
+    def _complete(self):
+        """จบ transaction: bus ว่างตั้งแต่ไบต์สุดท้ายที่รับ (ไม่ใช่ตอนที่ main loop มาเห็น)
+        ถ้าไม่มีไบต์ใน buffer (timeout) ใช้เวลาปัจจุบัน"""
+        self.busy = False
+        self.done_us = self._last_rx_us if self._rx_len else time.ticks_us()
+
+    def _receive(self):
+        """อ่านไบต์ที่มีใน UART ต่อท้าย buffer (ไม่รอ) ตัด echo, ไบต์ก่อนช่วงเงียบ t3.5 และไบต์ขยะหน้า frame
+        คืนค่าจำนวนไบต์ใน buffer"""
+        rx_len = self._rx_len
+        n = self.uart.any()
+        if not n:
+            # ตั้ง flag เมื่อเห็นเองว่า UART เงียบนานกว่า t3.5 เท่านั้น (main loop ที่ช้าไม่ทำให้ตัด frame ผิด)
+            if rx_len and time.ticks_diff(time.ticks_us(), self._last_rx_us) >= self._t35_us:
+                self._gap = True
+        elif rx_len < len(self._rx):
+            if self._gap:
+                # ไบต์ก่อนช่วงเงียบเป็นคนละ frame (Response ค้าง/noise): เริ่ม frame ใหม่จากไบต์ที่เพิ่งมา
+                self._gap = False
+                self._discard(rx_len)
+                self.resyncs += 1
+                rx_len = 0
+            got = self.uart.readinto(self._rx_mv[rx_len:rx_len + min(n, len(self._rx) - rx_len)])
+            if got:
+                self._rx_len = rx_len + got
+                self._last_rx_us = time.ticks_us()
+                if self._echo_left:
+                    self._skip_echo()
+                if self._align():
+                    self.resyncs += 1
+        return self._rx_len
+
+    def _skip_echo(self):
+        """ตัดไบต์ที่ตรงกับ request ที่เพิ่งส่งออกจากหน้า buffer ถ้าไม่ตรงแปลว่าไม่มี echo (เลิกตัด)"""
+        rx = self._rx
+        echo = self._echo
+        pos = len(echo) - self._echo_left
+        k = 0
+        limit = min(self._rx_len, self._echo_left)
+        while k < limit and rx[k] == echo[pos + k]:
+            k += 1
+        if k < limit:
+            self._echo_left = 0
+            return
+        self._echo_left -= k
+        self.echo_bytes += k
+        self._rx_len -= k
+        if k and self._rx_len:
+            rx[:self._rx_len] = rx[k:k + self._rx_len]
+
+    def _align(self):
+        """ตัดไบต์หน้า buffer จนกว่าจะขึ้นต้นด้วย Slave ID + Function Code ที่ถาม (หรือ Exception ของมัน)
+        และ Byte Count ตรงกับที่คาด (ถ้ารู้) คืนค่าจำนวนไบต์ที่ตัด"""
+        rx = self._rx
+        n = self._rx_len
+        slave = self._tx_slave
+        fc = self._tx_fc
+        count = self._tx_count
+        i = 0
+        while i < n:
+            if rx[i] == slave and (i + 1 >= n or (rx[i + 1] & 0x7F) == fc):
+                if not (count and i + 2 < n and rx[i + 1] == fc and rx[i + 2] != count):
+                    break
+            i += 1
+        if i:
+            self._discard(i)
+        return i
+
+    def _discard(self, k):
+        """ทิ้ง k ไบต์แรกของ buffer"""
+        n = self._rx_len - k
+        if n > 0:
+            self._rx[:n] = self._rx[k:k + n]
+        self._rx_len = max(n, 0)
+        self.skipped_bytes += k
+        if self._tx_count == 0:
+            self._expected_len = 0 # request แบบ transparent: หาความยาวจาก frame ใหม่
+
+    def _resync(self):
+        """frame ครบแต่ CRC ผิด (ขึ้นต้นบังเอิญเหมือน Response): ทิ้งไบต์แรกแล้วหาจุดเริ่ม frame ถัดไปใน buffer"""
+        self._discard(1)
+        self._align()
+        self.resyncs += 1
+
+    def _crc_ok(self, length):
+        return crc16(self._rx_mv[:length - 2]) == (self._rx[length - 2] | (self._rx[length - 1] << 8))
+
+    def begin_request(self, unit_id, pdu, timeout_ms=None):
+        """ส่ง PDU ใดๆ ตามที่ได้รับ (ทุก Function Code แบบ transparent) แล้วคืนทันที
+        จากนั้นเรียก poll_response() จนกว่าจะเสร็จ ความยาว Response หาจาก Function Code/Byte Count
+        ที่รับได้ หรือจากช่วงเงียบ t3.5 หลังไบต์สุดท้ายสำหรับ Function Code ที่ความยาวไม่แน่นอน"""
+        self._send(RTU_FRAMER.encode(None, unit_id, pdu))
+        self._expected_len = 0 # ยังไม่รู้
+        self._rx_len = 0
+        self._gap = False
+        self._tx_slave = unit_id
+        self._tx_fc = pdu[0]
+        self._tx_count = 0
+        if timeout_ms is None:
+            timeout_ms = self.uart.timeout + self.uart.timeout_char * len(self._rx)
+        self._timeout_ms = timeout_ms
+        self._start_time = time.ticks_ms()
+        self.busy = True
+        return True
+
+    def poll_response(self):
+        """คืนค่า None = ยังรอ Response อยู่, memoryview ของ Response PDU (ตรวจ Slave ID และ CRC แล้ว ตัด
+        Slave ID/CRC ออกแล้ว ใช้ได้จนกว่าจะเริ่ม transaction ถัดไป) = สำเร็จ, False = timeout หรือ frame ผิด"""
+        if not self.busy:
+            return False
+        rx_len = self._receive()
+        if not self._expected_len:
+            self._expected_len = rtu_response_length(self._rx, rx_len)
+
+        expected = self._expected_len
+        if expected:
+            done = rx_len >= expected
+            if done and not self._crc_ok(expected):
+                done = False
+                self._resync()
+                if not self._expected_len:
+                    self._expected_len = rtu_response_length(self._rx, self._rx_len)
+        else:
+            # ช่วงเงียบวัดจากครั้งที่เห็นข้อมูลล่าสุด: ถ้า main loop ช้ากว่า t3.5 อาจตัด frame เร็วไป
+            # ซึ่ง CRC จะไม่ผ่านและถือว่าล้มเหลว (ไม่ส่งข้อมูลผิดออกไป)
+            done = rx_len >= 4 and time.ticks_diff(time.ticks_us(), self._last_rx_us) >= self._t35_us
+        if not done:
+            if time.ticks_diff(time.ticks_ms(), self._start_time) < self._timeout_ms:
+                return None
+            self._complete()
+            return False
+        rx_len = self._rx_len
+        self._complete()
+        frame = self._rx_mv[:expected or rx_len]
+        if frame[0] != self._tx_slave:
+            return False
+        decoded = RTU_FRAMER.decode(frame) # ตรวจ CRC แล้วตัด Slave ID + CRC ออก
+        if decoded is None:
+            return False
+        pdu = decoded[2]
+        if pdu[0] & 0x80:
+            self.last_exception = pdu[1]
+        return pdu
+
+    def _check_read_response(self):
+        response_buffer = self._rx
+        bytes_read = self._rx_len
+        quantity = self._quantity
+        slave_id = self._tx_slave
 
         if bytes_read < 5: # Response สั้นเกินไปที่จะเป็น Modbus ที่ถูกต้อง
             # print(f"RTU response too short: {bytes_read} bytes. Raw: {response_buffer[:bytes_read].hex()}")
-            return None # ไม่ใช่ Response ที่ถูกต้อง
+            return False # ไม่ใช่ Response ที่ถูกต้อง
 
         # ตรวจสอบ Response พื้นฐาน
-        if response_buffer[0] != self.slave_id: # ตรวจสอบ Slave ID
-            # print(f"RTU: Slave ID mismatch. Expected {self.slave_id}, Got {response_buffer[0]}")
-            return None
+        if response_buffer[0] != slave_id: # ตรวจสอบ Slave ID
+            # print(f"RTU: Slave ID mismatch. Expected {slave_id}, Got {response_buffer[0]}")
+            return False
         
         # ตรวจสอบว่าเป็นการตอบกลับแบบ Exception หรือไม่ (Function Code จะถูก OR ด้วย 0x80)
         if (response_buffer[1] & 0x80) == 0x80:
-            exception_code = response_buffer[2]
-            # print(f"RTU Exception: Function Code {response_buffer[1] & 0x7F}, Exception Code {exception_code}")
-            return None
+            self.last_exception = response_buffer[2]
+            # print(f"RTU Exception: Function Code {response_buffer[1] & 0x7F}, Exception Code {self.last_exception}")
+            return False
 
         if response_buffer[1] != 0x03: # ตรวจสอบ Function Code ว่าเป็น 0x03 หรือไม่
             # print(f"RTU: Function Code mismatch. Expected 0x03, Got {response_buffer[1]}")
-            return None
+            return False
 
         response_byte_count = response_buffer[2]
         if response_byte_count != (quantity * 2): # ตรวจสอบจำนวนไบต์ของข้อมูล
             # print(f"RTU: Byte count mismatch. Expected {quantity * 2}, Got {response_byte_count}")
-            return None
+            return False
         
         # ตรวจสอบ CRC
-        received_crc = int.from_bytes(response_buffer[bytes_read-2:bytes_read], 'little')
-        calculated_crc = int.from_bytes(self._calculate_crc(response_buffer[0:bytes_read-2]), 'little')
+        received_crc = response_buffer[bytes_read-2] | (response_buffer[bytes_read-1] << 8)
+        calculated_crc = crc16(self._rx_mv[0:bytes_read-2])
         
         if received_crc != calculated_crc:
             # print(f"RTU: CRC mismatch. Received 0x{received_crc:04X}, Calculated 0x{calculated_crc:04X}")
-            return None
+            return False
 
-        # ดึงข้อมูล Register ออกมา (แต่ละ Register เป็น 16-bit)
-        registers = []
-        for i in range(quantity):
-            # Registers เป็น 2 ไบต์ต่อหนึ่ง Register และเป็น Big-endian
-            register_value = struct.unpack('>H', response_buffer[3 + i*2 : 3 + i*2 + 2])[0]
-            registers.append(register_value)
-            
-        return registers
+        self.last_exception = 0
+        return True
+
+    def read_holding_registers(self, start_address, quantity, slave_id=None):
+        """อ่านแบบบล็อก (รอจนได้ Response หรือหมดเวลา) คืนค่า tuple ของค่า register หรือ None"""
+        if not self.begin_read_holding_registers(start_address, quantity, slave_id):
+            return None
+        while True:
+            result = self.poll_transaction()
+            if result is None:
+                time.sleep_us(100) # หน่วงเวลาเล็กน้อยเพื่อไม่ให้ CPU ทำงานหนักเกินไป
+                continue
+            return result or None
 
 # --- Modbus TCP Server Implementation ---
+# Coalesced send: Response ทั้งหมดของ session ที่เกิดใน poll_for_clients() รอบเดียวถูกเขียนต่อกันลง
+# buffer ที่จองไว้ แล้วส่งด้วย socket write ครั้งเดียว (client ที่ส่ง request ต่อกันหลายชุด = 1 TCP segment
+# แทน 1 segment ต่อ Response) เปิด TCP_NODELAY เองเพราะรวมข้อมูลเองแล้ว ไม่ต้องให้ Nagle หน่วงรอ ACK
+# buffer ของ session (TX_BUFFER_SIZE = 1 TCP segment) อยู่ใน TCPSession ของ modbus_transport
+
+# airtime โดยประมาณของ 1 TCP segment บน Wi-Fi: DIFS/backoff/preamble/ACK + header 802.11/LLC/IP/TCP + payload
+AIRTIME_SEGMENT_US = 200
+SEGMENT_HEADER_BYTES = 34 + 8 + 40
+WIFI_RATE_MBPS = 24
+
+def airtime_us(nbytes):
+    return AIRTIME_SEGMENT_US + (nbytes + SEGMENT_HEADER_BYTES) * 8 // WIFI_RATE_MBPS
+
 class ModbusTCPServer:
-    def __init__(self, ip, port, registers_data):
+    def __init__(self, ip, port, registers_data, image=None, routing=None, framer=None, handler=None,
+                 max_sessions=4, idle_timeout_ms=60000, coalesce=True):
         self.ip = ip
         self.port = port
         self.registers = registers_data # อ้างอิงถึงลิสต์ holding_registers ส่วนกลาง
-        
-        # สร้าง Socket สำหรับ TCP Server
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # อนุญาตให้ใช้ Address ซ้ำได้
-        self.s.bind((self.ip, self.port))
-        self.s.listen(5) # ฟังการเชื่อมต่อได้สูงสุด 5 รายการ
-        self.s.settimeout(0.1) # ตั้ง timeout สำหรับ accept เพื่อให้ไม่บล็อกโปรแกรมหลัก
-        print(f"Modbus TCP Server listening on {self.ip}:{self.port}")
-
-    def _process_modbus_request(self, request_adu):
-        # โครงสร้าง Modbus TCP ADU:
-        # Transaction ID (2 bytes)
-        # Protocol ID (2 bytes, 0x0000 สำหรับ Modbus)
-        # Length (2 bytes)
-        # Unit ID (1 byte)
-        # Function Code (1 byte)
-        # Data ...
-
-        if len(request_adu) < 8: # ความยาว ADU ขั้นต่ำ
-            return None # คำขอไม่ถูกต้อง
-
-        trans_id = int.from_bytes(request_adu[0:2], 'big')
-        protocol_id = int.from_bytes(request_adu[2:4], 'big')
-        length = int.from_bytes(request_adu[4:6], 'big')
-        unit_id = request_adu[6]
-        function_code = request_adu[7]
-
-        response_pdu_data = b''
-        exception_code = 0x00 # ไม่มี Exception (ค่าเริ่มต้น)
-
-        if function_code == 0x03: # Read Holding Registers (Function Code 0x03)
-            if len(request_adu) < 12: # ตรวจสอบความสมบูรณ์ของคำขอ FC03
-                exception_code = 0x01 # Illegal Function (ความยาวไม่ถูกต้อง)
-            else:
-                start_reg = int.from_bytes(request_adu[8:10], 'big')
-                num_regs = int.from_bytes(request_adu[10:12], 'big')
-                
-                # print(f"TCP Req: Read Holding Registers Start={start_reg}, Num={num_regs}")
-
-                # ตรวจสอบความถูกต้องของ Address และ Quantity
-                if not (0 <= start_reg < len(self.registers) and 
-                        1 <= num_regs <= 125 and 
-                        (start_reg + num_regs) <= len(self.registers)):
-                    exception_code = 0x02 # Illegal Data Address
-                else:
-                    byte_count = num_regs * 2
-                    response_pdu_data += byte_count.to_bytes(1, 'big') # เพิ่ม Byte Count ใน PDU
-                    for i in range(num_regs):
-                        # Pack ค่า Register เป็น 16-bit unsigned short (H) แบบ Big-endian (>)
-                        response_pdu_data += struct.pack('>H', self.registers[start_reg + i])
-        else:
-            exception_code = 0x01 # Illegal Function (ฟังก์ชันโค้ดไม่รองรับ)
-
-        # สร้าง Response ADU
-        response_adu = bytearray()
-        response_adu += trans_id.to_bytes(2, 'big') # Transaction ID
-        response_adu += protocol_id.to_bytes(2, 'big') # Protocol ID (0x0000 สำหรับ Modbus TCP)
-
-        if exception_code != 0x00:
-            # สร้าง Exception Response PDU
-            response_pdu = bytearray([
-                unit_id,
-                function_code | 0x80, # ตั้งค่า MSB เพื่อระบุว่าเป็น Exception
-                exception_code
-            ])
-        else:
-            # สร้าง Normal Response PDU
-            response_pdu = bytearray([unit_id, function_code]) + response_pdu_data
+        # handler ใช้ร่วมกับ server อื่นได้ (เช่น UDP / RTU-over-TCP) เพื่อให้ตอบจาก register image เดียวกัน
+        self.handler = handler or ModbusRequestHandler(registers_data, image, routing)
+        self.framer = framer or MBAP_FRAMER # รูปแบบ frame บน TCP: MBAP (ค่าเริ่มต้น) หรือ RTU_FRAMER
+        self.first_response_ticks = None # เวลา (ticks_ms) ที่ส่ง Response แรกออกไป ใช้วัดเวลาบูต
+        self.max_sessions = max_sessions       # client ที่ต่อค้างไว้พร้อมกันได้
+        self.idle_timeout_ms = idle_timeout_ms # ปิด session ที่เงียบนานเกินนี้
+        self.coalesce = coalesce # False = ส่งทันทีทีละ Response (แบบเดิม ใช้เทียบ metrics)
+        self.sessions = []
+        # Metrics: จำนวน socket write (~ จำนวน TCP segment), airtime โดยประมาณ เทียบกับการส่งทีละ Response
+        self.requests = 0
+        self.sends = 0
+        self.bytes_out = 0
+        self.airtime_us = 0
+        self.unbatched_airtime_us = 0 # airtime ถ้าส่งแยกทีละ Response
+        self._window = [time.ticks_ms(), 0, 0] # เริ่มช่วงวัด, sends, requests (สำหรับอัตราต่อวินาที)
+        self.s = None # Initialize socket to None
+        self._setup_socket()
 
-        response_adu += len(response_pdu).to_bytes(2, 'big') # ความยาวของ PDU
-        response_adu += response_pdu
+    def _setup_socket(self):
+        try:
+            if self.s:
+                self.s.close() # ปิด socket เก่าถ้ามี
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # อนุญาตให้ใช้ Address ซ้ำได้
+            self.s.bind((self.ip, self.port))
+            self.s.listen(self.max_sessions)
+            self.s.settimeout(0) # non-blocking: accept คืนทันทีถ้าไม่มี client
+            print(f"Modbus TCP Server ({self.framer.name}) listening on {self.ip}:{self.port}")
+        except Exception as e:
+            print(f"Error setting up Modbus TCP Server socket: {e}")
+            self.s = None # ตั้งเป็น None ถ้ามีปัญหา
 
-        return response_adu
+    def rebind(self, ip):
+        """สร้าง listening socket ใหม่บน IP ใหม่ (เช่น หลัง Wi-Fi reconnect หรือ DHCP เปลี่ยน IP)"""
+        for session in list(self.sessions):
+            self._drop(session)
+        self.ip = ip
+        self._setup_socket()
 
     def poll_for_clients(self):
+        if not self.s: # ตรวจสอบว่า socket ถูกสร้างขึ้นมาอย่างถูกต้อง
+            return
+        self._accept()
+        for session in list(self.sessions):
+            self._serve(session)
+
+    def _accept(self):
         try:
-            conn, addr = self.s.accept() # พยายามรับการเชื่อมต่อใหม่ (ไม่บล็อกเนื่องจาก timeout)
-            # print(f"Connection from {addr}")
-            
-            conn.settimeout(0.01) # ตั้ง timeout สำหรับ client socket เพื่อไม่ให้บล็อกการรับข้อมูล
+            conn, addr = self.s.accept()
+        except OSError:
+            return # ไม่มี Client ใหม่กำลังรอ
+        if len(self.sessions) >= self.max_sessions:
+            conn.close()
+            return
+        conn.settimeout(0)
+        if hasattr(socket, "TCP_NODELAY"):
             try:
-                # อ่าน Modbus TCP ADU ทั้งหมด (สูงสุด 260 ไบต์)
-                request_adu = conn.recv(260) 
-                
-                if request_adu: # ถ้าได้รับข้อมูล
-                    response_adu = self._process_modbus_request(request_adu) # ประมวลผลคำขอ
-                    if response_adu:
-                        conn.sendall(response_adu) # ส่ง Response กลับไป
-                # else:
-                #     print(f"Client {addr} disconnected or sent no data.")
-
-            except socket.timeout:
-                pass # ไม่มีข้อมูลได้รับภายในเวลาที่กำหนด, ดำเนินการต่อ
-            except OSError as e:
-                # print(f"Error handling client {addr}: {e}")
+                conn.setsockopt(getattr(socket, "IPPROTO_TCP", 6), socket.TCP_NODELAY, 1)
+            except OSError:
                 pass
+        self.sessions.append(TCPSession(conn, addr))
+
+    def _serve(self, session):
+        n = session.recv(TX_BUFFER_SIZE)
+        if n < 0:
+            self._drop(session) # client ปิดการเชื่อมต่อ หรือ ECONNRESET / ENOTCONN ฯลฯ
+            return
+        if n:
+            rx = session.rx
+            framer = self.framer
+            # ตอบทุก request ที่รับครบแล้ว ต่อกันลง tx buffer ของ session
+            while True:
+                n = framer.frame_length(rx)
+                if n <= 0:
+                    if n < 0:
+                        self._drop(session) # header ผิด หา frame ถัดไปไม่ได้
+                        return
+                    break
+                request_adu = bytes(rx[:n])
+                del rx[:n]
+                if not self._respond(session, request_adu):
+                    return
+        elif time.ticks_diff(time.ticks_ms(), session.last_rx) > self.idle_timeout_ms:
+            self._drop(session)
+            return
+        self._flush(session)
+
+    def _respond(self, session, request_adu):
+        """เขียน Response ของ request ลง tx buffer คืนค่า False ถ้า session ถูกปิด"""
+        request = self.framer.decode(request_adu)
+        if request is None:
+            return True # คำขอไม่ถูกต้อง: ไม่ตอบ
+        context, unit_id, pdu = request
+        response_pdu = self.handler.process_pdu(unit_id, pdu)
+        if not session.append(self.framer, context, unit_id, response_pdu):
+            if not self._flush(session) or not session.append(self.framer, context, unit_id, response_pdu):
+                self._drop(session) # client ไม่รับข้อมูล buffer เต็ม
+                return False
+        self.requests += 1
+        self.unbatched_airtime_us += airtime_us(len(response_pdu) + self.framer.overhead)
+        if self.first_response_ticks is None:
+            self.first_response_ticks = time.ticks_ms()
+        if not self.coalesce:
+            return self._flush(session)
+        return True
+
+    def _flush(self, session):
+        """ส่งข้อมูลที่รอใน tx buffer ด้วย write ครั้งเดียว คืนค่า False ถ้า session ถูกปิด"""
+        sent = session.flush()
+        if sent < 0:
+            self._drop(session)
+            return False
+        if sent:
+            self.sends += 1
+            self.bytes_out += sent
+            self.airtime_us += airtime_us(sent)
+        return True
+
+    def _drop(self, session):
+        session.close()
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def stats(self):
+        """metrics ของการส่ง: อัตราต่อวินาทีนับจากการเรียก stats() ครั้งก่อน, airtime เฉลี่ยต่อ request
+        เทียบกับ airtime ถ้าส่งทีละ Response"""
+        now = time.ticks_ms()
+        window = self._window
+        elapsed = max(1, time.ticks_diff(now, window[0]))
+        result = {"sessions": len(self.sessions), "requests": self.requests, "sends": self.sends,
+                  "bytes_out": self.bytes_out,
+                  "sends_per_s": (self.sends - window[1]) * 1000 // elapsed,
+                  "requests_per_s": (self.requests - window[2]) * 1000 // elapsed,
+                  "airtime_per_request_us": self.airtime_us // max(1, self.requests),
+                  "unbatched_airtime_per_request_us": self.unbatched_airtime_us // max(1, self.requests)}
+        self._window = [now, self.sends, self.requests]
+        return result
+
+    def close(self):
+        for session in list(self.sessions):
+            self._drop(session)
+        if self.s:
+            try:
+                self.s.close()
+                print("Modbus TCP Server socket closed.")
+            except Exception as e:
+                print(f"Error closing Modbus TCP socket: {e}")
+            finally:
+                self.s = None
+
+# --- Modbus UDP Server Implementation ---
+class ModbusUDPServer:
+    """Modbus/UDP: MBAP frame บน datagram socket เดียว ไม่มี connection/handshake ต่อ client"""
+    def __init__(self, ip, port, handler, framer=None, max_datagrams=8):
+        self.ip = ip
+        self.port = port
+        self.handler = handler # ModbusRequestHandler เดียวกับ TCP server
+        self.framer = framer or MBAP_FRAMER
+        self.max_datagrams = max_datagrams # จำนวน datagram สูงสุดที่ตอบต่อการเรียก poll ครั้งหนึ่ง
+        self.first_response_ticks = None
+        self.s = None
+        self._setup_socket()
+
+    def _setup_socket(self):
+        try:
+            if self.s:
+                self.s.close()
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.s.bind((self.ip, self.port))
+            self.s.settimeout(0) # non-blocking: recvfrom คืนทันทีถ้าไม่มีข้อมูล
+            print(f"Modbus UDP Server ({self.framer.name}) listening on {self.ip}:{self.port}")
+        except Exception as e:
+            print(f"Error setting up Modbus UDP Server socket: {e}")
+            self.s = None
+
+    def rebind(self, ip):
+        self.ip = ip
+        self._setup_socket()
+
+    def poll_for_clients(self):
+        if not self.s:
+            return
+        for _ in range(self.max_datagrams):
+            try:
+                request_adu, addr = self.s.recvfrom(260)
+            except OSError:
+                return # ไม่มี datagram รออยู่
+            request = self.framer.decode(request_adu)
+            if request is None:
+                continue
+            context, unit_id, pdu = request
+            response_adu = self.framer.encode(context, unit_id, self.handler.process_pdu(unit_id, pdu))
+            try:
+                self.s.sendto(response_adu, addr)
+            except OSError:
+                continue
+            if self.first_response_ticks is None:
+                self.first_response_ticks = time.ticks_ms()
+
+    def close(self):
+        if self.s:
+            try:
+                self.s.close()
             finally:
-                conn.close() # ปิดการเชื่อมต่อหลังจากจัดการคำขอ (Modbus TCP เป็น stateless ต่อหนึ่ง Transaction)
-                # print(f"Connection from {addr} closed.")
-        except socket.timeout:
-            pass # ไม่มี Client ใหม่กำลังรอ, ดำเนินการต่อ
-        except OSError as e:
-            # print(f"Server accept error: {e}")
-            pass
\ No newline at end of file
+                self.s = None
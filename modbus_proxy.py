@@ -0,0 +1,467 @@
+# modbus_proxy.py
+# Transparent proxy Modbus TCP -> Modbus RTU: ส่งต่อ request ทุก Function Code ไปยัง slave บน RS-485 ตามที่ได้รับ
+# (ไม่ผ่าน register image) ใช้ใน ok/main.py
+#   - client ต่อค้างไว้ได้หลายตัวพร้อมกัน (persistent session) และส่ง request ต่อกันได้หลายชุดโดยไม่ต้องรอคำตอบ
+#   - ทุก request เข้า FIFO ที่จำกัดขนาด พร้อม tag (session, transaction id, unit id)
+#   - bus ทำทีละ transaction: เว้นช่วงเงียบ t3.5 ระหว่าง frame และ timeout ตามความยาว request/response จริง
+#   - Response ต้องผ่าน Slave ID + CRC แล้วตัด Slave ID/CRC ออกก่อนห่อเป็น MBAP ด้วย transaction id เดิม
+#     แล้วส่งกลับไปที่ session ที่ถามมา (ถ้า session ปิดไปแล้วก็ทิ้ง)
+#   - queue เต็ม หรือ client ค้างเกิน max_pending ตอบ Exception 0x06 (Slave Device Busy) ทันที
+#   - slave ไม่ตอบ/CRC ผิด ตอบ Exception 0x0B (Gateway Target Device Failed to Respond)
+#   - unit id 0 (broadcast) ไม่มี Response: รอแค่ turnaround แล้วทำ request ถัดไป ไม่ตอบ client
+#   - Response เขียนลง tx buffer ของ session แล้วส่งแบบ non-blocking: ส่วนที่ส่งไม่หมด/EAGAIN ส่งต่อรอบหน้า
+#
+# Admission control (กัน client ตัวเดียวจอง bus หลายวินาที):
+#   - ทุก request มี deadline = เวลาที่รับ + client_timeout_ms (เวลาที่ client รอคำตอบ)
+#   - ประเมินเวลาบน bus ของแต่ละ request (ความยาว frame ทั้งสองทาง + t3.5 + turnaround) ถ้างานที่รออยู่
+#     ทั้งหมดบวก request นี้เสร็จไม่ทัน deadline ตอบ 0x06 ทันทีแทนการต่อคิวไปเรื่อยๆ
+#   - token bucket ต่อ IP ของ client: เติมเวลา bus ให้ client_share % ของเวลาจริง สะสมได้ไม่เกิน burst_ms
+#     request ที่เวลา bus เกินเครดิตที่เหลือตอบ 0x06
+#   - request ที่เลย deadline ระหว่างรอคิวถูกทิ้งก่อนถึง bus (client เลิกรอไปแล้ว ไม่ตอบ)
+#
+# Prefetch (prefetch=True, HMI มักถามช่วง register เดิมเป็นคาบคงที่):
+#   - ตารางความถี่ขนาดคงที่ prefetch_slots ช่อง ต่อ read request (unit id, FC 01-04, start, quantity)
+#     เก็บเวลาที่ถามล่าสุด คาบที่เรียนได้ และ score = จำนวนครั้งที่มาตรงคาบ (คลาด ±25% ได้)
+#     เต็มแล้วแทนที่ช่องที่ score ต่ำสุด
+#   - ช่องที่ score >= prefetch_min_score ถูกอ่านล่วงหน้าตอน bus ว่าง (queue ว่าง) ก่อนเวลาที่คาดว่า client
+#     จะถามเท่ากับเวลาบน bus + prefetch_lead_ms แล้วเก็บ Response ไว้
+#   - read request ที่มี Response อายุไม่เกิน prefetch_max_age_ms ตอบจาก cache ทันทีโดยไม่ใช้ bus
+#     write (FC 05/06/0F/10/16/17) ไปที่ unit ใดล้าง cache ของ unit นั้น
+#   - prefetch ที่ไม่มี client ใช้ก่อนหมดอายุ (หรือ slave ไม่ตอบ) นับเป็นเวลา bus ที่เสียเปล่า (wasted_ms)
+#     และลด score ลงต่ำกว่าเกณฑ์ (ต้องมาตรงคาบอีกครั้งจึง prefetch ต่อ)
+import socket
+import time
+from array import array
+from modbus_transport import MBAP_FRAMER, MAX_TCP_ADU, TCPSession
+from modbus_dispatch import SLAVE_DEVICE_BUSY, GATEWAY_TARGET_FAILED
+
+MAX_RTU_RESPONSE = 256
+_READ_FCS = (0x01, 0x02, 0x03, 0x04)
+_WRITE_FCS = (0x05, 0x06, 0x0F, 0x10, 0x16, 0x17)
+
+def expected_response_length(pdu):
+    """ความยาว RTU Response (รวม Slave ID + CRC) ที่คาดไว้จาก request PDU ใช้คำนวณ timeout"""
+    fc = pdu[0]
+    if len(pdu) >= 5:
+        quantity = (pdu[3] << 8) | pdu[4]
+        if fc in (0x01, 0x02):
+            return 5 + ((quantity + 7) >> 3)
+        if fc in (0x03, 0x04):
+            return 5 + quantity * 2
+    if fc in (0x05, 0x06, 0x0F, 0x10):
+        return 8
+    return MAX_RTU_RESPONSE # ไม่รู้ล่วงหน้า: เผื่อขนาดสูงสุด
+
+def bus_cost_us(timing, pdu):
+    """เวลาที่ request หนึ่งครอบครอง bus โดยประมาณ: request + response บนสาย + t3.5 สองช่วง + turnaround"""
+    return (timing.frame_us(len(pdu) + 3 + expected_response_length(pdu)) + 2 * timing.t35_us
+            + timing.turnaround_ms * 1000)
+
+class ProxySession(TCPSession):
+    """client 1 ตัว: buffer รับ/ส่งของ TCPSession + จำนวน request ที่ยังไม่ได้ตอบ"""
+    def __init__(self, conn, addr):
+        super().__init__(conn, addr)
+        self.pending = 0
+        self.closed = False
+
+class ModbusProxy:
+    def __init__(self, ip, port, master, timing, max_sessions=4, max_queue=16, max_pending=8,
+                 idle_timeout_ms=60000, client_timeout_ms=2000, client_share=50, burst_ms=1000,
+                 prefetch=False, prefetch_slots=8, prefetch_max_age_ms=300, prefetch_lead_ms=50,
+                 prefetch_min_score=3):
+        self.ip = ip
+        self.port = port
+        self.master = master # ModbusRTUMaster ของ bus ที่ส่งต่อ
+        self.timing = timing # RTUTiming ของ bus เดียวกัน
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.max_pending = max_pending         # request ค้างต่อ client ได้ไม่เกินนี้
+        self.idle_timeout_ms = idle_timeout_ms # ปิด session ที่เงียบนานเกินนี้ (client หายไปโดยไม่ปิด)
+        self.client_timeout_ms = client_timeout_ms # deadline ของ request นับจากเวลาที่รับ
+        self.client_share = client_share           # ส่วนแบ่งเวลา bus สูงสุดต่อ IP (%)
+        self.burst_us = burst_ms * 1000            # เครดิตเวลา bus สะสมสูงสุดต่อ IP
+        self.bucket_tokens = {} # IP -> เครดิตเวลา bus ที่เหลือ (us)
+        self.bucket_time = {}   # IP -> ticks_ms ที่เติมเครดิตล่าสุด
+        self.backlog_us = 0     # เวลา bus โดยประมาณของ request ที่รอใน queue + ที่กำลังทำ
+        self.sock = None
+        self.sessions = []
+        self.queue = []      # FIFO ของ (session, transaction id, unit id, PDU, deadline, cost)
+        self.current = None  # request ที่กำลังทำบน bus
+        self.idle_since = time.ticks_us() # เวลาที่ bus ว่างล่าสุด (เริ่มนับ t3.5)
+        self.requests = 0
+        self.replies = 0
+        self.rejected = 0
+        self.failures = 0
+        self.expired = 0
+        # Prefetch: ตารางความถี่ของ read request แบบ parallel arrays (index = slot)
+        self.prefetch = prefetch
+        self.max_age_ms = prefetch_max_age_ms
+        self.lead_ms = prefetch_lead_ms
+        self.min_score = prefetch_min_score
+        self.pf_index = {}                                # unit id + PDU ของ read request -> slot
+        self.pf_key = [None] * prefetch_slots
+        self.pf_seen = array('L', [0] * prefetch_slots)   # ticks_ms ที่ client ถามล่าสุด
+        self.pf_period = array('L', [0] * prefetch_slots) # คาบที่เรียนได้ (ms)
+        self.pf_score = bytearray(prefetch_slots)         # จำนวนครั้งที่มาตรงคาบ (ไม่เกิน 255)
+        self.pf_armed = bytearray(prefetch_slots)         # 1 = ยังไม่ได้ prefetch ให้การถามครั้งถัดไป
+        self.pf_data = [None] * prefetch_slots            # Response PDU ที่ cache ไว้
+        self.pf_time = array('L', [0] * prefetch_slots)   # ticks_ms ที่ได้ Response
+        self.pf_cost = array('L', [0] * prefetch_slots)   # เวลา bus ของ prefetch ที่ยังไม่มี client ใช้ (us)
+        self.prefetch_slot = -1 # slot ของ prefetch ที่กำลังทำบน bus
+        self.prefetches = 0
+        self.cache_hits = 0
+        self.cache_misses = 0   # read request ที่ต้องไปถาม slave จริง
+        self.wasted_us = 0
+        self._setup_socket()
+
+    def _setup_socket(self):
+        addr = socket.getaddrinfo(self.ip, self.port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(self.max_sessions)
+        self.sock.settimeout(0) # non-blocking: accept คืนทันทีถ้าไม่มี client
+        print(f"Modbus proxy listening on {self.ip}:{self.port}")
+
+    def rebind(self, ip):
+        self.close()
+        self.ip = ip
+        self._setup_socket()
+
+    def close(self):
+        for session in list(self.sessions):
+            self._drop(session)
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def poll(self):
+        """รับ client/request ใหม่ และเดิน transaction บน bus 1 ขั้น (ไม่บล็อก) เรียกจาก main loop ทุกรอบ"""
+        if self.sock:
+            self._accept()
+            for session in list(self.sessions):
+                self._read(session)
+        self._run_bus()
+        for session in list(self.sessions):
+            if session.tx_len:
+                self._flush(session) # ส่วนที่ส่งไม่หมดรอบก่อน
+
+    # --- ฝั่ง TCP ---
+
+    def _accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except OSError:
+            return
+        if len(self.sessions) >= self.max_sessions:
+            print(f"Modbus proxy: refusing {addr}, {len(self.sessions)} sessions open")
+            conn.close()
+            return
+        conn.settimeout(0)
+        self.sessions.append(ProxySession(conn, addr))
+        print(f"Modbus proxy: client {addr} connected")
+
+    def _read(self, session):
+        n = session.recv(MAX_TCP_ADU)
+        if n < 0:
+            self._drop(session) # client ปิดการเชื่อมต่อ หรือ ECONNRESET / ENOTCONN ฯลฯ
+            return
+        if not n:
+            # ยังไม่มีข้อมูล: ปิดเฉพาะ session ที่เงียบนานและไม่มี request ค้าง
+            if not session.pending and time.ticks_diff(time.ticks_ms(), session.last_rx) > self.idle_timeout_ms:
+                self._drop(session)
+            return
+        rx = session.rx
+        # แยก request ทั้งหมดที่ครบแล้วใน buffer (client ส่งต่อกันหลายชุดได้)
+        while True:
+            total = MBAP_FRAMER.frame_length(rx)
+            if total <= 0:
+                if total < 0:
+                    print(f"Modbus proxy: bad MBAP length from {session.addr}, closing")
+                    self._drop(session)
+                return
+            request = MBAP_FRAMER.decode(rx[:total])
+            del rx[:total]
+            if request is not None:
+                self._enqueue(session, request[0], request[1], bytes(request[2]))
+
+    def _enqueue(self, session, trans_id, unit_id, pdu):
+        self.requests += 1
+        if self.prefetch and unit_id and self._from_cache(session, trans_id, unit_id, pdu):
+            return
+        cost = bus_cost_us(self.timing, pdu)
+        if (len(self.queue) >= self.max_queue or session.pending >= self.max_pending
+                or (self.backlog_us + cost) // 1000 > self.client_timeout_ms # ทำไม่ทัน deadline แน่นอน
+                or not self._take_tokens(session.addr[0], cost)):
+            self.rejected += 1
+            self._reply_exception(session, trans_id, unit_id, pdu[0], SLAVE_DEVICE_BUSY)
+            return
+        deadline = time.ticks_add(time.ticks_ms(), self.client_timeout_ms)
+        self.queue.append((session, trans_id, unit_id, pdu, deadline, cost))
+        self.backlog_us += cost
+        session.pending += 1
+
+    def _take_tokens(self, ip, cost):
+        """หักเครดิตเวลา bus ของ IP นี้ คืนค่า False ถ้าเครดิตไม่พอ (ไม่หัก)"""
+        now = time.ticks_ms()
+        tokens = self.bucket_tokens.get(ip)
+        if tokens is None:
+            if len(self.bucket_tokens) >= 4 * self.max_sessions:
+                self._prune_buckets(now)
+            tokens = self.burst_us
+        else:
+            tokens = min(self.burst_us, tokens + time.ticks_diff(now, self.bucket_time[ip]) * self.client_share * 10)
+        self.bucket_time[ip] = now
+        if tokens < cost:
+            self.bucket_tokens[ip] = tokens
+            return False
+        self.bucket_tokens[ip] = tokens - cost
+        return True
+
+    def _prune_buckets(self, now):
+        """ลบ bucket ของ IP ที่เครดิตเต็มแล้ว (ไม่ต่างจากเริ่มใหม่) เพื่อไม่ให้ dict โตไม่จำกัด"""
+        refill = self.burst_us // (self.client_share * 10) + 1
+        for ip in list(self.bucket_tokens):
+            if time.ticks_diff(now, self.bucket_time[ip]) > refill:
+                del self.bucket_tokens[ip]
+                del self.bucket_time[ip]
+
+    def _reply(self, session, trans_id, unit_id, pdu):
+        """เขียน Response ลง tx buffer ของ session แล้วส่งเท่าที่ socket รับได้"""
+        if session.closed:
+            return # client ปิดไปแล้วระหว่างรอ bus
+        if not session.append(MBAP_FRAMER, trans_id, unit_id, pdu):
+            if not self._flush(session) or not session.append(MBAP_FRAMER, trans_id, unit_id, pdu):
+                print(f"Modbus proxy: {session.addr} not reading replies, closing")
+                self._drop(session) # client ไม่รับข้อมูล buffer เต็ม
+                return
+        self.replies += 1
+        self._flush(session)
+
+    def _flush(self, session):
+        """ส่งข้อมูลที่รอใน tx buffer คืนค่า False ถ้า session ถูกปิด (EAGAIN = ลองใหม่รอบหน้า)"""
+        if session.flush() < 0:
+            print(f"Modbus proxy: send to {session.addr} failed, closing")
+            self._drop(session)
+            return False
+        return True
+
+    def _reply_exception(self, session, trans_id, unit_id, fc, code):
+        self._reply(session, trans_id, unit_id, bytes([fc | 0x80, code]))
+
+    def _drop(self, session):
+        if session.closed:
+            return
+        session.closed = True
+        session.close()
+        self.sessions.remove(session)
+        print(f"Modbus proxy: client {session.addr} closed")
+
+    # --- Prefetch ---
+
+    def _from_cache(self, session, trans_id, unit_id, pdu):
+        """เรียนรู้ pattern ของ request แล้วตอบจาก cache ถ้ามี Response ที่ยังสด คืนค่า True ถ้าตอบแล้ว"""
+        if pdu[0] in _WRITE_FCS:
+            self._invalidate(unit_id)
+            return False
+        if pdu[0] not in _READ_FCS or len(pdu) != 5:
+            return False
+        now = time.ticks_ms()
+        i = self._observe(bytes([unit_id]) + pdu, now)
+        if not self._fresh(i, now):
+            return False
+        self._serve(i, session, trans_id, unit_id)
+        return True
+
+    def _observe(self, key, now):
+        """บันทึกการถาม 1 ครั้งลงตารางความถี่ คืนค่า slot"""
+        i = self.pf_index.get(key)
+        if i is None:
+            i = self._evict()
+            self.pf_key[i] = key
+            self.pf_index[key] = i
+            self.pf_period[i] = 0
+            self.pf_score[i] = 0
+        else:
+            interval = time.ticks_diff(now, self.pf_seen[i])
+            period = self.pf_period[i]
+            if period and interval < self.max_age_ms and interval * 2 < period:
+                return i # client อื่นถามช่วงเดียวกันซ้ำ: ไม่ใช่คาบใหม่
+            if period and abs(interval - period) <= period >> 2:
+                self.pf_period[i] = (3 * period + interval) >> 2
+                if self.pf_score[i] < 255:
+                    self.pf_score[i] += 1
+            else:
+                self.pf_score[i] >>= 1
+                if not self.pf_score[i]:
+                    self.pf_period[i] = interval
+        self.pf_seen[i] = now
+        self.pf_armed[i] = 1
+        return i
+
+    def _evict(self):
+        """slot ว่าง หรือ slot ที่ score ต่ำสุด (เท่ากันเลือกที่ถามนานที่สุด)"""
+        victim = 0
+        now = time.ticks_ms()
+        for i in range(len(self.pf_key)):
+            if self.pf_key[i] is None:
+                return i
+            if (self.pf_score[i], -time.ticks_diff(now, self.pf_seen[i])) < \
+                    (self.pf_score[victim], -time.ticks_diff(now, self.pf_seen[victim])):
+                victim = i
+        if self.pf_cost[victim]:
+            self.wasted_us += self.pf_cost[victim]
+            self.pf_cost[victim] = 0
+        del self.pf_index[self.pf_key[victim]]
+        self.pf_data[victim] = None
+        return victim
+
+    def _fresh(self, i, now):
+        return self.pf_data[i] is not None and time.ticks_diff(now, self.pf_time[i]) <= self.max_age_ms
+
+    def _serve(self, i, session, trans_id, unit_id):
+        self.cache_hits += 1
+        self.pf_cost[i] = 0 # prefetch ได้ใช้แล้ว
+        self._reply(session, trans_id, unit_id, self.pf_data[i])
+
+    def _store(self, i, data, cost):
+        if self.pf_cost[i]:
+            self._waste(i) # prefetch ก่อนหน้ายังไม่มีใครใช้
+        self.pf_data[i] = data
+        self.pf_time[i] = time.ticks_ms()
+        self.pf_cost[i] = cost
+
+    def _waste(self, i):
+        self.wasted_us += self.pf_cost[i]
+        self.pf_cost[i] = 0
+        if self.pf_score[i] >= self.min_score:
+            self.pf_score[i] = self.min_score - 1
+
+    def _invalidate(self, unit_id):
+        """ค่าของ unit นี้อาจเปลี่ยนหลัง write: ทิ้ง cache ทั้งหมดของ unit"""
+        for i in range(len(self.pf_key)):
+            key = self.pf_key[i]
+            if key is not None and key[0] == unit_id:
+                self.wasted_us += self.pf_cost[i]
+                self.pf_cost[i] = 0
+                self.pf_data[i] = None
+
+    def _next_prefetch(self, now):
+        """slot ที่ถึงเวลาอ่านล่วงหน้า หรือ -1 (ไล่ทุก slot และนับ prefetch ที่หมดอายุโดยไม่มีใครใช้)"""
+        found = -1
+        for i in range(len(self.pf_key)):
+            if self.pf_cost[i] and not self._fresh(i, now):
+                self._waste(i)
+            if found >= 0 or not self.pf_armed[i] or self.pf_score[i] < self.min_score:
+                continue
+            key = self.pf_key[i]
+            # เวลา (ms) จนถึงครั้งที่คาดว่า client จะถาม
+            ahead = time.ticks_diff(time.ticks_add(self.pf_seen[i], self.pf_period[i]), now)
+            if ahead > self.lead_ms + bus_cost_us(self.timing, key[1:]) // 1000:
+                continue
+            self.pf_armed[i] = 0
+            if ahead >= 0: # เลยเวลาไปแล้ว: client ไม่ได้ถามตามคาบ ไม่อ่านรอ
+                found = i
+        return found
+
+    def _start_prefetch(self, i):
+        key = self.pf_key[i]
+        pdu = key[1:]
+        cost = bus_cost_us(self.timing, pdu)
+        self.current = (None, 0, key[0], pdu, 0, cost)
+        self.prefetch_slot = i
+        self.backlog_us += cost
+        self.prefetches += 1
+        self.master.begin_request(key[0], pdu, self.timing.response_timeout_ms(len(pdu) + 3,
+                                                                           expected_response_length(pdu)))
+
+    def _prefetch_done(self, unit_id, pdu, result, cost):
+        i = self.prefetch_slot
+        self.prefetch_slot = -1
+        key = self.pf_key[i]
+        if key is None or key[0] != unit_id or key[1:] != pdu:
+            self.wasted_us += cost # slot ถูกแทนที่ระหว่างรอ Response
+        elif result is False or result[0] & 0x80:
+            self.pf_cost[i] = cost
+            self._waste(i)
+        else:
+            self._store(i, bytes(result), cost)
+
+    # --- ฝั่ง RS-485 ---
+
+    def _run_bus(self):
+        if self.current is not None:
+            result = self.master.poll_response()
+            if result is None:
+                return
+            session, trans_id, unit_id, pdu, deadline, cost = self.current
+            self.current = None
+            self.backlog_us -= cost
+            self.idle_since = self.master.done_us # t3.5 นับจากไบต์สุดท้ายบนสาย
+            if session is None:
+                self._prefetch_done(unit_id, pdu, result, cost)
+                return
+            session.pending -= 1
+            if self.prefetch and pdu[0] in _WRITE_FCS:
+                self._invalidate(unit_id) # prefetch ที่ทำก่อน write เสร็จอาจเป็นค่าเก่า
+            if unit_id == 0:
+                return # broadcast: slave ไม่ตอบ
+            if result is False:
+                self.failures += 1
+                self._reply_exception(session, trans_id, unit_id, pdu[0], GATEWAY_TARGET_FAILED)
+            else:
+                self._reply(session, trans_id, unit_id, result)
+                if self.prefetch and not result[0] & 0x80:
+                    i = self.pf_index.get(bytes([unit_id]) + pdu)
+                    if i is not None:
+                        self._store(i, bytes(result), 0) # client อื่นที่ถามช่วงเดียวกันใช้ต่อได้
+            return
+
+        # เว้นช่วงเงียบ t3.5 หลัง transaction ก่อนหน้า ก่อนส่ง frame ถัดไป
+        timing = self.timing
+        while self.queue and time.ticks_diff(time.ticks_us(), self.idle_since) >= timing.t35_us:
+            entry = self.queue.pop(0)
+            session, trans_id, unit_id, pdu, deadline, cost = entry
+            if session.closed:
+                self.backlog_us -= cost
+                continue # client ปิดไปแล้ว ไม่ต้องถาม slave
+            if time.ticks_diff(time.ticks_add(time.ticks_ms(), cost // 1000), deadline) > 0:
+                # เสร็จไม่ทัน deadline แล้ว: client เลิกรอไปแล้ว ไม่เสียเวลา bus
+                self.backlog_us -= cost
+                session.pending -= 1
+                self.expired += 1
+                continue
+            if self.prefetch and unit_id:
+                i = self.pf_index.get(bytes([unit_id]) + pdu)
+                if i is not None:
+                    if self._fresh(i, time.ticks_ms()):
+                        # prefetch เสร็จระหว่างที่ request นี้รอคิว
+                        self.backlog_us -= cost
+                        session.pending -= 1
+                        self._serve(i, session, trans_id, unit_id)
+                        continue
+                    self.cache_misses += 1
+            if unit_id == 0:
+                timeout_ms = timing.turnaround_ms # เวลาให้ slave ประมวลผล broadcast
+            else:
+                timeout_ms = timing.response_timeout_ms(len(pdu) + 3, expected_response_length(pdu))
+            self.current = entry
+            self.master.begin_request(unit_id, pdu, timeout_ms)
+            return
+        if (self.prefetch and not self.queue
+                and time.ticks_diff(time.ticks_us(), self.idle_since) >= timing.t35_us):
+            i = self._next_prefetch(time.ticks_ms())
+            if i >= 0:
+                self._start_prefetch(i)
+
+    def stats(self):
+        stats = {"sessions": len(self.sessions), "queued": len(self.queue), "requests": self.requests,
+                 "replies": self.replies, "rejected": self.rejected, "expired": self.expired,
+                 "failures": self.failures, "backlog_ms": self.backlog_us // 1000}
+        if self.prefetch:
+            reads = self.cache_hits + self.cache_misses
+            stats.update({"prefetches": self.prefetches, "cache_hits": self.cache_hits,
+                          "cache_misses": self.cache_misses,
+                          "hit_rate": self.cache_hits * 100 // reads if reads else 0,
+                          "wasted_ms": self.wasted_us // 1000})
+        return stats
@@ -8,22 +8,25 @@ import time    # สำหรับจัดการเวลา
 # from modbus_rtu_master import ModbusRTUMaster
 # from modbus_tcp_server import ModbusTCPServer
 
-# --- การตั้งค่า Wi-Fi ---
-WIFI_SSID = "wifi-ice" # เปลี่ยนเป็นชื่อ Wi-Fi ของคุณ
-WIFI_PASSWORD = "06062523" # เปลี่ยนเป็นรหัสผ่าน Wi-Fi ของคุณ
-STATIC_IP = ('192.168.1.100', '255.255.255.0', '192.168.1.1', '8.8.8.8') # IP, Subnet, Gateway, DNS
+from bridge_config import load_config
+
+# --- การตั้งค่าทั้งหมดอยู่ใน config.json (ใส่ "static_ip": [IP, Subnet, Gateway, DNS] ในส่วน "wifi") ---
+_cfg = load_config()
+WIFI_SSID = _cfg["wifi"]["ssid"]
+WIFI_PASSWORD = _cfg["wifi"]["password"]
+STATIC_IP = tuple(_cfg["wifi"]["static_ip"] or ('192.168.1.100', '255.255.255.0', '192.168.1.1', '8.8.8.8')) # IP, Subnet, Gateway, DNS
 
 # --- การตั้งค่า Modbus RTU ---
-UART_ID = 1          # ใช้ UART 1 สำหรับ Modbus RTU
-UART_TX_PIN = 5      # GPIO5 สำหรับ UART1 TX
-UART_RX_PIN = 4      # GPIO4 สำหรับ UART1 RX
-MAX485_DE_RE_PIN = 2 # GPIO2 สำหรับขา DE/RE ของ MAX485
-MODBUS_RTU_BAUDRATE = 9600 # อัตรา Baud rate ของอุปกรณ์ Modbus RTU ของคุณ
-MODBUS_SLAVE_ID = 1
+UART_ID = _cfg["bus"]["uart_id"]
+UART_TX_PIN = _cfg["bus"]["tx_pin"]
+UART_RX_PIN = _cfg["bus"]["rx_pin"]
+MAX485_DE_RE_PIN = _cfg["bus"]["de_re_pin"]
+MODBUS_RTU_BAUDRATE = _cfg["bus"]["baudrate"]
+MODBUS_SLAVE_ID = _cfg["blocks"][0]["slave"]
 
 # พื้นที่เก็บข้อมูลส่วนกลางสำหรับ Holding Registers (สำหรับเชื่อมข้อมูล RTU ไปยัง TCP)
-# เริ่มต้นด้วยศูนย์สำหรับ 100 registers
-holding_registers = [0] * 100
+# เริ่มต้นด้วยศูนย์ตามขนาด image_size ใน config
+holding_registers = [0] * _cfg["image_size"]
 
 def connect_wifi():
     print("กำลังเชื่อมต่อ WiFi...", end="")
@@ -175,7 +178,7 @@ def main():
     rtu_master = RTUMaster(UART_ID, UART_TX_PIN, UART_RX_PIN, MAX485_DE_RE_PIN, MODBUS_RTU_BAUDRATE, MODBUS_SLAVE_ID)
 
     # 3. เริ่มต้น Modbus TCP Server
-    tcp_server = ModbusTCPServer(STATIC_IP[0], 502, holding_registers)
+    tcp_server = ModbusTCPServer(STATIC_IP[0], _cfg["tcp"]["port"], holding_registers)
 
     last_rtu_read_time = time.ticks_ms()
     rtu_read_interval = 1000 # อ่าน RTU ทุก 1 วินาที
@@ -0,0 +1,175 @@
+# modbus_transport.py
+# Framer สำหรับ transport แบบต่างๆ: แยก frame ที่รับมาเป็น (context, unit id, PDU)
+# และห่อ Response PDU กลับเป็น frame ของ transport เดิม
+# ทุก framer ส่ง PDU ให้ ModbusRequestHandler ตัวเดียวกัน จึงใช้ register image ร่วมกัน
+#   MBAP_FRAMER : Modbus TCP มาตรฐาน (MBAP header 7 ไบต์) ใช้ได้ทั้ง TCP และ UDP
+#   RTU_FRAMER  : Modbus RTU frame (Unit ID + PDU + CRC) ที่ส่งผ่าน TCP ตรงๆ (RTU-over-TCP)
+# frame_length() แยก request ที่ส่งต่อกันมาใน stream เดียว (pipelining) และ encode_into() เขียน Response
+# ลง buffer ที่จองไว้แล้วโดยตรง (TCP server รวมหลาย Response เป็นการส่งครั้งเดียว)
+# TCPSession: สถานะของ client 1 ตัวบน socket non-blocking ใช้ร่วมกันทั้ง ModbusTCPServer และ ModbusProxy
+
+# crc16(data, crc=0xFFFF) คำนวณ CRC-16/Modbus คืนค่าเป็น int (ใช้ร่วมกันทั้ง RTU frame และไฟล์ snapshot)
+# ตัวจริงอยู่ใน modbus_kernels (viper บน MicroPython, pure-Python บน CPython)
+import errno
+import time
+from modbus_kernels import crc16, mbap_header
+
+MAX_TCP_ADU = 260 # MBAP header 7 ไบต์ + PDU สูงสุด 253 ไบต์
+TX_BUFFER_SIZE = 1460 # 1 TCP segment (MSS ปกติบน Wi-Fi)
+
+def t35_us(baudrate, bits_per_char=11):
+    """ช่วงเงียบ t3.5 ระหว่าง RTU frame (us) มาตรฐานกำหนดคงที่ 1750 us เมื่อ baud rate สูงกว่า 19200"""
+    return 1750 if baudrate > 19200 else bits_per_char * 3500000 // baudrate
+
+class MBAPFramer:
+    name = "mbap"
+    overhead = 7 # MBAP header
+
+    def frame_length(self, buf):
+        """ความยาวของ request แรกใน buf ถ้ารับครบแล้ว, 0 = ยังไม่ครบ, -1 = header ผิด (เสีย sync)"""
+        if len(buf) < 7:
+            return 0
+        total = 6 + ((buf[4] << 8) | buf[5])
+        if total < 8 or total > MAX_TCP_ADU:
+            return -1
+        return total if total <= len(buf) else 0
+
+    def decode(self, adu):
+        """คืนค่า (transaction id, unit id, PDU) หรือ None ถ้า frame ไม่ถูกต้อง"""
+        # Transaction ID (2) + Protocol ID (2, 0x0000) + Length (2) + Unit ID (1) + PDU
+        if len(adu) < 8: # ความยาว ADU ขั้นต่ำ
+            return None
+        trans_id, protocol_id, length, unit_id = mbap_header(adu) # length = จำนวนไบต์ของ Unit ID + PDU
+        if protocol_id: # Protocol ID ต้องเป็น 0x0000 สำหรับ Modbus
+            return None
+        if length < 2 or 6 + length > len(adu):
+            return None
+        return trans_id, unit_id, adu[7:6 + length]
+
+    def encode(self, trans_id, unit_id, pdu):
+        length = len(pdu) + 1
+        return bytes([trans_id >> 8, trans_id & 0xFF, 0, 0, length >> 8, length & 0xFF, unit_id]) + pdu
+
+    def encode_into(self, buf, pos, trans_id, unit_id, pdu):
+        """เขียน Response ADU ลง buf ที่ตำแหน่ง pos คืนค่าตำแหน่งถัดไป"""
+        n = len(pdu)
+        buf[pos] = trans_id >> 8
+        buf[pos + 1] = trans_id & 0xFF
+        buf[pos + 2] = 0
+        buf[pos + 3] = 0
+        buf[pos + 4] = (n + 1) >> 8
+        buf[pos + 5] = (n + 1) & 0xFF
+        buf[pos + 6] = unit_id
+        buf[pos + 7:pos + 7 + n] = pdu
+        return pos + 7 + n
+
+# ความยาว RTU request ตาม Function Code (Unit ID + PDU + CRC) สำหรับแยก request ที่ส่งต่อกันมา
+_RTU_REQUEST_LENGTH = {0x01: 8, 0x02: 8, 0x03: 8, 0x04: 8, 0x05: 8, 0x06: 8, 0x41: 12}
+
+class RTUFramer:
+    name = "rtu"
+    overhead = 3 # Unit ID + CRC
+
+    def frame_length(self, buf):
+        """ความยาวของ request แรกใน buf (0 = ยังไม่ครบ) Function Code ที่ไม่รู้ความยาวถือว่าทั้ง buf เป็น frame เดียว"""
+        n = len(buf)
+        if n < 2:
+            return 0
+        fc = buf[1]
+        total = _RTU_REQUEST_LENGTH.get(fc, 0)
+        if fc in (0x0F, 0x10):
+            if n < 7:
+                return 0
+            total = 9 + buf[6] # Unit ID + FC + address + quantity + byte count + data + CRC
+        elif not total:
+            return n
+        return total if total <= n else 0
+
+    def decode(self, frame):
+        """คืนค่า (None, unit id, PDU) หรือ None ถ้าสั้นเกินไปหรือ CRC ผิด (ตามมาตรฐาน RTU จะไม่ตอบ)"""
+        n = len(frame)
+        if n < 4:
+            return None
+        if crc16(memoryview(frame)[:n - 2]) != (frame[n - 2] | (frame[n - 1] << 8)):
+            return None
+        return None, frame[0], frame[1:n - 2]
+
+    def encode(self, context, unit_id, pdu):
+        frame = bytearray(len(pdu) + 3)
+        frame[0] = unit_id
+        frame[1:len(pdu) + 1] = pdu
+        crc = crc16(memoryview(frame)[:len(pdu) + 1])
+        frame[-2] = crc & 0xFF
+        frame[-1] = crc >> 8
+        return frame
+
+    def encode_into(self, buf, pos, context, unit_id, pdu):
+        n = len(pdu)
+        buf[pos] = unit_id
+        buf[pos + 1:pos + 1 + n] = pdu
+        end = pos + 1 + n
+        crc = crc16(memoryview(buf)[pos:end])
+        buf[end] = crc & 0xFF
+        buf[end + 1] = crc >> 8
+        return end + 2
+
+MBAP_FRAMER = MBAPFramer()
+RTU_FRAMER = RTUFramer()
+FRAMERS = {"mbap": MBAP_FRAMER, "rtu": RTU_FRAMER}
+
+def _again(e):
+    return bool(e.args) and e.args[0] == errno.EAGAIN
+
+class TCPSession:
+    """client 1 ตัว: buffer รับ (request ต่อกันได้หลายชุด) + buffer ส่งที่จองไว้ครั้งเดียว
+    socket เป็น non-blocking: EAGAIN = ยังไม่มีข้อมูล/send buffer เต็ม ลองใหม่รอบหน้า error อื่น = ปิด session"""
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.rx = bytearray()
+        self.tx = bytearray(TX_BUFFER_SIZE)
+        self.tx_mv = memoryview(self.tx)
+        self.tx_len = 0
+        self.last_rx = time.ticks_ms()
+
+    def recv(self, size):
+        """รับข้อมูลต่อท้าย rx คืนค่าจำนวนไบต์, 0 = ยังไม่มีข้อมูล (EAGAIN), -1 = client ปิดหรือ socket ใช้ไม่ได้"""
+        try:
+            data = self.conn.recv(size)
+        except OSError as e:
+            return 0 if _again(e) else -1
+        if not data:
+            return -1
+        self.last_rx = time.ticks_ms()
+        self.rx += data
+        return len(data)
+
+    def append(self, framer, context, unit_id, pdu):
+        """เขียน Response ต่อท้าย tx buffer คืนค่า False ถ้าที่ไม่พอ (ให้ flush() ก่อนแล้วลองใหม่)"""
+        if self.tx_len + len(pdu) + framer.overhead > TX_BUFFER_SIZE:
+            return False
+        self.tx_len = framer.encode_into(self.tx, self.tx_len, context, unit_id, pdu)
+        return True
+
+    def flush(self):
+        """ส่งข้อมูลที่รอใน tx buffer ด้วย write ครั้งเดียว ส่วนที่ส่งไม่หมดเลื่อนไปต้น buffer ส่งต่อรอบหน้า
+        คืนค่าจำนวนไบต์ที่ส่งได้ (0 = ไม่มีข้อมูลหรือ EAGAIN) หรือ -1 ถ้า socket ใช้ไม่ได้"""
+        pending = self.tx_len
+        if not pending:
+            return 0
+        try:
+            sent = self.conn.send(self.tx_mv[:pending])
+        except OSError as e:
+            return 0 if _again(e) else -1
+        if not sent:
+            return 0
+        if sent < pending:
+            self.tx[:pending - sent] = bytes(self.tx_mv[sent:pending])
+        self.tx_len = pending - sent
+        return sent
+
+    def close(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
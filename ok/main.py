@@ -1,117 +1,70 @@
-import network, socket, struct, time
-from machine import UART, Pin
+# ok/main.py: transparent proxy Modbus TCP -> RTU (ดู modbus_proxy.py)
+# ใช้โมดูลจากโฟลเดอร์หลักของ repo: deploy ด้วย "python build_mpy.py --deploy --ok"
+# (คัดลอก ok/boot.py, ok/main.py, ok/config.json และโมดูลใน build_mpy.OK_MODULES ลงบอร์ด)
+import time
+from machine import Pin
+from wifi_supervisor import WiFiSupervisor
+from bridge_config import load_config
+from modbus_lib import ModbusRTUMaster
+from modbus_proxy import ModbusProxy
+from rtu_bus import RTUTiming
 
-# 🔧 Wi-Fi config
-SSID = 'wifi-ice'
-PASSWORD = '06062523'
+# 🔧 config ทั้งหมดอยู่ใน config.json (ดู ok/config.json)
+cfg = load_config()
+SSID = cfg['wifi']['ssid']
+PASSWORD = cfg['wifi']['password']
+BUS = cfg['bus']
+TCP_PORT = cfg['tcp']['port']
+PROXY = cfg['proxy']
 
 # 🟢 LED แสดงสถานะ (GPIO8)
-status_led = Pin(8, Pin.OUT)
+status_led = Pin(cfg['led_pin'], Pin.OUT)
 
-# 📡 สร้างและเชื่อมต่อ Wi-Fi
-wlan = network.WLAN(network.STA_IF)
-wlan.active(True)
+# ⚙️ RS-485 / Modbus RTU: proxy ส่งต่อ request จาก client ไปที่ slave ทีละ transaction (ดู modbus_proxy.py)
+master = ModbusRTUMaster(BUS['uart_id'], BUS['tx_pin'], BUS['rx_pin'], BUS['de_re_pin'], BUS['baudrate'], 1,
+                         echo=BUS.get('echo', False))
+timing = RTUTiming(BUS['baudrate'], turnaround_ms=BUS.get('turnaround_ms', 100))
 
-def connect_wifi():
-    if not wlan.isconnected():
-        print("📶 Connecting Wi-Fi...")
-        wlan.connect(SSID, PASSWORD)
-        for i in range(20):
-            if wlan.isconnected():
-                break
-            status_led.value(i % 2)  # กระพริบ
-            time.sleep(1)
-        status_led.value(1)
+# 📡 Wi-Fi supervisor: reconnect แบบ back-off โดยไม่บล็อก loop หลัก
+proxy = None
 
-def update_led():
-    if wlan.isconnected():
-        status_led.value(0)  # ติดค้าง
+def on_ip_change(ip):
+    global proxy
+    print("✅ Wi-Fi IP:", ip)
+    if proxy:
+        proxy.rebind(ip)  # สร้าง listening socket ใหม่ทุกครั้งที่ได้ IP ใหม่ (session เดิมถูกปิด)
     else:
-        status_led.value(0)
-        time.sleep(0.3)
-        status_led.value(1)
-        time.sleep(0.3)
-
-# 🛠️ เรียกเชื่อมต่อ Wi-Fi
-connect_wifi()
-print("✅ Wi-Fi IP:", wlan.ifconfig()[0] if wlan.isconnected() else "❌ No connection")
-
-# ⚙️ RS-485 / Modbus RTU config
-uart = UART(1, baudrate=9600, tx=20, rx=21)
-de = Pin(7, Pin.OUT)
-de.value(0)
-
-# 🔄 CRC16 สำหรับ Modbus RTU
-def crc16(data):
-    crc = 0xFFFF
-    for b in data:
-        crc ^= b
-        for _ in range(8):
-            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
-    return crc
+        proxy = ModbusProxy(ip, TCP_PORT, master, timing, max_sessions=PROXY['max_sessions'],
+                            max_queue=PROXY['max_queue'], max_pending=PROXY['max_pending'],
+                            idle_timeout_ms=PROXY['idle_timeout_ms'],
+                            client_timeout_ms=PROXY['client_timeout_ms'],
+                            client_share=PROXY['client_share'], burst_ms=PROXY['burst_ms'],
+                            prefetch=PROXY['prefetch'], prefetch_slots=PROXY['prefetch_slots'],
+                            prefetch_max_age_ms=PROXY['prefetch_max_age_ms'],
+                            prefetch_lead_ms=PROXY['prefetch_lead_ms'],
+                            prefetch_min_score=PROXY['prefetch_min_score'])
 
-# 📥 อ่านค่าจาก Modbus RTU slave
-def modbus_read_holding(slave_id, start_addr, quantity, retries=3):
-    func = 0x03
-    req = struct.pack('>BBHH', slave_id, func, start_addr, quantity)
-    req += struct.pack('<H', crc16(req))
+wifi = WiFiSupervisor(SSID, PASSWORD, on_ip_change=on_ip_change)
 
-    for attempt in range(retries):
-        try:
-            de.value(1)  # ส่ง
-            uart.write(req)
-            time.sleep(0.01)
-            de.value(0)  # รับ
-            time.sleep(0.05)
-            resp = uart.read()
-            if resp and len(resp) >= 5:
-                return resp
-            else:
-                print(f"⚠️ Empty RTU response (try {attempt+1})")
-        except Exception as e:
-            print(f"❌ RTU error: {e}")
-        time.sleep(0.1)
-    print("⛔️ RTU retry failed")
-    return None
+_led_toggle = time.ticks_ms()
 
-# 🌐 Modbus TCP server
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(('', 502))
-server.listen(1)
-print("🧭 TCP server started on port 502")
+def update_led():
+    global _led_toggle
+    if wifi.isconnected():
+        status_led.value(0)  # ติดค้าง
+    elif time.ticks_diff(time.ticks_ms(), _led_toggle) >= 300:
+        _led_toggle = time.ticks_ms()
+        status_led.value(not status_led.value())  # กระพริบ
 
-# 🔁 Loop: handle TCP request
+# 🔁 Loop: Wi-Fi + proxy (ไม่บล็อก: หลาย client ค้าง request ไว้พร้อมกันได้)
+_report = time.ticks_ms()
 while True:
-    if not wlan.isconnected():
-        print("🔄 Wi-Fi lost, reconnecting...")
-        connect_wifi()
+    wifi.poll()
     update_led()
-
-    try:
-        client, addr = server.accept()
-        print("🔌 TCP client:", addr)
-        req = client.recv(1024)
-        if not req or len(req) < 12:
-            client.close()
-            continue
-
-        trans_id = req[0:2]
-        unit_id = req[6]
-        func_code = req[7]
-        start = struct.unpack('>H', req[8:10])[0]
-        qty = struct.unpack('>H', req[10:12])[0]
-
-        rtu_resp = modbus_read_holding(unit_id, start, qty)
-        if rtu_resp:
-            tcp_resp = trans_id + b'\x00\x00' + struct.pack('>H', len(rtu_resp)+1)
-            tcp_resp += bytes([unit_id]) + rtu_resp[1:]  # ตัด slave ID
-            client.send(tcp_resp)
-        else:
-            # Optional: ส่ง exception frame กลับ
-            error_code = func_code | 0x80
-            tcp_resp = trans_id + b'\x00\x00\x00\x03' + bytes([unit_id, error_code, 0x0B])
-            client.send(tcp_resp)
-        client.close()
-    except Exception as e:
-        print("⚠️ TCP error:", e)
-        time.sleep(1)
\ No newline at end of file
+    if proxy is None:
+        time.sleep_ms(10)
+        continue
+    proxy.poll()
+    if time.ticks_diff(time.ticks_ms(), _report) >= 60000:
+        _report = time.ticks_ms()
+        print("📊 proxy:", proxy.stats())
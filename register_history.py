@@ -0,0 +1,339 @@
+# register_history.py
+# ประวัติค่า register บนบอร์ด: ring ของ "page" (bytearray ที่จองไว้ตั้งแต่เริ่ม) เก็บ sample ของ block พร้อมเวลา
+# ให้ client ดึงย้อนหลังช่วงที่ Wi-Fi หลุดได้หลังต่อใหม่ (ไม่ใช่แค่ค่าล่าสุดใน holding_registers)
+# ระหว่าง offline (Wi-Fi หลุด) page ที่เต็มจะถูกเขียนลง flash ด้วย (spill) ทำให้เก็บย้อนหลังได้นานกว่า RAM
+# ตอน online ไม่เขียน flash เพื่อไม่ให้สึกหรอโดยไม่จำเป็น
+# threaded mode: record() ถูกเรียกจาก RTU worker thread ส่วน HistoryServer อ่าน page จาก main thread
+# ทั้งสองฝั่งใช้ image.lock (การเขียน record/ล้าง page และการคัดลอก chunk ออกไปส่ง) จึงไม่เห็น page ที่เขียนค้างครึ่ง
+#
+# record : seq (4) + time.time() (4) + block (1) + count (1)   little-endian
+#          + ค่า register (2 ไบต์ต่อค่า, big-endian แบบ Modbus)
+# page ไม่มี header: record แรกของ page อยู่ที่ offset 0 และพื้นที่ที่เหลือเป็น 0 (count = 0 = จบ page)
+#
+# ดึงข้อมูลผ่าน TCP (HistoryServer): client ส่ง "MBHR" + seq เริ่มต้น (4, little-endian)
+# gateway ตอบ "MBHR" + version (1) + seq เก่าสุดที่มี (4) ตามด้วย record ต่อกันทั้งหมด
+# และปิดท้ายด้วย record header ที่ count = 0 ซึ่ง seq คือ seq ถัดไป (ใช้เป็นจุดเริ่มครั้งหน้า)
+import errno
+import socket
+import struct
+import time
+from array import array
+from modbus_codec import encode_registers, decode_registers
+
+HISTORY_MAGIC = b'MBHR'
+HISTORY_VERSION = 1
+_RECORD_FMT = '<LLBB'
+_RECORD_SIZE = struct.calcsize(_RECORD_FMT)
+_REPLY_FMT = '<4sBL'
+
+class RegisterHistory:
+    def __init__(self, image, pages=8, page_size=1024, interval_ms=0, spill_path=None, spill_pages=64):
+        if page_size < _RECORD_SIZE + 250:
+            raise ValueError("history page too small for a 125-register record")
+        self.image = image
+        self.page_size = page_size
+        self.pages = [bytearray(page_size) for _ in range(pages)]
+        self.page_fill = array('H', [0] * pages)
+        self.page_seq = array('L', [0] * pages) # seq ของ record แรกใน page
+        self.current = 0                        # page ที่กำลังเขียน
+        self.used = 1                           # จำนวน page ที่มีข้อมูล (รวม page ปัจจุบัน)
+        self.next_seq = 1
+        self.interval_ms = interval_ms          # เก็บ sample ของ block เดียวกันไม่บ่อยกว่านี้ (0 = ทุกครั้งที่ poll)
+        self.last_record = [None] * image.num_blocks()
+        self._zero = bytes(page_size)
+        # Spill ลง flash: ไฟล์เดียวขนาด spill_pages page วนเขียนทับ page เก่าสุด
+        self.spill_path = spill_path
+        self.spill_pages = spill_pages
+        self.spill_seq = array('L', [0] * spill_pages) # seq ของ record แรกในแต่ละ slot (0 = ว่าง)
+        self.spill_next = 0
+        self.offline = False                    # main.py ตั้งเป็น True ระหว่าง Wi-Fi หลุด
+        self.records = 0
+        self.spilled = 0
+        if spill_path:
+            self._load_spill_index()
+
+    def record(self, block):
+        """บันทึกค่าปัจจุบันของ block ใน image (เรียกหลัง update_block สำเร็จ)"""
+        now = time.ticks_ms()
+        last = self.last_record[block]
+        if last is not None and self.interval_ms and time.ticks_diff(now, last) < self.interval_ms:
+            return
+        self.last_record[block] = now
+        with self.image.lock:
+            self._append(block)
+
+    def _append(self, block):
+        image = self.image
+        count = image.block_count[block]
+        size = _RECORD_SIZE + count * 2
+        if self.page_fill[self.current] + size > self.page_size:
+            self._next_page()
+        page = self.pages[self.current]
+        pos = self.page_fill[self.current]
+        if pos == 0:
+            self.page_seq[self.current] = self.next_seq
+        struct.pack_into(_RECORD_FMT, page, pos, self.next_seq, int(time.time()), block, count)
+        pos += _RECORD_SIZE
+        pos += encode_registers(image.registers, image.block_offset[block], count, page, pos)
+        self.page_fill[self.current] = pos
+        self.next_seq += 1
+        self.records += 1
+
+    def _next_page(self):
+        if self.spill_path and self.offline:
+            self._spill(self.current)
+        self.current = (self.current + 1) % len(self.pages)
+        if self.used < len(self.pages):
+            self.used += 1
+        # page ที่จะใช้ต่อคือ page เก่าสุด: ล้างให้เป็น 0 (record ที่ count = 0 = จบ page)
+        page = self.pages[self.current]
+        page[:] = self._zero
+        self.page_fill[self.current] = 0
+
+    # --- flash spill ---
+
+    def _spill(self, index):
+        try:
+            try:
+                f = open(self.spill_path, "r+b")
+            except OSError:
+                f = open(self.spill_path, "w+b")
+            with f:
+                f.seek(self.spill_next * self.page_size)
+                f.write(self.pages[index])
+            self.spill_seq[self.spill_next] = self.page_seq[index]
+            self.spill_next = (self.spill_next + 1) % self.spill_pages
+            self.spilled += 1
+        except OSError as e:
+            print(f"register_history: spill to {self.spill_path} failed: {e}")
+
+    def _load_spill_index(self):
+        """อ่าน seq ของ record แรกในแต่ละ slot ของไฟล์ spill (ข้อมูลจากก่อนรีบูตยังดึงได้)"""
+        try:
+            with open(self.spill_path, "rb") as f:
+                for slot in range(self.spill_pages):
+                    f.seek(slot * self.page_size)
+                    header = f.read(_RECORD_SIZE)
+                    if len(header) < _RECORD_SIZE:
+                        break
+                    seq, t, block, count = struct.unpack(_RECORD_FMT, header)
+                    if count:
+                        self.spill_seq[slot] = seq
+        except OSError:
+            return
+        newest = 0
+        for slot in range(self.spill_pages):
+            if self.spill_seq[slot] > self.spill_seq[newest]:
+                newest = slot
+        if self.spill_seq[newest]:
+            self.spill_next = (newest + 1) % self.spill_pages
+            # seq ต่อจากไฟล์เดิม (ค่าประมาณ: ไม่ต้องรู้จำนวน record ใน page สุดท้ายพอดี)
+            self.next_seq = self.spill_seq[newest] + self.page_size // _RECORD_SIZE
+
+    # --- อ่านย้อนหลัง ---
+
+    def oldest_seq(self):
+        seqs = [s for s in self.spill_seq if s] if self.spill_path else []
+        first = self._ram_order()[0]
+        if self.page_fill[first]:
+            seqs.append(self.page_seq[first])
+        return min(seqs) if seqs else self.next_seq
+
+    def _ram_order(self):
+        """index ของ page ใน RAM เรียงจากเก่าไปใหม่"""
+        n = len(self.pages)
+        return [(self.current - self.used + 1 + i) % n for i in range(self.used)]
+
+    def chunks(self, since):
+        """คืนค่า generator ของ memoryview ของ record ที่ seq >= since เรียงจากเก่าไปใหม่ (ทีละ page)
+        ต้องเรียก next() และคัดลอก chunk ออกภายใต้ image.lock (page อาจถูกเขียนทับหลังปล่อย lock)
+        page ที่ถูกเขียนทับระหว่างส่งไม่ทำให้ส่งซ้ำหรือย้อนลำดับ: ข้าม record ที่ seq ไม่ใหม่กว่าที่ส่งไปแล้ว"""
+        ram = self._ram_order()
+        ram_first = self.page_seq[ram[0]] if self.page_fill[ram[0]] else self.next_seq
+        if self.spill_path and since < ram_first:
+            slots = sorted((s, i) for i, s in enumerate(self.spill_seq) if s and s < ram_first)
+            for n, (seq, slot) in enumerate(slots):
+                following = slots[n + 1][0] if n + 1 < len(slots) else ram_first
+                if following <= since:
+                    continue # page นี้เก่ากว่าที่ขอทั้งหมด
+                try:
+                    with open(self.spill_path, "rb") as f:
+                        f.seek(slot * self.page_size)
+                        page = f.read(self.page_size)
+                except OSError:
+                    continue
+                chunk = self._page_records(page, len(page), since, ram_first)
+                if chunk:
+                    since = chunk[1]
+                    yield chunk[0]
+        for index in ram:
+            chunk = self._page_records(self.pages[index], self.page_fill[index], since, self.next_seq)
+            if chunk:
+                since = chunk[1]
+                yield chunk[0]
+
+    def _page_records(self, page, fill, since, stop):
+        """ส่วนของ page ที่มี record seq ในช่วง [since, stop) และ seq ถัดจาก record สุดท้าย หรือ None"""
+        pos = 0
+        first = -1
+        last = since
+        while pos + _RECORD_SIZE <= fill:
+            seq, t, block, count = struct.unpack_from(_RECORD_FMT, page, pos)
+            if count == 0 or seq >= stop:
+                break
+            if seq >= since:
+                if first < 0:
+                    first = pos
+                last = seq + 1
+            elif first >= 0:
+                break # record เก่ากว่าตามหลัง (ไม่ควรเกิด): ส่งแค่ส่วนที่เรียงแล้ว
+            pos += _RECORD_SIZE + count * 2
+        if first < 0:
+            return None
+        return memoryview(page)[first:pos], last
+
+    def stats(self):
+        return {"records": self.records, "next_seq": self.next_seq, "ram_pages": self.used,
+                "spilled": self.spilled}
+
+def iter_records(data):
+    """แยก record ออกจาก bytes ที่ได้จาก HistoryServer: คืนค่า generator ของ (seq, time, block, values)
+    หยุดที่ record ที่ count = 0 (ตัวปิดท้าย)"""
+    pos = 0
+    while pos + _RECORD_SIZE <= len(data):
+        seq, t, block, count = struct.unpack_from(_RECORD_FMT, data, pos)
+        pos += _RECORD_SIZE
+        if count == 0:
+            return
+        yield seq, t, block, decode_registers(data, pos, count)
+        pos += count * 2
+
+class HistoryServer:
+    """ส่งประวัติย้อนหลังเป็น stream ก้อนใหญ่ทาง TCP แบบไม่บล็อก: socket เป็น non-blocking
+    รับ request 8 ไบต์สะสมข้ามหลายรอบ poll และส่งทีละส่วนเท่าที่ socket รับได้ (ที่เหลือส่งรอบหน้า)"""
+    def __init__(self, ip, port, history, request_timeout_ms=2000):
+        self.ip = ip
+        self.port = port
+        self.history = history
+        self.request_timeout_ms = request_timeout_ms # client ที่ไม่ส่ง request/ไม่รับข้อมูลนานเกินนี้ถูกปิด
+        self.sock = None
+        self.client = None
+        self.pending = None # generator ของ chunk ที่ยังส่งไม่หมด (None = ยังรอ request)
+        self.done = False   # ส่ง record ปิดท้ายไปแล้ว
+        self.request = bytearray(8)
+        self.request_len = 0
+        self.tx = bytearray(history.page_size) # chunk ที่กำลังส่ง (จองครั้งเดียว)
+        self.tx_mv = memoryview(self.tx)
+        self.tx_pos = 0
+        self.tx_len = 0
+        self.last_io = 0    # ticks_ms ที่รับ/ส่งได้ล่าสุด
+        self._setup_socket()
+
+    def _setup_socket(self):
+        addr = socket.getaddrinfo(self.ip, self.port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(1)
+        self.sock.settimeout(0) # non-blocking: accept คืนทันทีถ้าไม่มี client
+        print(f"History server listening on {self.ip}:{self.port}")
+
+    def rebind(self, ip):
+        self.close()
+        self.ip = ip
+        self._setup_socket()
+
+    def poll_for_clients(self):
+        if self.client is None:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            conn.settimeout(0)
+            self.client = conn
+            self.request_len = 0
+            self.tx_pos = self.tx_len = 0
+            self.last_io = time.ticks_ms()
+            return
+        try:
+            if self.pending is None:
+                self._receive_request()
+            else:
+                self._send()
+        except OSError as e:
+            if e.args and e.args[0] == errno.EAGAIN:
+                # ยังไม่มีข้อมูล/send buffer เต็ม: ลองใหม่รอบหน้า เว้นแต่ client เงียบนานเกินไป
+                if time.ticks_diff(time.ticks_ms(), self.last_io) > self.request_timeout_ms:
+                    print("History client timed out")
+                    self._finish()
+                return
+            print(f"History transfer failed: {e}")
+            self._finish()
+
+    def _receive_request(self):
+        data = self.client.recv(8 - self.request_len)
+        if not data:
+            self._finish() # client ปิดก่อนส่ง request ครบ
+            return
+        self.last_io = time.ticks_ms()
+        self.request[self.request_len:self.request_len + len(data)] = data
+        self.request_len += len(data)
+        if self.request_len < 8:
+            return
+        if self.request[:4] != HISTORY_MAGIC:
+            self._finish()
+            return
+        since = struct.unpack_from('<L', self.request, 4)[0]
+        self.tx_len = struct.calcsize(_REPLY_FMT)
+        with self.history.image.lock:
+            oldest = self.history.oldest_seq()
+        struct.pack_into(_REPLY_FMT, self.tx, 0, HISTORY_MAGIC, HISTORY_VERSION, oldest)
+        self.tx_pos = 0
+        self.pending = self.history.chunks(since)
+        self.done = False
+
+    def _send(self):
+        if self.tx_pos >= self.tx_len:
+            if not self._next_chunk():
+                self._finish()
+                return
+        sent = self.client.send(self.tx_mv[self.tx_pos:self.tx_len])
+        if sent:
+            self.tx_pos += sent
+            self.last_io = time.ticks_ms()
+
+    def _next_chunk(self):
+        """คัดลอก chunk ถัดไปลง tx buffer คืนค่า False เมื่อส่งครบแล้ว (รวม record ปิดท้าย)"""
+        if self.done:
+            return False
+        with self.history.image.lock: # threaded mode: worker เขียน page เดียวกันไม่ได้ระหว่างคัดลอก
+            # next() แบบมีค่า default ต้องใช้ MICROPY_PY_BUILTINS_NEXT2 ซึ่ง port ESP32 ไม่เปิด
+            try:
+                chunk = next(self.pending)
+            except StopIteration:
+                chunk = None
+            if chunk is not None:
+                n = len(chunk)
+                self.tx_mv[:n] = chunk
+        if chunk is None:
+            struct.pack_into(_RECORD_FMT, self.tx, 0, self.history.next_seq, int(time.time()), 0, 0)
+            self.tx_len = _RECORD_SIZE
+            self.done = True # ส่ง record ปิดท้ายนี้แล้วจบ
+        else:
+            self.tx_len = n
+        self.tx_pos = 0
+        return True
+
+    def _finish(self):
+        if self.client:
+            self.client.close()
+        self.client = None
+        self.pending = None
+        self.request_len = 0
+        self.tx_pos = self.tx_len = 0
+
+    def close(self):
+        self._finish()
+        if self.sock:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,318 @@
+# register_image.py
+# Register image ส่วนกลางที่ฝั่ง RTU เขียน และฝั่ง TCP อ่าน
+# แบ่งเป็น "block" ตามการ poll แต่ละครั้ง (slave, start, count) เพื่อเก็บสถานะแยกกันได้
+# ติดตามการเปลี่ยนแปลง (report-by-exception): ทุกครั้งที่ poll แล้วมีค่าเปลี่ยน (เกิน deadband)
+# change_seq จะเพิ่มขึ้น 1 และ register ที่เปลี่ยนจะจำ seq นั้นไว้ใน reg_seq ทำให้ตอบได้ว่า
+# "อะไรเปลี่ยนบ้างตั้งแต่ seq N" โดยไม่ต้องเก็บประวัติ
+#
+# Double buffer (threaded mode, enable_double_buffer): ฝั่ง RTU (worker thread) เขียนลง self.back เท่านั้น
+# แล้วสลับ reference self.registers <-> self.back ภายใต้ lock ครั้งเดียวต่อ block ฝั่ง TCP อ่าน self.registers
+# ภายใต้ lock เดียวกัน (ถือไว้แค่ตอนคัดลอกค่าออก ไม่เคยรอ serial I/O) จึงเห็น block ครบทั้งก้อนเสมอ
+# ค่า 32-bit ที่อยู่ใน block เดียวกันไม่มีทางได้ word ครึ่งเก่าครึ่งใหม่
+# โหมดปกติ (thread เดียว) self.back คือ self.registers และ lock เป็น NO_LOCK ที่ไม่ทำอะไร
+import time
+from array import array
+from modbus_codec import decode_into, encode_registers
+
+# คุณภาพของข้อมูลในแต่ละ block
+QUALITY_NONE = 0     # ยังไม่เคยมีข้อมูล (ค่าเป็น 0)
+QUALITY_RESTORED = 1 # ค่าที่โหลดมาจาก snapshot ใน flash (stale จนกว่าจะ poll สำเร็จ)
+QUALITY_GOOD = 2     # ค่าจากการ poll RTU ที่สำเร็จ
+QUALITY_FAILED = 3   # poll ครั้งล่าสุดล้มเหลว ค่าใน image คือค่าจากครั้งที่สำเร็จก่อนหน้า
+
+# นโยบายเมื่อข้อมูลใน block เก่าเกิน max_age_ms
+POLICY_SERVE = 0     # ให้บริการค่าเดิมต่อไป (ค่าเริ่มต้น)
+POLICY_EXCEPTION = 1 # ตอบ Exception 0x0B (Gateway Target Device Failed to Respond)
+
+NO_BLOCK = 0xFF      # ค่าใน block_of สำหรับ register ที่ไม่อยู่ใน block ใด
+AGE_UNKNOWN = 0xFFFF # ค่าใน shadow age register เมื่อ block ยังไม่เคยมีข้อมูล live
+
+EXC_GATEWAY_TARGET_FAILED = 0x0B
+
+class _NoLock:
+    """lock ที่ไม่ทำอะไร ใช้กับ with ได้เหมือน _thread lock (โหมด thread เดียว)"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_LOCK = _NoLock()
+
+class RegisterImage:
+    def __init__(self, size):
+        self.size = size
+        self.registers = array('H', [0] * size) # 16-bit unsigned ต่อ register (2 ไบต์ แทน object ของ list)
+        self.back = self.registers # buffer ที่ฝั่ง RTU เขียน (คนละ array กับ registers เมื่อเปิด double buffer)
+        self.lock = NO_LOCK
+        # ข้อมูลของแต่ละ block เก็บแยกเป็น array ขนานกัน (index เดียวกัน = block เดียวกัน)
+        self.block_slave = bytearray()
+        self.block_start = array('H')   # address เริ่มต้นฝั่ง RTU
+        self.block_count = array('H')   # จำนวน register
+        self.block_offset = array('H')  # ตำแหน่งเริ่มต้นใน self.registers
+        self.block_time = array('L')    # time.time() ของค่าล่าสุด (วินาที) ใช้บันทึกลง snapshot
+        self.quality = bytearray()
+        self.dirty = False              # มีข้อมูลใหม่ที่ยังไม่ได้บันทึก snapshot
+        # Freshness: ticks_ms ของการ poll สำเร็จล่าสุด และนโยบายเมื่อข้อมูลเก่า (ต่อ block)
+        self.last_ok = array('L')
+        self.fail_count = array('H')     # จำนวนครั้งที่ poll ล้มเหลวติดต่อกัน
+        self.policy = bytearray()
+        self.max_age_ms = array('L')
+        self.age_register = array('h')   # ตำแหน่ง shadow register ที่แสดงอายุข้อมูล (วินาที), -1 = ไม่มี
+        self.block_seq = array('L')      # change seq ล่าสุดที่มี register ใน block เปลี่ยน
+        # เพิ่มขึ้นทุกครั้งที่ตาราง block หรือ slave address เปลี่ยน (ผู้ที่ cache request frame ใช้ตรวจว่าต้อง compile ใหม่)
+        self.layout_version = 0
+        # block_of[i] = index ของ block ที่ register i อยู่ ทำให้ตรวจ freshness ได้ O(1) ต่อ request
+        self.block_of = bytearray(b'\xff' * size)
+        # Change tracking: seq ล่าสุดของ image และ seq ที่แต่ละ register เปลี่ยนครั้งล่าสุด
+        self.change_seq = 0
+        self.reg_seq = array('L', [0] * size)
+        # Deadband ต่อ register (สร้างเมื่อมีการตั้งค่าเท่านั้น) และค่าที่รายงานล่าสุดที่ใช้เทียบ
+        self.deadband = None
+        self.reported = None
+        # ค่าเดิมของ block ที่กำลังอัปเดต (big-endian เหมือน payload) ใช้เทียบกับ Response ทั้งก้อน
+        self._old = bytearray(250)
+        self._old_mv = memoryview(self._old)
+
+    def enable_double_buffer(self, lock):
+        """เปิด double buffer สำหรับ RTU worker thread: lock = _thread.allocate_lock()"""
+        self.back = array('H', self.registers)
+        self.lock = lock
+
+    def _publish(self, changed, offset=0, count=0):
+        """ทำให้ค่าใน back buffer มองเห็นได้จากฝั่ง TCP: สลับ reference ภายใต้ lock แล้วคัดลอกช่วง
+        [offset, offset + count) ที่เพิ่งเขียนลง buffer ที่สลับออกมา (หลังสลับแล้วไม่มี reader ใช้ buffer นั้นอยู่)
+        ส่วนอื่นของทั้งสอง buffer เท่ากันอยู่แล้ว changed = เลื่อน change_seq ไปพร้อมกัน"""
+        if self.back is self.registers:
+            if changed:
+                self.change_seq += 1
+            return
+        with self.lock:
+            self.registers, self.back = self.back, self.registers
+            if changed:
+                self.change_seq += 1
+        if count:
+            memoryview(self.back)[offset:offset + count] = memoryview(self.registers)[offset:offset + count]
+
+    def add_block(self, slave_id, rtu_start, count, offset=None):
+        """เพิ่ม block ที่จะ poll และคืนค่า index ของ block (offset = ตำแหน่งใน image, ค่าเริ่มต้นคือต่อท้าย block ก่อนหน้า)"""
+        if offset is None:
+            offset = 0
+            if len(self.block_offset):
+                offset = self.block_offset[-1] + self.block_count[-1]
+        if offset + count > self.size:
+            raise ValueError("block does not fit in register image")
+        if len(self.quality) >= NO_BLOCK:
+            raise ValueError("too many blocks")
+        self.block_slave.append(slave_id)
+        self.block_start.append(rtu_start)
+        self.block_count.append(count)
+        self.block_offset.append(offset)
+        self.block_time.append(0)
+        self.quality.append(QUALITY_NONE)
+        self.last_ok.append(0)
+        self.fail_count.append(0)
+        self.policy.append(POLICY_SERVE)
+        self.max_age_ms.append(0)
+        self.age_register.append(-1)
+        self.block_seq.append(0)
+        self.layout_version += 1
+        index = len(self.quality) - 1
+        for i in range(offset, offset + count):
+            self.block_of[i] = index
+        return index
+
+    def set_policy(self, index, policy=POLICY_SERVE, max_age_ms=0, age_register=-1):
+        """กำหนดนโยบายข้อมูลเก่าของ block: POLICY_SERVE / POLICY_EXCEPTION (หลังเก่าเกิน max_age_ms)
+        และตำแหน่ง shadow register สำหรับแสดงอายุข้อมูลเป็นวินาที (ถ้าต้องการ)"""
+        if age_register >= self.size:
+            raise ValueError("age register outside register image")
+        self.policy[index] = policy
+        self.max_age_ms[index] = max_age_ms
+        self.age_register[index] = age_register
+
+    def set_slave(self, index, slave_id):
+        """เปลี่ยน slave address ของ block (เช่นหลังเปลี่ยนอุปกรณ์) request frame ที่ cache ไว้จะถูก compile ใหม่"""
+        if self.block_slave[index] != slave_id:
+            self.block_slave[index] = slave_id
+            self.layout_version += 1
+
+    def set_deadband(self, index, deadband):
+        """กำหนด deadband ของ register ใน block: ค่าเดียวทั้ง block หรือ list ต่อ register
+        register ที่มี deadband จะถือว่าเปลี่ยนเมื่อต่างจากค่าที่รายงานล่าสุดเกิน deadband เท่านั้น"""
+        if self.deadband is None:
+            self.deadband = array('H', [0] * self.size)
+            self.reported = array('H', self.registers)
+        offset = self.block_offset[index]
+        for i in range(self.block_count[index]):
+            self.deadband[offset + i] = deadband[i] if isinstance(deadband, (list, tuple)) else deadband
+
+    def changed_since(self, slot, since):
+        """register ที่ slot เปลี่ยนหลัง seq since หรือไม่ (since = 0 หรือมากกว่า seq ปัจจุบัน เช่นหลังรีบูต = ทั้งหมด)"""
+        return since == 0 or since > self.change_seq or self.reg_seq[slot] > since
+
+    def num_blocks(self):
+        return len(self.quality)
+
+    def update_block(self, index, values):
+        """คัดลอกค่าที่อ่านได้จาก RTU ลง image, บันทึกการเปลี่ยนแปลง และตั้งคุณภาพเป็น GOOD"""
+        regs = self.back
+        offset = self.block_offset[index]
+        n = min(len(values), self.block_count[index])
+        if not isinstance(values, array):
+            values = array('H', values)
+        # ทางลัด: payload เหมือนค่าใน image ทุกไบต์ (กรณีส่วนใหญ่) ไม่ต้องเทียบทีละ register
+        changed = regs[offset:offset + n] != values[:n] and self._apply_changes(offset, values, n)
+        self._block_updated(index, changed, offset, n)
+
+    def update_block_payload(self, index, payload):
+        """เหมือน update_block แต่รับ payload big-endian ของ Response FC03 (memoryview ใน RX buffer)
+        แล้ว decode ลง back buffer ตรงตำแหน่งของ block ด้วย decode_into (ไม่สร้าง tuple/array กลาง)"""
+        regs = self.back
+        offset = self.block_offset[index]
+        n = min(len(payload) >> 1, self.block_count[index])
+        nbytes = n * 2
+        # ทางลัด: เทียบค่าเดิม (encode เป็น big-endian) กับ payload ทั้งก้อน เหมือนกัน = ไม่ต้องเขียนอะไร
+        encode_registers(regs, offset, n, self._old, 0)
+        changed = False
+        if self._old_mv[:nbytes] != payload[:nbytes]:
+            decode_into(payload, 0, n, regs, offset)
+            changed = self._track_changes(offset, n)
+        self._block_updated(index, changed, offset, n)
+
+    def _block_updated(self, index, changed, offset, n):
+        self._publish(changed, offset, n)
+        if changed:
+            self.block_seq[index] = self.change_seq
+        self.quality[index] = QUALITY_GOOD
+        self.block_time[index] = int(time.time())
+        self.last_ok[index] = time.ticks_ms()
+        self.fail_count[index] = 0
+        self.dirty = True
+
+    def _apply_changes(self, offset, values, n):
+        """เขียนค่าลง back buffer และบันทึก reg_seq ของ register ที่เปลี่ยน (change_seq เลื่อนตอน _publish)"""
+        regs = self.back
+        reg_seq = self.reg_seq
+        deadband = self.deadband
+        reported = self.reported
+        seq = self.change_seq + 1
+        changed = False
+        for i in range(n):
+            slot = offset + i
+            v = values[i]
+            if deadband is not None and deadband[slot]:
+                if abs(v - reported[slot]) > deadband[slot]:
+                    reported[slot] = v
+                    reg_seq[slot] = seq
+                    changed = True
+            elif regs[slot] != v:
+                reg_seq[slot] = seq
+                changed = True
+            regs[slot] = v
+        return changed
+
+    def _track_changes(self, offset, n):
+        """บันทึก reg_seq ของ register ที่ค่าใน back buffer ต่างจากค่าเดิมใน self._old (เกิน deadband)"""
+        regs = self.back
+        old = self._old
+        reg_seq = self.reg_seq
+        deadband = self.deadband
+        reported = self.reported
+        seq = self.change_seq + 1
+        changed = False
+        for i in range(n):
+            slot = offset + i
+            v = regs[slot]
+            if deadband is not None and deadband[slot]:
+                if abs(v - reported[slot]) > deadband[slot]:
+                    reported[slot] = v
+                    reg_seq[slot] = seq
+                    changed = True
+            elif v != (old[2 * i] << 8) | old[2 * i + 1]:
+                reg_seq[slot] = seq
+                changed = True
+        return changed
+
+    def mark_failed(self, index):
+        """บันทึกว่า poll ของ block ล้มเหลว (ค่าเดิมยังอยู่ แต่อายุจะเพิ่มขึ้นเรื่อยๆ)"""
+        if self.quality[index] == QUALITY_GOOD:
+            self.quality[index] = QUALITY_FAILED
+        if self.fail_count[index] < 0xFFFF:
+            self.fail_count[index] += 1
+
+    def restore_block(self, index, values, timestamp):
+        """โหลดค่าจาก snapshot: ให้บริการได้ทันทีแต่ถือว่า stale จนกว่าจะ poll สำเร็จ"""
+        regs = self.back
+        offset = self.block_offset[index]
+        n = min(len(values), self.block_count[index])
+        for i in range(n):
+            regs[offset + i] = values[i]
+            if self.reported is not None:
+                self.reported[offset + i] = values[i]
+        self._publish(False, offset, n)
+        self.quality[index] = QUALITY_RESTORED
+        self.block_time[index] = timestamp
+        # นับอายุจากตอนบูต: ถ้าใช้ POLICY_EXCEPTION ค่าจาก snapshot จะให้บริการได้ไม่เกิน max_age_ms
+        self.last_ok[index] = time.ticks_ms()
+
+    def is_stale(self, index):
+        return self.quality[index] != QUALITY_GOOD
+
+    def age_ms(self, index, now=None):
+        """อายุข้อมูลของ block (ms) นับจาก poll สำเร็จล่าสุด (หรือจากตอนโหลด snapshot), -1 ถ้ายังไม่มีข้อมูล"""
+        if self.quality[index] == QUALITY_NONE:
+            return -1
+        if now is None:
+            now = time.ticks_ms()
+        return time.ticks_diff(now, self.last_ok[index])
+
+    def check_range(self, offset, count):
+        """ตรวจ freshness ของช่วง register ที่ TCP ขอ คืนค่า exception code (0 = ให้บริการได้)
+        ดูเฉพาะ block ที่ช่วงนี้ครอบคลุม (ปกติ 1-2 block) ไม่ได้วนทุก register"""
+        block_of = self.block_of
+        pos = offset
+        end = offset + count
+        now = None
+        while pos < end:
+            b = block_of[pos]
+            if b == NO_BLOCK:
+                pos += 1
+                continue
+            if self.policy[b] == POLICY_EXCEPTION:
+                if now is None:
+                    now = time.ticks_ms()
+                age = self.age_ms(b, now)
+                if age < 0 or age > self.max_age_ms[b]:
+                    return EXC_GATEWAY_TARGET_FAILED
+            pos = self.block_offset[b] + self.block_count[b]
+        return 0
+
+    def update_age_registers(self):
+        """เขียนอายุข้อมูล (วินาที, สูงสุด 0xFFFE) ลง shadow register ของแต่ละ block ที่กำหนดไว้
+        เรียกจาก main loop เป็นระยะ (O(จำนวน block)) ไม่ใช่ทุก request"""
+        now = time.ticks_ms()
+        regs = self.back
+        wrote = False
+        for b in range(len(self.quality)):
+            reg = self.age_register[b]
+            if reg < 0:
+                continue
+            wrote = True
+            if self.quality[b] == QUALITY_GOOD or self.quality[b] == QUALITY_FAILED:
+                regs[reg] = min(self.age_ms(b, now) // 1000, AGE_UNKNOWN - 1)
+            else:
+                regs[reg] = AGE_UNKNOWN # ยังไม่เคยมีข้อมูล live (ว่างหรือมาจาก snapshot)
+        if wrote:
+            self._publish(False)
+            if self.back is not self.registers:
+                for reg in self.age_register: # คัดลอกเฉพาะ age register ที่เพิ่งเขียนกลับลง back
+                    if reg >= 0:
+                        self.back[reg] = self.registers[reg]
+
+    def find_block(self, slave_id, rtu_start, count):
+        for i in range(len(self.quality)):
+            if (self.block_slave[i] == slave_id and self.block_start[i] == rtu_start and
+                    self.block_count[i] == count):
+                return i
+        return -1
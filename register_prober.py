@@ -0,0 +1,133 @@
+# register_prober.py
+# หาช่วง register ที่อ่านได้จริงของ slave แล้วสร้างตาราง poll block ที่ไม่มีวันชนรู (commissioning)
+# มิเตอร์หลายรุ่นตอบ Exception 0x02 ถ้าช่วงที่อ่านมี register ที่ไม่มีอยู่แม้แต่ตัวเดียว การอ่านก้อนใหญ่จึงล้มทั้งก้อน
+#   - ไล่ address ไปทีละช่วง: อ่าน 125 register (หรือถึง end) ได้ = ทั้งช่วงใช้ได้ (probe เดียว)
+#     Exception 0x02/0x03 = มีรูอยู่ในช่วง -> binary search หาความยาวที่อ่านได้ยาวที่สุดจาก address นั้น
+#     (ไม่เกิน 7 probe) ถ้า register แรกเองเป็นรู ไล่ทีละ register จนพ้นรู
+#     ช่วงที่ครบ = 1 probe, รูแต่ละจุด = ราว log2 125 probe, รูยาว L register = L probe
+#   - ช่วงที่อ่านได้และติดกันถูกรวม แล้วตัดเป็น block ละไม่เกิน 125 register = จำนวน read น้อยที่สุดที่ไม่ข้ามรู
+#   - slave ไม่ตอบ (timeout/CRC ผิด) ลองซ้ำ retries ครั้ง ถ้ายังไม่ตอบหยุด probe ของ slave นั้นทันที
+#     (คืนช่วงที่หาได้ถึงตอนนั้น) รูไล่ทีละ register เฉพาะเมื่อ slave ตอบ Exception เท่านั้น
+# ผลลัพธ์เป็น "blocks" แบบเดียวกับใน config.json (save_poll_table เขียนลงไฟล์พร้อม image_size และ tcp_map auto)
+# ทดสอบได้โดยไม่ต้องมี slave จริงด้วย bus_simulator.SimulatedBus (set_map กำหนดรูได้)
+import json
+import time
+from rtu_bus import RTUTiming
+
+MAX_READ = 125
+_HOLE_EXCEPTIONS = (0x02, 0x03) # Illegal Data Address / Illegal Data Value (บางรุ่นใช้กับ quantity ที่ข้ามรู)
+
+class RegisterProber:
+    def __init__(self, master, timing=None, retries=2):
+        self.master = master
+        self.timing = timing or RTUTiming(master.baudrate)
+        self.retries = retries
+        self.probes = 0
+        self.no_response = 0
+
+    def _read(self, slave, start, quantity):
+        """True = อ่านได้ทั้งช่วง, False = มีรู (Exception), None = slave ไม่ตอบ"""
+        master = self.master
+        pdu = bytes([0x03, start >> 8, start & 0xFF, quantity >> 8, quantity & 0xFF])
+        timeout_ms = self.timing.response_timeout_ms(8, 5 + quantity * 2)
+        for attempt in range(self.retries + 1):
+            time.sleep_us(self.timing.t35_us)
+            self.probes += 1
+            master.begin_request(slave, pdu, timeout_ms)
+            result = None
+            while result is None:
+                result = master.poll_response()
+            if result is not False:
+                if not result[0] & 0x80:
+                    return True
+                if result[1] in _HOLE_EXCEPTIONS:
+                    return False
+                print(f"register_prober: slave {slave} exception {result[1]} at {start}+{quantity}")
+                return False
+        self.no_response += 1
+        print(f"register_prober: slave {slave} did not answer {start}+{quantity}")
+        return None
+
+    def readable_ranges(self, slave, start=0, end=1000):
+        """คืนค่า list ของ (start, count) ที่อ่านได้ใน [start, end) เรียงตาม address และรวมช่วงที่ติดกันแล้ว
+        ไล่รูทีละ register เฉพาะเมื่อ slave ตอบ Exception: ถ้า slave ไม่ตอบเลย (ครบ retries) หยุดทันที
+        และคืนช่วงที่หาได้ถึงตอนนั้น (slave ที่ไม่มีอยู่ไม่เสียเวลาไล่ทีละ register ทั้งช่วง)"""
+        ranges = []
+        address = start
+        in_hole = False
+        while address < end:
+            limit = min(MAX_READ, end - address)
+            if in_hole:
+                # อยู่ในรู: ลองทีละ register จนเจอตัวที่อ่านได้ (รูยาว L ใช้ L probe ซึ่งหลีกเลี่ยงไม่ได้)
+                ok = self._read(slave, address, 1)
+                if ok is None:
+                    break
+                if not ok:
+                    address += 1
+                    continue
+                in_hole = False
+            ok = self._read(slave, address, limit)
+            if ok is None:
+                break
+            if ok:
+                count = limit
+            else:
+                ok = self._read(slave, address, 1)
+                if ok is None:
+                    break
+                if not ok:
+                    in_hole = True
+                    address += 1
+                    continue
+                # binary search หาความยาวที่อ่านได้ยาวที่สุดจาก address (อ่านได้ที่ good, ไม่ได้ที่ bad)
+                good, bad = 1, limit
+                while bad - good > 1:
+                    mid = (good + bad) // 2
+                    ok = self._read(slave, address, mid)
+                    if ok is None:
+                        break
+                    if ok:
+                        good = mid
+                    else:
+                        bad = mid
+                count = good
+            if ranges and ranges[-1][0] + ranges[-1][1] == address:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + count)
+            else:
+                ranges.append((address, count))
+            address += count
+            if ok is None:
+                break # หยุดกลาง binary search: เก็บเฉพาะส่วนที่ยืนยันแล้วว่าอ่านได้
+        if address < end:
+            print(f"register_prober: slave {slave} stopped answering at {address}, probe aborted")
+        return ranges
+
+def poll_table(slave, ranges, interval_ms=1000, **extra):
+    """แปลงช่วงที่อ่านได้เป็น block ของ config.json (ไม่เกิน 125 register ต่อ block, ไม่ข้ามรู)"""
+    blocks = []
+    for first, count in ranges:
+        while count > 0:
+            n = min(MAX_READ, count)
+            blk = {"slave": slave, "start": first, "count": n, "interval_ms": interval_ms}
+            blk.update(extra)
+            blocks.append(blk)
+            first += n
+            count -= n
+    return blocks
+
+def save_poll_table(blocks, path="config.json"):
+    """เขียน blocks ลง config พร้อม image_size ที่พอดี และ tcp_map แบบ auto (address เดียวกับฝั่ง RTU)
+    ปิด "probe" ตอนบูตด้วย"""
+    try:
+        with open(path) as f:
+            cfg = json.load(f)
+    except (OSError, ValueError):
+        cfg = {}
+    cfg["blocks"] = blocks
+    cfg["image_size"] = sum(blk["count"] for blk in blocks)
+    cfg["tcp_map"] = [{"auto": True}]
+    probe = cfg.get("probe") or {}
+    probe["enabled"] = False
+    cfg["probe"] = probe
+    with open(path, "w") as f:
+        json.dump(cfg, f)
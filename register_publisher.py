@@ -0,0 +1,181 @@
+# register_publisher.py
+# ส่งค่า register ที่เปลี่ยน (report-by-exception) ออกไปเอง แทนให้ server กลาง poll ผ่าน Modbus TCP
+# ใช้ change tracking ของ RegisterImage (block_seq / reg_seq) จึงไม่ต้องเก็บสำเนาค่าไว้เทียบเอง
+# 1 block = 1 topic ("<topic>/<block>") แต่ละ topic ส่งไม่บ่อยกว่า min_interval_ms
+# ค่าที่เปลี่ยนระหว่างรอ rate limit ไม่หาย: รอบถัดไปจะส่งค่าล่าสุดของทุก register ที่เปลี่ยนตั้งแต่ส่งครั้งก่อน
+#
+# รูปแบบข้อความ:
+#   binary : version (1) + block (1) + change seq (4) + จำนวนช่วง (1)
+#            + ต่อช่วง: slot เริ่มต้น (2) + จำนวน (1) + ค่า register (2 ไบต์ต่อค่า)   ทั้งหมด big-endian
+#   json   : {"seq": N, "block": b, "values": {"<slot>": value, ...}}
+# Transport: UDP (ส่ง datagram ไปยัง collector) หรือ MQTT (ต้องมี umqtt.simple จาก micropython-lib)
+import json
+import socket
+import struct
+import time
+from register_image import QUALITY_NONE
+
+try:
+    from umqtt.simple import MQTTClient
+except ImportError:
+    MQTTClient = None
+
+FORMAT_BINARY = 0
+FORMAT_JSON = 1
+FORMAT_NAMES = {"binary": FORMAT_BINARY, "json": FORMAT_JSON}
+
+PUBLISH_VERSION = 1
+_HEADER_FMT = '>BBLB'
+_RUN_FMT = '>HB'
+_HEADER_SIZE = struct.calcsize(_HEADER_FMT)
+_RUN_SIZE = struct.calcsize(_RUN_FMT)
+
+class UDPTransport:
+    """ส่งแต่ละข้อความเป็น 1 datagram: ความยาว topic (1) + topic + payload"""
+    def __init__(self, host, port):
+        self.addr = socket.getaddrinfo(host, port)[0][-1]
+        self.sock = None
+
+    def send(self, topic, payload):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        topic = topic.encode()
+        self.sock.sendto(bytes([len(topic)]) + topic + payload, self.addr)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+class MQTTTransport:
+    """MQTT QoS 0 ผ่าน umqtt.simple ต่อ broker เมื่อส่งครั้งแรก และต่อใหม่หลัง error (ไม่บ่อยกว่า retry_ms)"""
+    def __init__(self, host, port, client_id, retry_ms=5000):
+        if MQTTClient is None:
+            raise OSError("umqtt.simple is not installed")
+        self.client = MQTTClient(client_id, host, port)
+        self.connected = False
+        self.retry_ms = retry_ms
+        self.last_attempt = None
+
+    def send(self, topic, payload):
+        if not self.connected:
+            now = time.ticks_ms()
+            if self.last_attempt is not None and time.ticks_diff(now, self.last_attempt) < self.retry_ms:
+                raise OSError("MQTT broker not connected")
+            self.last_attempt = now
+            self.client.connect()
+            self.connected = True
+        try:
+            self.client.publish(topic, payload)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.connected:
+            try:
+                self.client.disconnect()
+            except OSError:
+                pass
+        self.connected = False
+
+class RegisterPublisher:
+    def __init__(self, image, transport, fmt=FORMAT_BINARY, topic="modbus", min_interval_ms=1000):
+        self.image = image
+        self.transport = transport
+        self.fmt = fmt
+        self.topic = topic
+        self.min_interval_ms = min_interval_ms
+        n = image.num_blocks()
+        self.topics = [f"{topic}/{b}" for b in range(n)]
+        self.sent_seq = [0] * n         # change seq ที่ส่งไปแล้วของแต่ละ block
+        self.last_publish = [None] * n  # None = ยังไม่เคยส่ง (ครั้งแรกส่งทั้ง block)
+        self.messages = 0
+        self.errors = 0
+
+    def poll(self):
+        """ส่งข้อความของ block ที่มีค่าเปลี่ยนและพ้น rate limit แล้ว คืนค่าจำนวนข้อความที่ส่ง"""
+        image = self.image
+        now = time.ticks_ms()
+        sent = 0
+        for b in range(image.num_blocks()):
+            if image.quality[b] == QUALITY_NONE:
+                continue # ยังไม่มีข้อมูล
+            last = self.last_publish[b]
+            if last is not None:
+                if image.block_seq[b] <= self.sent_seq[b]:
+                    continue # ไม่มีอะไรเปลี่ยนตั้งแต่ส่งครั้งก่อน
+                if time.ticks_diff(now, last) < self.min_interval_ms:
+                    continue
+            with image.lock: # threaded mode: ค่าที่ส่งเป็นชุดเดียวกับ change seq
+                seq = image.change_seq
+                payload = self.encode(b, self.sent_seq[b] if last is not None else 0, seq)
+            try:
+                self.transport.send(self.topics[b], payload)
+            except OSError as e:
+                self.errors += 1
+                print(f"register_publisher: publish of block {b} failed: {e}")
+                return sent # ลองใหม่รอบถัดไป
+            self.sent_seq[b] = seq
+            self.last_publish[b] = now
+            self.messages += 1
+            sent += 1
+        return sent
+
+    def _runs(self, block, since):
+        """ช่วงต่อเนื่อง (slot, count) ของ register ใน block ที่เปลี่ยนหลัง seq since"""
+        image = self.image
+        offset = image.block_offset[block]
+        end = offset + image.block_count[block]
+        runs = []
+        slot = offset
+        while slot < end:
+            if not image.changed_since(slot, since):
+                slot += 1
+                continue
+            first = slot
+            while slot < end and slot - first < 255 and image.changed_since(slot, since):
+                slot += 1
+            runs.append((first, slot - first))
+        return runs
+
+    def encode(self, block, since, seq):
+        regs = self.image.registers
+        runs = self._runs(block, since)
+        if self.fmt == FORMAT_JSON:
+            values = {}
+            for first, count in runs:
+                for slot in range(first, first + count):
+                    values[str(slot)] = regs[slot]
+            return json.dumps({"seq": seq, "block": block, "values": values}).encode()
+        size = _HEADER_SIZE
+        for first, count in runs:
+            size += _RUN_SIZE + count * 2
+        buf = bytearray(size)
+        struct.pack_into(_HEADER_FMT, buf, 0, PUBLISH_VERSION, block, seq, len(runs))
+        pos = _HEADER_SIZE
+        for first, count in runs:
+            struct.pack_into(_RUN_FMT, buf, pos, first, count)
+            pos += _RUN_SIZE
+            for slot in range(first, first + count):
+                struct.pack_into('>H', buf, pos, regs[slot])
+                pos += 2
+        return buf
+
+    def stats(self):
+        return {"messages": self.messages, "errors": self.errors}
+
+def decode_binary(payload):
+    """แปลงข้อความ binary กลับเป็น (block, seq, {slot: value}) ใช้ได้ทั้งบน collector และบนบอร์ด"""
+    version, block, seq, nruns = struct.unpack_from(_HEADER_FMT, payload, 0)
+    if version != PUBLISH_VERSION:
+        raise ValueError("unknown publish message version")
+    values = {}
+    pos = _HEADER_SIZE
+    for _ in range(nruns):
+        first, count = struct.unpack_from(_RUN_FMT, payload, pos)
+        pos += _RUN_SIZE
+        for slot in range(first, first + count):
+            values[slot] = struct.unpack_from('>H', payload, pos)[0]
+            pos += 2
+    return block, seq, values
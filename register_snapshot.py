@@ -0,0 +1,125 @@
+# register_snapshot.py
+# บันทึก/โหลด snapshot ของ register image ลง flash เพื่อให้หลังรีบูตมีค่าเดิมให้บริการทันที
+# แทนที่จะเป็น 0 (ซึ่ง historian จะบันทึกเป็นค่าจริง)
+#
+# รูปแบบไฟล์ (binary, little-endian ยกเว้นค่า register ที่เป็น big-endian แบบ Modbus):
+#   header : magic "MBSN" (4) + version (1) + จำนวน block (1) + ขนาด image (2)
+#   block  : slave (1) + quality (1) + rtu_start (2) + count (2) + offset (2) + time.time() (4)   x จำนวน block
+#   data   : ค่า register ของแต่ละ block เรียงต่อกัน (2 ไบต์ต่อ register, big-endian)
+#   CRC-16/Modbus ของทุกไบต์ก่อนหน้า (2)
+import os
+import struct
+import time
+from modbus_transport import crc16
+from modbus_codec import encode_registers, decode_registers
+from register_image import QUALITY_NONE
+
+SNAPSHOT_MAGIC = b'MBSN'
+SNAPSHOT_VERSION = 1
+_HEADER_FMT = '<4sBBH'
+_BLOCK_FMT = '<BBHHHL'
+_HEADER_SIZE = struct.calcsize(_HEADER_FMT)
+_BLOCK_SIZE = struct.calcsize(_BLOCK_FMT)
+
+class RegisterSnapshot:
+    def __init__(self, path='registers.snap', min_interval_ms=600000):
+        self.path = path
+        # Flash มีจำนวนรอบการเขียนจำกัด: เขียนไม่บ่อยกว่า min_interval_ms และเฉพาะเมื่อข้อมูลเปลี่ยน
+        self.min_interval_ms = min_interval_ms
+        self.last_save = time.ticks_ms()
+        self.last_crc = None # CRC ของค่า register ที่บันทึกล่าสุด ใช้ข้ามการเขียนถ้าค่าไม่เปลี่ยน
+        self.writes = 0
+        self.skipped = 0
+
+    def _encode(self, image):
+        """สร้างข้อมูลไฟล์ snapshot คืนค่า (buffer, CRC ของส่วนข้อมูล register)"""
+        n = image.num_blocks()
+        data_len = 0
+        for i in range(n):
+            data_len += image.block_count[i] * 2
+        buf = bytearray(_HEADER_SIZE + n * _BLOCK_SIZE + data_len + 2)
+        struct.pack_into(_HEADER_FMT, buf, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, n, image.size)
+        pos = _HEADER_SIZE
+        for i in range(n):
+            struct.pack_into(_BLOCK_FMT, buf, pos, image.block_slave[i], image.quality[i],
+                             image.block_start[i], image.block_count[i], image.block_offset[i],
+                             image.block_time[i])
+            pos += _BLOCK_SIZE
+        data_pos = pos
+        regs = image.registers
+        for i in range(n):
+            pos += encode_registers(regs, image.block_offset[i], image.block_count[i], buf, pos)
+        mv = memoryview(buf)
+        struct.pack_into('<H', buf, pos, crc16(mv[:pos]))
+        return buf, crc16(mv[data_pos:pos])
+
+    def _write(self, buf, data_crc, image):
+        # เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้ไฟล์เสียถ้าไฟดับระหว่างเขียน
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(buf)
+        os.rename(tmp_path, self.path)
+        self.last_crc = data_crc
+        self.last_save = time.ticks_ms()
+        self.writes += 1
+        image.dirty = False
+
+    def save(self, image):
+        """เขียน snapshot ทันที (ไม่สนใจ rate limit)"""
+        buf, data_crc = self._encode(image)
+        self._write(buf, data_crc, image)
+
+    def maybe_save(self, image):
+        """เรียกจาก main loop: บันทึกเมื่อครบ min_interval_ms และค่า register เปลี่ยนจากครั้งก่อน คืนค่า True ถ้าเขียนจริง"""
+        if not image.dirty:
+            return False
+        # ถ้ายังไม่เคยมี snapshot ให้บันทึกทันทีที่มีข้อมูล live ครั้งแรก ไม่ต้องรอครบรอบ
+        if self.last_crc is not None and time.ticks_diff(time.ticks_ms(), self.last_save) < self.min_interval_ms:
+            return False
+        buf, data_crc = self._encode(image)
+        if data_crc == self.last_crc: # ค่า register เหมือนเดิม (เปลี่ยนแค่เวลา) ไม่ต้องเขียน flash
+            self.last_save = time.ticks_ms()
+            self.skipped += 1
+            image.dirty = False
+            return False
+        try:
+            self._write(buf, data_crc, image)
+        except OSError as e:
+            print(f"snapshot: save failed: {e}")
+            self.last_save = time.ticks_ms() # ไม่ลองซ้ำทันที
+            return False
+        return True
+
+    def load(self, image):
+        """โหลด snapshot เข้า image (เฉพาะ block ที่ตรงกับ config ปัจจุบัน) คืนค่าจำนวน block ที่โหลดได้"""
+        try:
+            with open(self.path, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            return 0 # ยังไม่เคยมี snapshot
+
+        if len(buf) < _HEADER_SIZE + 2:
+            print("snapshot: file too short, ignored")
+            return 0
+        if crc16(memoryview(buf)[:-2]) != (buf[-2] | (buf[-1] << 8)):
+            print("snapshot: CRC mismatch, ignored")
+            return 0
+        magic, version, n, size = struct.unpack_from(_HEADER_FMT, buf, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            print("snapshot: unknown format, ignored")
+            return 0
+
+        restored = 0
+        pos = _HEADER_SIZE
+        data_pos = _HEADER_SIZE + n * _BLOCK_SIZE
+        for _ in range(n):
+            slave, quality, start, count, offset, stamp = struct.unpack_from(_BLOCK_FMT, buf, pos)
+            pos += _BLOCK_SIZE
+            index = image.find_block(slave, start, count)
+            if index >= 0 and quality != QUALITY_NONE:
+                values = decode_registers(buf, data_pos, count)
+                image.restore_block(index, values, stamp)
+                restored += 1
+            data_pos += count * 2
+        self.last_crc = crc16(memoryview(buf)[_HEADER_SIZE + n * _BLOCK_SIZE:-2])
+        return restored
@@ -0,0 +1,195 @@
+# routing.py
+# ตาราง routing ฝั่ง TCP: แปลง (unit id, address) ของ Modbus TCP เป็นตำแหน่ง (slot) ใน register image
+# แต่ละรายการคือ "window" (ช่วง address ต่อเนื่อง) ที่มี view ของตัวเอง เช่น ตรงตัว, scale, สลับ word
+# หรือ virtual register ที่ไม่ได้มาจาก RTU
+# เก็บเป็น array เรียงลำดับ แล้วค้นหาแบบ binary search (O(log windows)) ไม่มีการสร้าง dict/object ต่อ request
+import time
+from array import array
+from modbus_codec import to_float32, from_int32
+
+ANY_UNIT = 0x100 # unit id พิเศษ: ใช้ได้กับทุก unit ที่ไม่มี mapping ของตัวเอง
+
+# ชนิดของ view ของ window
+VIEW_DIRECT = 0    # ค่าตรงจาก register image (เหมือน TCP_START_REG ใน Arduino)
+VIEW_SCALE = 1     # ค่า = raw * mul // div + add (เลือก signed ได้)
+VIEW_WORD_SWAP = 2 # สลับ register คู่ (word order ของค่า 32-bit) ต้องมีจำนวนคู่
+VIEW_BYTE_SWAP = 3 # สลับไบต์สูง/ต่ำในแต่ละ register
+VIEW_CONST = 4     # virtual: ค่าคงที่จาก config
+VIEW_STATUS = 5    # virtual: สถานะของ block [quality, อายุข้อมูล (วินาที), จำนวนครั้งที่ล้มเหลวติดกัน, uptime (วินาที)]
+VIEW_FLOAT = 6     # float32 จาก register คู่ (ABCD หรือ CDAB) -> int32 ABCD ของ round(f * mul / div) ต้องมีจำนวนคู่
+
+VIEW_NAMES = {"direct": VIEW_DIRECT, "scale": VIEW_SCALE, "swap": VIEW_WORD_SWAP,
+              "byteswap": VIEW_BYTE_SWAP, "const": VIEW_CONST, "status": VIEW_STATUS,
+              "float": VIEW_FLOAT}
+STATUS_REGISTERS = 4
+
+def bisect_right(a, x):
+    """เหมือน bisect.bisect_right (MicroPython ไม่มีโมดูล bisect)"""
+    lo = 0
+    hi = len(a)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _round_int32(f):
+    """ปัดเป็นจำนวนเต็มในช่วง int32 (NaN = 0, เกินช่วง = ค่าสุดขอบ)"""
+    if f != f:
+        return 0
+    if f >= 2147483647:
+        return 2147483647
+    if f <= -2147483648:
+        return -2147483648
+    return round(f)
+
+class RoutingTable:
+    def __init__(self):
+        self._pending = [] # (key, count, slot, kind, param) ระหว่างสร้างตาราง จะถูกแปลงเป็น array ใน build()
+        self.starts = array('L') # key = (unit << 16) | address เริ่มต้น
+        self.ends = array('L')   # key สิ้นสุด (ไม่รวม)
+        self.slots = array('H')  # ตำแหน่งใน register image ที่ตรงกับ address เริ่มต้น
+        self.kinds = bytearray() # VIEW_* ของแต่ละ window
+        self.params = []         # พารามิเตอร์ของ view (None สำหรับ VIEW_DIRECT)
+        self.has_any_unit = False
+
+    def add(self, unit, address, count, slot, kind=VIEW_DIRECT, param=None):
+        if not (0 <= address and count > 0 and address + count <= 0x10000):
+            raise ValueError("invalid TCP address range")
+        if (kind == VIEW_WORD_SWAP or kind == VIEW_FLOAT) and count % 2:
+            raise ValueError("swap/float window needs an even register count")
+        if unit == ANY_UNIT:
+            self.has_any_unit = True
+        self._pending.append(((unit << 16) | address, count, slot, kind, param))
+
+    def build(self):
+        """เรียงลำดับและตรวจว่าช่วง address ไม่ทับซ้อนกัน ต้องเรียกหลัง add() ครบแล้ว"""
+        self._pending.sort(key=lambda e: e[0])
+        starts = array('L')
+        ends = array('L')
+        slots = array('H')
+        kinds = bytearray()
+        params = []
+        for key, count, slot, kind, param in self._pending:
+            if len(ends) and key < ends[-1]:
+                raise ValueError("overlapping TCP mapping at unit %d address %d" % (key >> 16, key & 0xFFFF))
+            starts.append(key)
+            ends.append(key + count)
+            slots.append(slot)
+            kinds.append(kind)
+            params.append(param)
+        self.starts = starts
+        self.ends = ends
+        self.slots = slots
+        self.kinds = kinds
+        self.params = params
+        self._pending = []
+
+    def _find(self, key, count):
+        i = bisect_right(self.starts, key) - 1
+        if i >= 0 and key + count <= self.ends[i]:
+            return i
+        return -1
+
+    def find(self, unit, address, count=1):
+        """คืนค่า index ของ window ที่ครอบคลุมช่วง (unit, address, count) ทั้งหมด หรือ -1"""
+        w = self._find((unit << 16) | address, count)
+        if w < 0 and self.has_any_unit:
+            w = self._find((ANY_UNIT << 16) | address, count)
+        return w
+
+    def lookup(self, unit, address, count=1):
+        """คืนค่า slot ใน register image ของช่วง (unit, address, count) หรือ -1 ถ้าไม่มี mapping ครอบคลุมทั้งช่วง"""
+        w = self.find(unit, address, count)
+        if w < 0:
+            return -1
+        return self.slots[w] + (address - (self.starts[w] & 0xFFFF))
+
+    def source_range(self, w, address, count):
+        """ช่วง (slot, count) ใน register image ที่ window ต้องใช้ (สำหรับตรวจ freshness) หรือ None ถ้าเป็น virtual"""
+        kind = self.kinds[w]
+        if kind == VIEW_CONST or kind == VIEW_STATUS:
+            return None
+        rel = address - (self.starts[w] & 0xFFFF)
+        if kind == VIEW_WORD_SWAP or kind == VIEW_FLOAT:
+            first = rel & ~1
+            return self.slots[w] + first, ((rel + count + 1) & ~1) - first
+        return self.slots[w] + rel, count
+
+    def slot_of(self, w, address):
+        """slot ใน register image ที่ address ของ window w อ่านค่ามา หรือ -1 ถ้าเป็น virtual
+        VIEW_FLOAT คืน slot แรกของคู่ (ค่าของ address ขึ้นกับทั้ง slot และ slot + 1)"""
+        kind = self.kinds[w]
+        if kind == VIEW_CONST or kind == VIEW_STATUS:
+            return -1
+        rel = address - (self.starts[w] & 0xFFFF)
+        if kind == VIEW_WORD_SWAP:
+            rel ^= 1
+        elif kind == VIEW_FLOAT:
+            rel &= ~1
+        return self.slots[w] + rel
+
+    def window_end(self, w):
+        """address สุดท้าย (ไม่รวม) ของ window w"""
+        return ((self.ends[w] - 1) & 0xFFFF) + 1
+
+    def read(self, w, address, count, registers, image=None, out=None):
+        """อ่านค่าช่วง (address, count) ของ window w ตาม view คืนค่า (values, index เริ่มต้นใน values)
+        VIEW_DIRECT คืน registers เองพร้อม slot (ไม่คัดลอก ให้ encode_registers pack ตรง)
+        view อื่นเขียนลง out (array('H') ที่ผู้เรียกจองไว้ อย่างน้อย count ช่อง) แล้วคืน (out, 0)"""
+        kind = self.kinds[w]
+        rel = address - (self.starts[w] & 0xFFFF)
+        base = self.slots[w] + rel
+        if kind == VIEW_DIRECT:
+            return registers, base
+        param = self.params[w]
+        if out is None:
+            out = array('H', bytes(count * 2))
+        if kind == VIEW_SCALE:
+            mul, div, add, signed = param
+            for i in range(count):
+                v = registers[base + i]
+                if signed and v & 0x8000:
+                    v -= 0x10000
+                out[i] = (v * mul // div + add) & 0xFFFF
+        elif kind == VIEW_WORD_SWAP:
+            slot = self.slots[w]
+            for i in range(count):
+                out[i] = registers[slot + ((rel + i) ^ 1)]
+        elif kind == VIEW_BYTE_SWAP:
+            for i in range(count):
+                v = registers[base + i]
+                out[i] = ((v & 0xFF) << 8) | (v >> 8)
+        elif kind == VIEW_FLOAT:
+            mul, div, word_swap = param
+            first = rel & ~1
+            floats = to_float32(registers, self.slots[w] + first, (rel + count + 1 - first) >> 1, word_swap)
+            words = from_int32([_round_int32(f * mul / div) for f in floats])
+            skip = rel - first
+            for i in range(count):
+                out[i] = words[skip + i]
+        elif kind == VIEW_CONST:
+            for i in range(count):
+                out[i] = param[rel + i] & 0xFFFF
+        elif kind == VIEW_STATUS:
+            block = param
+            for i in range(count):
+                r = rel + i
+                if r == 3:
+                    v = (time.ticks_ms() // 1000) & 0xFFFF
+                elif image is None:
+                    v = 0
+                elif r == 0:
+                    v = image.quality[block]
+                elif r == 1:
+                    age = image.age_ms(block)
+                    v = 0xFFFF if age < 0 else min(age // 1000, 0xFFFE)
+                else:
+                    v = image.fail_count[block]
+                out[i] = v
+        return out, 0
+
+    def __len__(self):
+        return len(self.starts)
@@ -0,0 +1,188 @@
+# rtu_bus.py
+# จัดการ RS-485 bus แต่ละเส้นแยกกัน: ModbusRTUMaster 1 ตัว + ตาราง poll ของ block บน bus นั้น + timing model
+# poll() ไม่บล็อก (ส่ง request แล้วกลับทันที, รอ Response ในรอบถัดไป) จึงเรียกหลาย bus สลับกันใน main loop ได้
+# UART แต่ละตัวรับ/ส่งใน hardware อยู่แล้ว ทุก bus จึงทำ transaction ไปพร้อมกันได้จริง
+# นับเวลาที่ bus ไม่ว่างในแต่ละช่วง 1 วินาที ถ้าเกินเพดาน (max_utilisation) จะยืด interval ของ block
+# ที่ priority ต่ำ (priority > 0) ออกไป แล้วค่อยๆ คืนกลับเมื่อ bus ว่างลง
+import time
+from array import array
+from modbus_transport import t35_us
+
+class RTUTiming:
+    """เวลาบน bus ตาม baud rate: ความยาว 1 ตัวอักษร, t3.5 (ช่วงเงียบระหว่าง frame) และ timeout ของ Response"""
+    def __init__(self, baudrate, bits_per_char=11, turnaround_ms=100):
+        self.baudrate = baudrate
+        # 1 ตัวอักษร RTU = start + 8 data + parity/stop + stop = 11 bit
+        self.char_us = bits_per_char * 1000000 // baudrate
+        self.t35_us = t35_us(baudrate, bits_per_char)
+        self.turnaround_ms = turnaround_ms # เวลาที่ slave ใช้ประมวลผลก่อนตอบ (ค่าเผื่อ)
+
+    def frame_us(self, nbytes):
+        """เวลาที่ใช้ส่ง frame ยาว nbytes ไบต์บนสาย"""
+        return nbytes * self.char_us
+
+    def response_timeout_ms(self, request_len, response_len):
+        """timeout ของ transaction: ส่ง request + turnaround + รับ response (ปัดขึ้นเป็น ms)"""
+        wire_us = self.frame_us(request_len + response_len) + self.t35_us
+        return self.turnaround_ms + (wire_us + 999) // 1000
+
+    def read_cost_us(self, quantity):
+        """เวลาบนสายโดยประมาณของการอ่าน FC03 1 ครั้ง: request 8 ไบต์ + response + ช่วงเงียบ t3.5 สองช่วง
+        (ไม่รวม turnaround ของ slave ซึ่งวัดได้จริงจากเวลา transaction)"""
+        return self.frame_us(8 + 5 + quantity * 2) + 2 * self.t35_us
+
+UTIL_WINDOW_MS = 1000 # ช่วงเวลาที่ใช้คำนวณ utilisation
+MAX_STRETCH = 800     # ยืด interval ของ block priority ต่ำได้สูงสุด 8 เท่า (หน่วย %)
+
+class RTUBus:
+    def __init__(self, name, master, image, timing, max_utilisation=80, history=None):
+        self.name = name
+        self.master = master # ModbusRTUMaster ของ UART นี้
+        self.image = image   # RegisterImage ที่ใช้ร่วมกันทุก bus
+        self.timing = timing
+        self.history = history # RegisterHistory (ถ้ามี) เก็บทุก sample ที่ poll สำเร็จ
+        self.blocks = array('B')      # index ของ block ใน image ที่อยู่บน bus นี้
+        self.interval_ms = array('L')
+        self.next_poll = array('L')
+        self.priority = bytearray()   # 0 = ห้ามยืด interval, > 0 = ยืดได้เมื่อ bus แน่น
+        self.cost_us = array('L')     # เวลาบนสายโดยประมาณต่อการ poll 1 ครั้ง
+        self.achieved_ms = array('L') # interval ที่ทำได้จริง (ค่าเฉลี่ยแบบ exponential)
+        self.last_start = array('L')
+        # Transaction ที่ compile แล้วต่อ block: (request frame, ความยาว Response, timeout ms)
+        # compile ใหม่อัตโนมัติเมื่อตาราง poll หรือ slave address ใน image เปลี่ยน (layout_version)
+        self.plans = []
+        self._layout = -1
+        self.current = -1             # index ใน self.blocks ของ transaction ที่กำลังรออยู่ (-1 = ว่าง)
+        self.idle_since = time.ticks_us()
+        self.first_round_done = True # bus ที่ไม่มี block ถือว่าเสร็จรอบแรกแล้ว
+        self._first_pending = 0
+        # สถิติ: จำนวน transaction, สำเร็จ, ล้มเหลว
+        self.transactions = 0
+        self.ok = 0
+        self.failed = 0
+        # bus utilisation: เวลาที่ไม่ว่าง (us) ในช่วงปัจจุบัน, utilisation ของช่วงก่อน (%), ตัวคูณ interval (%)
+        self.max_utilisation = max_utilisation
+        self.busy_us = 0
+        self.window_start = time.ticks_ms()
+        self.utilisation = 0
+        self.stretch = 100
+        self._tx_start = 0
+
+    def add_block(self, block, interval_ms, priority=0):
+        self.blocks.append(block)
+        self.interval_ms.append(interval_ms)
+        self.priority.append(priority)
+        self.cost_us.append(self.timing.read_cost_us(self.image.block_count[block]))
+        self.achieved_ms.append(0)
+        self.last_start.append(0)
+        self.next_poll.append(time.ticks_ms()) # poll รอบแรกทันที
+        self._first_pending += 1
+        self.first_round_done = False
+        self._layout = -1 # ตาราง poll เปลี่ยน: compile ใหม่ก่อน poll ครั้งถัดไป
+
+    def _compile(self):
+        image = self.image
+        master = self.master
+        plans = []
+        for block in self.blocks:
+            count = image.block_count[block]
+            expected = 5 + count * 2
+            frame = master.request_frame(image.block_start[block], count, image.block_slave[block])
+            plans.append((frame, expected, self.timing.response_timeout_ms(len(frame), expected)))
+        self.plans = plans
+        self._layout = image.layout_version
+
+    def poll(self):
+        """เดินหน้า bus 1 ก้าว (ไม่บล็อก): รับ Response ที่ค้างอยู่ หรือเริ่ม transaction ของ block ที่ถึงเวลา"""
+        master = self.master
+        if self.current >= 0:
+            result = master.poll_transaction(False) # payload ใน RX buffer: decode ลง image โดยตรง
+            if result is None:
+                return # ยังรอ Response อยู่
+            # เวลาที่ bus ไม่ว่างนับถึงไบต์สุดท้ายที่รับ (ไม่รวมเวลาที่ main loop ทำงานอื่นก่อนมา poll)
+            self.idle_since = master.done_us
+            self.busy_us += time.ticks_diff(self.idle_since, self._tx_start)
+            self._finish(self.current, result)
+            self.current = -1
+            return
+
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.window_start) >= UTIL_WINDOW_MS:
+            self._update_utilisation(now)
+
+        # เว้นช่วงเงียบ t3.5 หลัง Response ก่อนส่ง request ถัดไป ตามมาตรฐาน RTU
+        if time.ticks_diff(time.ticks_us(), self.idle_since) < self.timing.t35_us:
+            return
+
+        image = self.image
+        if self._layout != image.layout_version:
+            self._compile()
+        for i in range(len(self.blocks)):
+            if time.ticks_diff(now, self.next_poll[i]) >= 0:
+                self.next_poll[i] = time.ticks_add(now, self.effective_interval_ms(i))
+                if self.last_start[i]:
+                    # interval จริงเฉลี่ยแบบ exponential (น้ำหนักค่าใหม่ 1/4)
+                    elapsed = time.ticks_diff(now, self.last_start[i])
+                    prev = self.achieved_ms[i]
+                    self.achieved_ms[i] = elapsed if not prev else (prev * 3 + elapsed) // 4
+                self.last_start[i] = now or 1 # 0 = ยังไม่เคย poll
+                frame, expected, timeout = self.plans[i]
+                self._tx_start = time.ticks_us()
+                master.begin_transaction(frame, expected, timeout)
+                self.current = i
+                self.transactions += 1
+                return # เริ่มได้ครั้งละ 1 transaction ต่อ bus
+
+    def _finish(self, i, result):
+        image = self.image
+        block = self.blocks[i]
+        if result is not False:
+            image.update_block_payload(block, result)
+            if self.history:
+                self.history.record(block)
+            self.ok += 1
+        else:
+            image.mark_failed(block)
+            self.failed += 1
+            print(f"rtu_bus {self.name}: read of block {block} returned no data or failed "
+                  f"({image.fail_count[block]} in a row, data age {image.age_ms(block)} ms).")
+        if not self.first_round_done:
+            self._first_pending -= 1
+            if self._first_pending <= 0:
+                self.first_round_done = True
+
+    def effective_interval_ms(self, i):
+        """interval ที่ใช้จริง: block priority ต่ำถูกยืดตาม stretch เมื่อ bus แน่นเกินเพดาน"""
+        if self.priority[i] and self.stretch != 100:
+            return self.interval_ms[i] * self.stretch // 100
+        return self.interval_ms[i]
+
+    def _update_utilisation(self, now):
+        elapsed_ms = time.ticks_diff(now, self.window_start)
+        self.utilisation = min(100, self.busy_us // (elapsed_ms * 10)) # busy_us / (elapsed_ms * 1000) * 100
+        self.busy_us = 0
+        self.window_start = now
+        ceiling = self.max_utilisation
+        if self.utilisation > ceiling:
+            # ยืดตามสัดส่วนที่เกิน เช่น ใช้ 100% เพดาน 80% -> ยืดอีก 25%
+            self.stretch = min(MAX_STRETCH, self.stretch * self.utilisation // ceiling + 1)
+        elif self.stretch > 100 and self.utilisation < ceiling * 3 // 4:
+            # ค่อยๆ คืน interval เดิมเมื่อ bus ว่างลงชัดเจน (hysteresis กันแกว่ง)
+            self.stretch = max(100, self.stretch * 7 // 8)
+
+    def planned_utilisation(self):
+        """utilisation ที่คาดไว้จาก config (%): ผลรวมของ cost / interval ของทุก block"""
+        total = 0
+        for i in range(len(self.blocks)):
+            total += self.cost_us[i] // (self.interval_ms[i] * 10 or 1)
+        return total
+
+    def block_report(self):
+        """คืนค่า list ของ (block, interval ที่ตั้งไว้ ms, interval ที่ใช้ตอนนี้ ms, interval ที่ทำได้จริง ms, cost us)"""
+        return [(self.blocks[i], self.interval_ms[i], self.effective_interval_ms(i), self.achieved_ms[i], self.cost_us[i])
+                for i in range(len(self.blocks))]
+
+    def stats(self):
+        return {"bus": self.name, "baudrate": self.timing.baudrate, "blocks": len(self.blocks),
+                "transactions": self.transactions, "ok": self.ok, "failed": self.failed,
+                "utilisation": self.utilisation, "stretch": self.stretch, "resyncs": self.master.resyncs}
@@ -1,29 +1,16 @@
-import network
 import time
+from wifi_supervisor import WiFiSupervisor
 
 SSID = 'wifi-ice'
 PASSWORD = ''
 
-wlan = network.WLAN(network.STA_IF)
-wlan.active(True)
-
-def connect():
-    if not wlan.isconnected():
-        print("เชื่อมต่อ Wi-Fi...")
-        wlan.connect(SSID, PASSWORD)
-        for i in range(20):
-            status = wlan.status()
-            print(f"ลองครั้งที่ {i+1}, status: {status}")
-            if status == 1010:  # GOT_IP
-                break
-            time.sleep(1)
-
-connect()
+# ทดสอบ WiFiSupervisor: reconnect แบบ back-off โดยไม่บล็อก loop
+wifi = WiFiSupervisor(SSID, PASSWORD, on_ip_change=lambda ip: print("🟢 Connected:", ip))
 
+last_report = time.ticks_ms()
 while True:
-    if not wlan.isconnected():
-        print("หลุดการเชื่อมต่อ, กำลัง reconnect...")
-        connect()
-    else:
-        print("🟢 Connected:", wlan.ifconfig()[0])
-    time.sleep(5)
\ No newline at end of file
+    wifi.poll()
+    if time.ticks_diff(time.ticks_ms(), last_report) >= 5000:
+        last_report = time.ticks_ms()
+        print(wifi.stats())
+    time.sleep_ms(50)
@@ -0,0 +1,158 @@
+# wifi_supervisor.py
+# State machine ดูแล Wi-Fi แบบไม่บล็อก: เรียก poll() จาก main loop ทุกรอบ
+# ไม่มี time.sleep() ในนี้ ฝั่ง Modbus RTU จึงทำงานต่อได้ระหว่างที่ Wi-Fi หลุด/กำลังต่อใหม่
+import time
+import network
+
+STATE_IDLE = 0       # ยังไม่ได้สั่ง connect
+STATE_CONNECTING = 1 # สั่ง connect แล้ว รอผล
+STATE_CONNECTED = 2  # ได้ IP แล้ว
+STATE_BACKOFF = 3    # ต่อไม่สำเร็จ รอ back-off ก่อนลองใหม่
+
+STATE_NAMES = ("IDLE", "CONNECTING", "CONNECTED", "BACKOFF")
+
+# สถานะที่ driver บอกว่าล้มเหลวแน่นอนแล้ว ไม่ต้องรอจน timeout
+_FAIL_STATUSES = []
+for _name in ("STAT_NO_AP_FOUND", "STAT_WRONG_PASSWORD", "STAT_CONNECT_FAIL", "STAT_BEACON_TIMEOUT", "STAT_ASSOC_FAIL", "STAT_HANDSHAKE_TIMEOUT"):
+    if hasattr(network, _name):
+        _FAIL_STATUSES.append(getattr(network, _name))
+
+class WiFiSupervisor:
+    def __init__(self, ssid, password, on_ip_change=None, on_disconnect=None,
+                 connect_timeout_ms=15000, backoff_min_ms=1000, backoff_max_ms=60000,
+                 ip_check_interval_ms=5000):
+        self.ssid = ssid
+        self.password = password
+        self.on_ip_change = on_ip_change   # callback(ip) เมื่อได้ IP ใหม่ หรือ IP เปลี่ยน (เช่นหลัง DHCP renew)
+        self.on_disconnect = on_disconnect # callback() เมื่อ Wi-Fi หลุด
+        self.connect_timeout_ms = connect_timeout_ms
+        self.backoff_min_ms = backoff_min_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.ip_check_interval_ms = ip_check_interval_ms
+
+        self.nic = network.WLAN(network.STA_IF)
+        if not self.nic.active():
+            self.nic.active(True)
+
+        self.ip = None
+        self.backoff_ms = backoff_min_ms
+        self.state_since = time.ticks_ms()
+        self.last_ip_check = self.state_since
+
+        # สถิติช่วงเวลาที่ Wi-Fi หลุด (นับเฉพาะหลังจากเคยเชื่อมต่อได้แล้ว)
+        self.outage_start = None
+        self.outage_count = 0
+        self.last_outage_ms = 0
+        self.longest_outage_ms = 0
+        self.total_outage_ms = 0
+        self.connect_attempts = 0
+
+        # ใช้การเชื่อมต่อเดิมถ้ามีอยู่แล้ว (boot.py อาจเชื่อมต่อไว้แล้ว)
+        if self.nic.isconnected():
+            self.state = STATE_CONNECTED
+            self._check_ip(self.state_since)
+        elif self.nic.status() == network.STAT_CONNECTING:
+            self.state = STATE_CONNECTING
+        else:
+            self.state = STATE_IDLE
+
+    def isconnected(self):
+        return self.state == STATE_CONNECTED
+
+    def _set_state(self, state, now):
+        self.state = state
+        self.state_since = now
+
+    def _start_connect(self, now):
+        self.connect_attempts += 1
+        try:
+            self.nic.disconnect() # ล้างสถานะค้างของ driver ก่อนสั่งใหม่
+        except OSError:
+            pass
+        try:
+            self.nic.connect(self.ssid, self.password)
+        except OSError as e:
+            print(f"wifi: connect() error: {e}")
+            self._enter_backoff(now)
+            return
+        self._set_state(STATE_CONNECTING, now)
+
+    def _enter_backoff(self, now):
+        self._set_state(STATE_BACKOFF, now)
+        print(f"wifi: connect failed (status {self.nic.status()}), retry in {self.backoff_ms} ms")
+
+    def _check_ip(self, now):
+        self.last_ip_check = now
+        ip = self.nic.ifconfig()[0]
+        if ip != self.ip and ip != "0.0.0.0":
+            old_ip = self.ip
+            self.ip = ip
+            if old_ip is None:
+                print(f"wifi: connected, IP {ip}")
+            else:
+                print(f"wifi: IP changed {old_ip} -> {ip}")
+            if self.on_ip_change:
+                self.on_ip_change(ip)
+
+    def _on_connected(self, now):
+        self._set_state(STATE_CONNECTED, now)
+        self.backoff_ms = self.backoff_min_ms
+        if self.outage_start is not None:
+            outage = time.ticks_diff(now, self.outage_start)
+            self.outage_start = None
+            self.outage_count += 1
+            self.last_outage_ms = outage
+            self.total_outage_ms += outage
+            if outage > self.longest_outage_ms:
+                self.longest_outage_ms = outage
+            print(f"wifi: reconnected after {outage} ms outage")
+        self._check_ip(now)
+
+    def poll(self):
+        """เรียกจาก main loop ทุกรอบ ทำงานเสร็จทันทีเสมอ (ไม่มีการรอ)"""
+        now = time.ticks_ms()
+        state = self.state
+
+        if state == STATE_CONNECTED:
+            if not self.nic.isconnected():
+                print("wifi: connection lost")
+                self.outage_start = now
+                if self.on_disconnect:
+                    self.on_disconnect()
+                self._start_connect(now)
+            elif time.ticks_diff(now, self.last_ip_check) >= self.ip_check_interval_ms:
+                self._check_ip(now)
+
+        elif state == STATE_CONNECTING:
+            if self.nic.isconnected():
+                self._on_connected(now)
+            elif (self.nic.status() in _FAIL_STATUSES or
+                  time.ticks_diff(now, self.state_since) >= self.connect_timeout_ms):
+                self._enter_backoff(now)
+
+        elif state == STATE_BACKOFF:
+            if self.nic.isconnected(): # driver อาจต่อกลับได้เองระหว่างรอ
+                self._on_connected(now)
+            elif time.ticks_diff(now, self.state_since) >= self.backoff_ms:
+                # Exponential back-off: 1s, 2s, 4s, ... สูงสุด backoff_max_ms
+                self.backoff_ms = min(self.backoff_ms * 2, self.backoff_max_ms)
+                self._start_connect(now)
+
+        else: # STATE_IDLE
+            self._start_connect(now)
+
+    def stats(self):
+        """คืนค่าสถิติ Wi-Fi เป็น dict (ใช้สำหรับ debug/print)"""
+        current = 0
+        if self.outage_start is not None:
+            current = time.ticks_diff(time.ticks_ms(), self.outage_start)
+        return {
+            "state": STATE_NAMES[self.state],
+            "ip": self.ip,
+            "attempts": self.connect_attempts,
+            "outages": self.outage_count,
+            "current_outage_ms": current,
+            "last_outage_ms": self.last_outage_ms,
+            "longest_outage_ms": self.longest_outage_ms,
+            "total_outage_ms": self.total_outage_ms,
+        }